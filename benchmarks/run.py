@@ -0,0 +1,242 @@
+""" Benchmarks of imageservice: cold renders, warm hits, extension guessing and concurrent misses.
+
+    Runs against generated fixture images of several formats and sizes plus test_media, and prints
+    the results as JSON (or writes them to --output) so that runs of different revisions can be compared:
+
+    > python benchmarks/run.py --repeat 5 --output bench_output.txt
+
+"""
+from __future__ import with_statement
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from optparse import OptionParser
+from distutils.spawn import find_executable
+
+root = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..')
+sys.path.insert(0, root)
+
+FIXTURE_FORMATS = ('png', 'jpg', 'gif')
+FIXTURE_SIZES = (256, 1024, 4096)
+SIZES = ((100, 100), (320, 200), (800, 600))
+TEMPLATES = ('thumbnail', 'grayscale')
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--repeat', type='int', default=3, help='Repetitions of every measurement.')
+    parser.add_option('--requests', type='int', default=200, help='Requests per warm hit measurement.')
+    parser.add_option('--concurrency', type='int', default=8, help='Number of concurrent misses.')
+    parser.add_option('--backend', default='imagemagick', help='Imaging backend, imagemagick or pillow.')
+    parser.add_option('--output', help='Write results to this file instead of stdout.')
+    (options, _) = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        media_root = os.path.join(work_dir, 'media')
+        cache_root = os.path.join(work_dir, 'cache')
+        os.makedirs(cache_root)
+        sources = create_fixtures(media_root)
+        configure(media_root, cache_root, options.backend)
+
+        benchmark = Benchmark(media_root, cache_root, options)
+        results = {
+            'revision': revision(),
+            'python': sys.version.split()[0],
+            'backend': options.backend,
+            'started': time.time(),
+            'results': benchmark.run(sources),
+        }
+    finally:
+        shutil.rmtree(work_dir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        open(options.output, 'w').write(output + "\n")
+    else:
+        print output
+
+def configure(media_root, cache_root, backend):
+    from django.conf import settings
+    settings.configure(RESIZE_MAX_HEIGHT=4096, RESIZE_MAX_WIDTH=4096,
+                       MEDIA_ROOT=media_root,
+                       MEDIA_CACHE_ROOT=cache_root,
+                       DATABASE_ENGINE=None,
+                       INSTALLED_APPS=('imageservice',),
+                       ROOT_URLCONF='imageservice.urls',
+                       TEMPLATE_DIRS=(os.path.dirname(os.path.abspath(__file__)),),
+                       RESIZE_BACKEND=backend,
+                       RESIZE_RENDER_SLOTS_DIR=os.path.join(cache_root, '..', 'slots'))
+
+def create_fixtures(media_root):
+    """ Creates noisy images of every format and size below media_root and copies test_media there.
+        Returns their names without extension, mapped to their extension.
+    """
+    os.makedirs(media_root)
+    sources = {}
+    for name in os.listdir(os.path.join(root, 'test_media')):
+        shutil.copy(os.path.join(root, 'test_media', name), media_root)
+        (base, extension) = os.path.splitext(name)
+        sources[base] = extension
+
+    for size in FIXTURE_SIZES:
+        for image_format in FIXTURE_FORMATS:
+            name = 'fixture%d%s' % (size, image_format)
+            _create_image(os.path.join(media_root, name + '.' + image_format), size)
+            sources[name] = '.' + image_format
+    return sources
+
+def _create_image(file_name, size):
+    try:
+        from PIL import Image
+    except ImportError:
+        subprocess.check_call(['convert', '-size', '%dx%d' % (size, size), 'plasma:', file_name])
+        return
+    noise = Image.frombytes('RGB', (size / 8, size / 8), os.urandom(size * size * 3 / 64))
+    image = noise.resize((size, size), Image.BILINEAR)
+    image.paste((255, 255, 255), (0, 0, size, size / 8))
+    image.save(file_name)
+
+def revision():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=root, stdout=subprocess.PIPE).communicate()[0].strip()
+    except OSError:
+        return None
+
+class Benchmark(object):
+
+    def __init__(self, media_root, cache_root, options):
+        self.media_root = media_root
+        self.cache_root = cache_root
+        self.options = options
+        self.results = []
+
+    def run(self, sources):
+        if self.options.backend == 'imagemagick' and not find_executable('convert'):
+            self.record('cold_render', skipped='convert not found')
+        else:
+            self.cold_render(sources)
+            self.warm_hits(sources)
+            self.concurrent_misses(sources)
+        self.extension_guessing(sources)
+        return self.results
+
+    def record(self, benchmark, **values):
+        values['benchmark'] = benchmark
+        self.results.append(values)
+
+    def record_measurement(self, benchmark, function, setup=None, **values):
+        try:
+            values.update(self.measure(function, setup))
+        except Exception, e:
+            values['error'] = str(e)
+        self.record(benchmark, **values)
+
+    def cold_render(self, sources):
+        from imageservice import imagemagick, paths, views
+        for (name, extension) in sorted(sources.items()):
+            for (width, height) in SIZES:
+                target = paths.resized_file(name, width, height, extension)
+                self.record_measurement('cold_render',
+                                        lambda: imagemagick.resize(paths.source_file(name, extension), target, width, height),
+                                        self.clear_cache, source=name + extension, size='%dx%d' % (width, height))
+            for template_name in TEMPLATES:
+                target = paths.template_file(name, template_name, extension)
+                command = views.templatesRepo.getTemplate(template_name)
+                self.record_measurement('cold_render',
+                                        lambda: imagemagick.execute(command, paths.source_file(name), target),
+                                        self.clear_cache, source=name + extension, template=template_name)
+
+    def warm_hits(self, sources):
+        from django.test.client import Client
+        client = Client()
+        (name, extension) = sorted(sources.items())[0]
+        url = '/%s.100x100%s' % (name, extension)
+        client.get(url)
+
+        def requests():
+            for _ in range(self.options.requests):
+                response = client.get(url)
+                assert response.status_code == 200, response.status_code
+        result = self.measure(requests)
+        result['requests_per_second'] = self.options.requests / result['median']
+        self.record('warm_hits', url=url, requests=self.options.requests, **result)
+
+    def extension_guessing(self, sources):
+        from django.conf import settings
+        from imageservice import imagemagick
+        cases = {
+            'with_extension': os.path.join(self.media_root, 'test.png'),
+            'upper_case_extension': os.path.join(self.media_root, 'Case'),
+            'missing': os.path.join(self.media_root, 'missing'),
+        }
+        for (source_index, ttl) in (('off', 0), ('mtime', 0), ('ttl', 60)):
+            settings.RESIZE_SOURCE_INDEX = source_index != 'off'
+            settings.RESIZE_SOURCE_INDEX_TTL = ttl
+            for (case, src) in sorted(cases.items()):
+                def lookups():
+                    for _ in range(1000):
+                        try:
+                            imagemagick._findAndVerifySource(src)
+                        except IOError:
+                            pass
+                self.record_measurement('extension_guessing', lookups, case=case, source_index=source_index, lookups=1000)
+        settings.RESIZE_SOURCE_INDEX = False
+
+    def concurrent_misses(self, sources):
+        from imageservice import imagemagick, paths
+        (name, extension) = ('fixture1024jpg', '.jpg')
+        concurrency = self.options.concurrency
+
+        def identical():
+            self.in_threads([lambda: imagemagick.resize(paths.source_file(name, extension),
+                                                        paths.resized_file(name, 200, 200, extension), 200, 200)] * concurrency)
+
+        def distinct():
+            self.in_threads([(lambda size: lambda: imagemagick.resize(paths.source_file(name, extension),
+                                                                      paths.resized_file(name, size, size, extension), size, size))(100 + i)
+                             for i in range(concurrency)])
+
+        self.record_measurement('concurrent_misses', identical, self.clear_cache, kind='identical', concurrency=concurrency)
+        self.record_measurement('concurrent_misses', distinct, self.clear_cache, kind='distinct', concurrency=concurrency)
+
+    def in_threads(self, functions):
+        """ Runs every function in a thread of its own. Raises the first exception of a thread, if any,
+            after all threads have finished, so that record_measurement records it as an error.
+        """
+        errors = []
+        def run(function):
+            try:
+                function()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(function,)) for function in functions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def measure(self, function, setup=None):
+        """ Runs function --repeat times and returns the wall clock seconds of every run and their median. """
+        seconds = []
+        for _ in range(self.options.repeat):
+            if setup is not None:
+                setup()
+            start = time.time()
+            function()
+            seconds.append(time.time() - start)
+        return {'seconds': seconds, 'median': sorted(seconds)[len(seconds) / 2]}
+
+    def clear_cache(self):
+        shutil.rmtree(self.cache_root)
+        os.makedirs(self.cache_root)
+
+if __name__ == '__main__':
+    main()
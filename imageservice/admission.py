@@ -0,0 +1,97 @@
+from __future__ import with_statement
+
+import os
+import time
+import tempfile
+
+from contextlib import contextmanager
+from django.conf import settings
+from imageservice import locks, metrics, tracing
+
+class RendererBusy(Exception):
+    """ Raised when an image can not be rendered right now because too many images are being rendered. """
+    pass
+
+class RenderQueueFull(RendererBusy):
+    """ Raised when too many renders are already waiting. """
+    pass
+
+class RenderQueueTimeout(RendererBusy):
+    """ Raised when no render slot became free in time. """
+    pass
+
+@contextmanager
+def render_slot():
+    """ Limits the number of images rendered at the same time on this host. Waits for one of
+        settings.RESIZE_MAX_CONCURRENT_RENDERS slots to become free, unless the setting is None (default).
+
+        At most settings.RESIZE_RENDER_QUEUE_SIZE callers (default 100) wait at the same time, others get
+        RenderQueueFull right away. A caller waiting longer than settings.RESIZE_RENDER_QUEUE_TIMEOUT
+        seconds (default 10) gets RenderQueueTimeout.
+
+        Slots are lock files in settings.RESIZE_RENDER_SLOTS_DIR, which defaults to a directory in the
+        system's temp dir, so all processes on the host share them.
+
+    """
+    max_renders = getattr(settings, 'RESIZE_MAX_CONCURRENT_RENDERS', None)
+    if not max_renders or locks.fcntl is None:
+        yield
+        return
+
+    slots_dir = _slots_dir()
+    slot = _try_slots(slots_dir, 'render', max_renders)
+    if slot is None:
+        queue_slot = _try_slots(slots_dir, 'queue', getattr(settings, 'RESIZE_RENDER_QUEUE_SIZE', 100))
+        if queue_slot is None:
+            metrics.incr('render_rejected', reason='queue_full')
+            raise RenderQueueFull("Too many images are waiting to be rendered.")
+        start = time.time()
+        try:
+            with tracing.phase('queue'):
+                slot = _wait_for_slot(slots_dir, max_renders, getattr(settings, 'RESIZE_RENDER_QUEUE_TIMEOUT', 10))
+        except RenderQueueTimeout:
+            metrics.incr('render_rejected', reason='timeout')
+            raise
+        finally:
+            locks.release_lock_file(queue_slot)
+            metrics.timing('queue_wait_seconds', time.time() - start)
+
+    try:
+        yield
+    finally:
+        locks.release_lock_file(slot)
+
+def _wait_for_slot(slots_dir, max_renders, timeout):
+    deadline = time.time() + timeout
+    while True:
+        slot = _try_slots(slots_dir, 'render', max_renders)
+        if slot is not None:
+            return slot
+        if time.time() >= deadline:
+            raise RenderQueueTimeout("Timed out waiting to render image.")
+        time.sleep(locks.POLL_INTERVAL)
+
+def _try_slots(slots_dir, name, count):
+    for i in range(count):
+        slot = locks.try_lock_file(os.path.join(slots_dir, '%s-%d.lock' % (name, i)))
+        if slot is not None:
+            return slot
+    return None
+
+def _slots_dir():
+    slots_dir = getattr(settings, 'RESIZE_RENDER_SLOTS_DIR', None) or os.path.join(tempfile.gettempdir(), 'imageservice-slots')
+    if not os.path.isdir(slots_dir):
+        try:
+            os.makedirs(slots_dir)
+        except OSError:
+            pass # Created by another process
+    return slots_dir
+
+def imagemagick_limits():
+    """ Returns imagemagick -limit arguments for settings.RESIZE_IMAGEMAGICK_LIMITS, a dict of resource
+        name and limit, for example {'memory': '256MiB', 'map': '512MiB', 'thread': 1, 'time': 60}.
+    """
+    args = []
+    for (resource, limit) in sorted(getattr(settings, 'RESIZE_IMAGEMAGICK_LIMITS', {}).items()):
+        args += ['-limit', resource, str(limit)]
+    return args
@@ -0,0 +1,63 @@
+from django.conf import settings
+from imageservice import metrics, probe
+
+def flattened(template_name='resize'):
+    """ Whether animated sources are rendered as a still image of their first frame for a template.
+
+        settings.RESIZE_FLATTEN_ANIMATIONS: Names of such templates, where 'resize' stands for resized
+        images, or True for all images. (Default ())
+    """
+    flatten = getattr(settings, 'RESIZE_FLATTEN_ANIMATIONS', ())
+    return flatten is True or template_name in (flatten or ())
+
+def animates(src, target, flatten=False):
+    """ Whether target is rendered frame by frame from src. That is the case for animated GIF sources
+        rendered to GIF targets, unless flatten is True or the animation exceeds the limits:
+
+        settings.RESIZE_MAX_FRAMES: Maximum number of frames. (Default None, no limit)
+
+        settings.RESIZE_MAX_ANIMATION_PIXELS: Maximum number of pixels of all frames together, for example
+        100000000. (Default None, no limit)
+
+        Animated sources that are not rendered frame by frame are rendered from their first frame only.
+    """
+    if flatten or not target.lower().endswith('.gif'):
+        return False
+    info = probe.probe(src)
+    if info is None or info.frames <= 1:
+        return False
+    max_frames = getattr(settings, 'RESIZE_MAX_FRAMES', None)
+    max_pixels = getattr(settings, 'RESIZE_MAX_ANIMATION_PIXELS', None)
+    if (max_frames and info.frames > max_frames) or (max_pixels and info.pixels() * info.frames > max_pixels):
+        metrics.incr('animation_fallbacks')
+        return False
+    return True
+
+def command(command):
+    """ Returns an imagemagick command that applies command to every full frame of an animation
+        and optimizes the frames of the result.
+    """
+    if is_animated(command.split('  ')):
+        return command
+    return '-coalesce  %s  -layers  Optimize' % command
+
+def resize_command(width, height):
+    """ Returns the command that resizes an animation like imagemagick.resize_command does still images,
+        except for trimming, which would trim every frame differently.
+    """
+    return command('-resize  %dx%d>  -background  white  -gravity  center  -extent  %dx%d' % (width, height, width, height))
+
+def is_animated(args):
+    return '-coalesce' in args
+
+def input_file(src, args):
+    """ Returns the name imagemagick reads src as with the arguments args: Only the first frame of
+        animated sources, unless args render every frame (see command). Reading a single frame saves
+        decoding all of them.
+    """
+    if is_animated(args):
+        return src
+    info = probe.probe(src)
+    if info is not None and info.frames > 1:
+        return src + '[0]'
+    return src
@@ -0,0 +1,39 @@
+from django.conf import settings
+
+class UnsupportedCommand(Exception):
+    """ Raised by a backend that can not render an imagemagick command. The command is then rendered by imagemagick. """
+    pass
+
+class ImageMagickBackend(object):
+    """ Renders commands with imagemagick processes. """
+
+    def render(self, command, src, target):
+        from imageservice import imagemagick
+        imagemagick._runImageMagick(src, command.split('  '), target)
+
+def get_backend(name):
+    """ Returns the backend with the given name, 'imagemagick' or 'pillow'. """
+    if name not in _backends:
+        if name == 'imagemagick':
+            _backends[name] = ImageMagickBackend()
+        elif name == 'pillow':
+            from imageservice.pillow_backend import PillowBackend
+            _backends[name] = PillowBackend()
+        else:
+            raise ValueError("Unknown imaging backend: %s" % name)
+    return _backends[name]
+
+_backends = {}
+
+def backend_name(template_name=None):
+    """ Returns the name of the backend configured for a template, or for resizing if template_name is None.
+
+        settings.RESIZE_TEMPLATE_BACKENDS: Backend name per template name.
+
+        settings.RESIZE_BACKEND: Backend for resizing and all other templates. (Default 'imagemagick')
+
+    """
+    default = getattr(settings, 'RESIZE_BACKEND', 'imagemagick')
+    if template_name is None:
+        return default
+    return getattr(settings, 'RESIZE_TEMPLATE_BACKENDS', {}).get(template_name, default)
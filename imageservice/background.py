@@ -0,0 +1,227 @@
+from __future__ import with_statement
+
+import os
+import time
+import Queue
+import tempfile
+import threading
+
+from django.conf import settings
+from django.utils.hashcompat import md5_constructor
+from django.utils import simplejson as json
+from imageservice import admission, metrics
+
+def miss_policy():
+    """ Returns settings.RESIZE_MISS_POLICY, what a request for an image that is not cached yet gets:
+
+        'render' (default): The image is rendered while the request waits.
+
+        'redirect': A redirect to the source image, while the image is rendered in the background.
+
+        'placeholder': settings.RESIZE_PLACEHOLDER_IMAGE (or a transparent pixel), while the image is
+        rendered in the background.
+
+        'accepted': 202 Accepted, while the image is rendered in the background.
+    """
+    return getattr(settings, 'RESIZE_MISS_POLICY', 'render')
+
+def enqueue(task):
+    """ Renders the image of task in the background. A task is a tuple, see run_task.
+
+        settings.RESIZE_BACKGROUND_QUEUE decides how: 'thread' (default) renders in
+        settings.RESIZE_BACKGROUND_THREADS threads (default 2) of this process, 'file' writes the task to
+        settings.RESIZE_BACKGROUND_QUEUE_DIR for the render_queued_images command.
+    """
+    if getattr(settings, 'RESIZE_BACKGROUND_QUEUE', 'thread') == 'file':
+        FileQueue(queue_dir()).put(task)
+    else:
+        _thread_queue().put(task)
+    metrics.incr('background_enqueued')
+
+def run_task(task):
+    """ Renders the image of a task:
+
+        ('resize', src, target, width, height): See imagemagick.resize.
+
+        ('execute', command, src, target, backend, label, flatten): See imagemagick.execute.
+        
+        ('stages', stages, src, target, backend, label, flatten): See imagemagick.execute_stages.
+    """
+    from imageservice import imagemagick
+    if task[0] == 'resize':
+        (_, src, target, width, height) = task
+        imagemagick.resize(src, target, width, height)
+    elif task[0] == 'execute':
+        (_, command, src, target, backend, label, flatten) = task
+        imagemagick.execute(command, src, target, backend, label=label, flatten=flatten)
+    elif task[0] == 'stages':
+        (_, stages, src, target, backend, label, flatten) = task
+        imagemagick.execute_stages(list(stages), src, target, backend, label=label, flatten=flatten)
+    else:
+        raise ValueError("Unknown task: %r" % (task,))
+
+def task_target(task):
+    return task[2] if task[0] == 'resize' else task[3]
+
+def render_now(task):
+    """ Runs task while the request waits (see run_task) and forgets an earlier failure of its target in the
+        background, so that later requests are served by the miss policy again.
+    """
+    run_task(task)
+    target = task_target(task)
+    with _failed_guard:
+        _failed.discard(target)
+    if getattr(settings, 'RESIZE_BACKGROUND_QUEUE', 'thread') == 'file':
+        FileQueue(queue_dir()).forget_failure(target)
+
+def run_safely(task):
+    """ Runs task and remembers its target as failed, instead of raising, if it fails. Returns True on success,
+        False on failure and None if no render slot was free (see admission.RendererBusy). That is no failure
+        of the image, which is queued again by the next request for it.
+    """
+    try:
+        run_task(task)
+        return True
+    except admission.RendererBusy:
+        metrics.incr('background_busy')
+        return None
+    except Exception:
+        metrics.incr('background_errors')
+        with _failed_guard:
+            if len(_failed) >= MAX_FAILED:
+                _failed.clear()
+            _failed.add(task_target(task))
+        return False
+
+def failed(target):
+    """ Whether rendering target in the background has failed, in this process or, with the 'file' queue, in
+        the render_queued_images command. Such images are rendered while the request waits, so that the request
+        gets the usual error handling and fallbacks.
+    """
+    if target in _failed:
+        return True
+    return getattr(settings, 'RESIZE_BACKGROUND_QUEUE', 'thread') == 'file' and FileQueue(queue_dir()).failed(target)
+
+MAX_FAILED = 10000
+_failed = set()
+_failed_guard = threading.Lock()
+
+def queue_dir():
+    return getattr(settings, 'RESIZE_BACKGROUND_QUEUE_DIR', None) or os.path.join(tempfile.gettempdir(), 'imageservice-queue')
+
+class ThreadQueue(object):
+    """ Renders tasks in daemon threads. A target that is queued or being rendered is not queued again. """
+
+    def __init__(self, threads):
+        self.queue = Queue.Queue()
+        self.pending = set()
+        self._guard = threading.Lock()
+        for _ in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+
+    def put(self, task):
+        with self._guard:
+            if task_target(task) in self.pending:
+                return
+            self.pending.add(task_target(task))
+        self.queue.put(task)
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                run_safely(task)
+            finally:
+                with self._guard:
+                    self.pending.discard(task_target(task))
+
+def _thread_queue():
+    global _queue, _queue_pid
+    # Threads started before a fork do not exist in the child process
+    if _queue is None or _queue_pid != os.getpid():
+        with _queue_guard:
+            if _queue is None or _queue_pid != os.getpid():
+                _queue = ThreadQueue(getattr(settings, 'RESIZE_BACKGROUND_THREADS', 2))
+                _queue_pid = os.getpid()
+    return _queue
+
+_queue = None
+_queue_pid = None
+_queue_guard = threading.Lock()
+
+class FileQueue(object):
+    """ Tasks stored as files in a directory, one per target, so that a target is queued at most once. """
+
+    def __init__(self, dir):
+        self.dir = dir
+
+    def put(self, task):
+        if not os.path.isdir(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError:
+                pass # Created by another process
+        (fd, temp) = tempfile.mkstemp(dir=self.dir, prefix='.tmp-')
+        try:
+            os.write(fd, json.dumps(task))
+        finally:
+            os.close(fd)
+        os.rename(temp, self._path(task_target(task), '.task'))
+
+    def failed(self, target):
+        """ Whether rendering target failed when the queue was drained. """
+        return os.path.isfile(self._path(target, '.failed'))
+
+    def forget_failure(self, target):
+        try:
+            os.remove(self._path(target, '.failed'))
+        except OSError:
+            pass
+
+    def _path(self, target, extension):
+        return os.path.join(self.dir, md5_constructor(target).hexdigest() + extension)
+
+    def claim(self):
+        """ Returns the oldest task and removes it from the queue, or None if the queue is empty. """
+        try:
+            files = [file for file in os.listdir(self.dir) if file.endswith('.task')]
+        except OSError:
+            return None
+        for file in sorted(files, key=lambda file: _mtime(os.path.join(self.dir, file))):
+            claimed = os.path.join(self.dir, file[:-len('.task')] + '.%d.working' % os.getpid())
+            try:
+                os.rename(os.path.join(self.dir, file), claimed)
+            except OSError:
+                continue # Claimed by another process
+            f = open(claimed)
+            try:
+                return tuple(json.load(f))
+            finally:
+                f.close()
+                os.remove(claimed)
+        return None
+
+    def drain(self):
+        """ Runs all queued tasks. Returns the number of tasks run and failed. Failed targets are marked with
+            a file in the queue directory, so that the web processes render them while the request waits.
+        """
+        (done, failures) = (0, 0)
+        while True:
+            task = self.claim()
+            if task is None:
+                return (done, failures)
+            done += 1
+            result = run_safely(task)
+            if result:
+                self.forget_failure(task_target(task))
+            elif result is not None:
+                failures += 1
+                open(self._path(task_target(task), '.failed'), 'w').close()
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return time.time()
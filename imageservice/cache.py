@@ -0,0 +1,47 @@
+import os
+
+from django.conf import settings
+
+from imageservice import cacheindex, hotcache, imagemagick, paths, storage
+
+def invalidate(source):
+    """ Removes all cached images derived from a source image, for example after it has been replaced.
+        The images are rendered again on their next request. Returns the paths of the removed images.
+        
+        Rendered images are removed from the shared storage too, and a source fetched from the source 
+        storage is fetched again on its next use.
+
+        source: Path of the source image relative to MEDIA_ROOT. The extension may be left out.
+
+    """
+    source_file = "%s/%s" % (settings.MEDIA_ROOT, source)
+    try:
+        source_file = imagemagick._findAndVerifySource(source_file)
+    except IOError:
+        pass # A deleted source still has derivatives to remove
+
+    paths = set(_mirrored_derivatives(source))
+    index = cacheindex.get_index()
+    if index is not None:
+        paths.update(index.derivatives(source_file))
+    paths.discard(source_file)
+    paths.update(storage.remove_renders(source))
+    storage.unstage_source(source_file)
+
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        hotcache.discard(path)
+        if index is not None:
+            index.remove(path)
+    return sorted(paths)
+
+def _mirrored_derivatives(source):
+    (dir, prefix) = os.path.split(paths.derivatives_prefix(source))
+    try:
+        files = os.listdir(dir)
+    except OSError:
+        return []
+    return [os.path.join(dir, file) for file in files if file.startswith(prefix) and not file.endswith('.lock')]
@@ -0,0 +1,173 @@
+from __future__ import with_statement
+
+import os
+import re
+import time
+import sqlite3
+import threading
+
+from django.conf import settings
+from imageservice import hotcache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    source TEXT,
+    fingerprint TEXT,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE INDEX IF NOT EXISTS entries_source ON entries (source);
+"""
+
+ORDER_BY = {
+    'lru': 'last_access',
+    'lfu': 'hits, last_access',
+}
+
+def get_index():
+    """ Returns the index of cached images, or None if settings.RESIZE_CACHE_INDEX (the path of the index
+        database) is not set.
+    """
+    global _index
+    path = getattr(settings, 'RESIZE_CACHE_INDEX', None)
+    if not path:
+        return None
+    if _index is None or _index.path != path:
+        _index = CacheIndex(path, getattr(settings, 'RESIZE_CACHE_INDEX_TOUCH_INTERVAL', 60))
+    return _index
+
+_index = None
+
+class CacheIndex(object):
+    """ Keeps size, source, last access and number of hits of every cached image in a sqlite database,
+        so that the cache can be trimmed without walking MEDIA_CACHE_ROOT.
+
+        path: Full path of the database file. (Created if it does not exist)
+
+        touch_interval: Accesses to an image are collected in memory and written at most once every
+        touch_interval seconds.
+
+    """
+
+    def __init__(self, path, touch_interval=60):
+        self.path = path
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+        self._pending = {}
+        self._pending_guard = threading.Lock()
+
+    def add(self, path, source, fingerprint=None):
+        now = time.time()
+        self._execute("INSERT OR REPLACE INTO entries (path, source, fingerprint, size, created, last_access, hits) VALUES (?, ?, ?, ?, ?, ?, 0)",
+                      (path, source, fingerprint, os.path.getsize(path), now, now))
+
+    def fingerprint(self, path):
+        """ Returns the fingerprint of the source the image was rendered from, or None if unknown. """
+        row = self._connection().execute("SELECT fingerprint FROM entries WHERE path = ?", (path,)).fetchone()
+        return row and row[0]
+
+    def derivatives(self, source):
+        """ Returns the paths of all images rendered from source. """
+        return [path for (path,) in self._connection().execute("SELECT path FROM entries WHERE source = ?", (source,))]
+
+    def touch(self, path):
+        now = time.time()
+        with self._pending_guard:
+            (hits, last_write) = self._pending.get(path, (0, 0))
+            if now - last_write < self.touch_interval:
+                self._pending[path] = (hits + 1, last_write)
+                return
+            if len(self._pending) > 10000:
+                self._pending.clear()
+            self._pending[path] = (0, now)
+        self._execute("UPDATE entries SET last_access = ?, hits = hits + ? WHERE path = ?", (now, hits + 1, path))
+
+    def remove(self, path):
+        self._execute("DELETE FROM entries WHERE path = ?", (path,))
+
+    def move(self, path, new_path):
+        """ Records that the image path has been moved to new_path. """
+        self._execute("DELETE FROM entries WHERE path = ?", (new_path,))
+        self._execute("UPDATE entries SET path = ? WHERE path = ?", (new_path, path))
+
+    def totals(self):
+        """ Returns number of images and their total size in bytes. """
+        (count, size) = self._connection().execute("SELECT COUNT(*), SUM(size) FROM entries").fetchone()
+        return (count, size or 0)
+
+    def evict(self, max_bytes=None, max_files=None, policy='lru', grace=300):
+        """ Removes least recently (lru) or least frequently (lfu) used images until the cache holds at most
+            max_bytes bytes and max_files images. Images accessed during the last grace seconds are kept
+            since they may still be being served. Returns the evicted paths.
+        """
+        (count, size) = self.totals()
+        evicted = []
+        if not self._over_budget(count, size, max_bytes, max_files):
+            return evicted
+
+        candidates = self._connection().execute(
+            "SELECT path, size, last_access FROM entries WHERE last_access < ? ORDER BY " + ORDER_BY[policy],
+            (time.time() - grace,)).fetchall()
+
+        for (path, entry_size, last_access) in candidates:
+            if not self._over_budget(count, size, max_bytes, max_files):
+                break
+            # Only evict the entry if nobody accessed or rendered it since we looked
+            if self._execute("DELETE FROM entries WHERE path = ? AND last_access = ?", (path, last_access)) != 1:
+                continue
+            _remove_file(path)
+            evicted.append(path)
+            count -= 1
+            size -= entry_size
+        return evicted
+
+    def rebuild(self, cache_root):
+        """ Replaces the index with the images found below cache_root. """
+        with self._connection() as connection:
+            connection.execute("DELETE FROM entries")
+            for path in cached_files(cache_root):
+                if path.startswith(self.path):
+                    continue # The index itself and its journal
+                stat = os.stat(path)
+                connection.execute("INSERT INTO entries (path, source, size, created, last_access, hits) VALUES (?, NULL, ?, ?, ?, 0)",
+                                   (path, stat.st_size, stat.st_mtime, stat.st_mtime))
+
+    def _over_budget(self, count, size, max_bytes, max_files):
+        return (max_bytes is not None and size > max_bytes) or (max_files is not None and count > max_files)
+
+    def _execute(self, sql, parameters):
+        with self._connection() as connection:
+            return connection.execute(sql, parameters).rowcount
+
+    def _connection(self):
+        # sqlite connections can be used neither from other threads nor after a fork
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = sqlite3.connect(self.path, timeout=30)
+            self._local.connection.executescript(SCHEMA)
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+def cached_files(cache_root):
+    """ Yields the full path of every cached image below cache_root. """
+    for (dir, dirs, files) in os.walk(cache_root):
+        for file in files:
+            if not file.endswith('.lock') and not file.startswith('.tmp-'):
+                yield os.path.join(dir, file)
+
+def parse_size(size):
+    """ Parses a number of bytes with an optional K, M or G suffix, for example '512M'. """
+    match = re.match(r'^(\d+)([KMG]?)B?$', str(size).strip().upper())
+    if not match:
+        raise ValueError("Invalid size: %s" % size)
+    return int(match.group(1)) * 1024 ** ' KMG'.index(match.group(2) or ' ')
+
+def _remove_file(path):
+    hotcache.discard(path)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
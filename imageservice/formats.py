@@ -0,0 +1,112 @@
+import os
+import time
+
+from django.conf import settings
+
+# Formats that can be negotiated with the Accept header, by file extension
+VARIANTS = {
+    'avif': 'image/avif',
+    'webp': 'image/webp',
+}
+
+def negotiation_enabled():
+    return bool(getattr(settings, 'RESIZE_NEGOTIATE_FORMATS', ()))
+
+def negotiate(request, target):
+    """ Returns the file name of the best format variant of target that the client accepts, for example
+        'photo.100x100.png.webp', or None if the client should get target itself. See variants.
+    """
+    candidates = variants(request, target)
+    return candidates and candidates[0] or None
+
+def variants(request, target):
+    """ Returns the file names of the format variants of target that the client accepts, best first.
+
+        Variants are tried in the order of settings.RESIZE_NEGOTIATE_FORMATS, for example ('avif', 'webp'),
+        and only if the Accept header lists their mimetype explicitly (wildcards do not count). Formats
+        that failed to render recently (see record_failure) are left out.
+    """
+    if request is None or not negotiation_enabled():
+        return []
+    accepted = accepted_types(request.META.get('HTTP_ACCEPT', ''))
+    extension = os.path.splitext(target)[1].lstrip('.').lower()
+    candidates = []
+    for variant in getattr(settings, 'RESIZE_NEGOTIATE_FORMATS', ()):
+        if variant == extension:
+            break
+        if VARIANTS.get(variant) in accepted and not failed(variant):
+            candidates.append('%s.%s' % (target, variant))
+    return candidates
+
+def record_failure(variant):
+    """ Leaves the format of a variant file name, for example 'photo.png.avif', out of negotiation for
+        settings.RESIZE_FORMAT_RETRY_INTERVAL seconds (default 300), so that an encoder imagemagick lacks
+        is not run again on every request.
+    """
+    _failures[variant.split('.')[-1]] = time.time()
+
+def failed(format):
+    """ Whether rendering format failed within settings.RESIZE_FORMAT_RETRY_INTERVAL seconds. """
+    failure = _failures.get(format)
+    if failure is None:
+        return False
+    if time.time() - failure >= getattr(settings, 'RESIZE_FORMAT_RETRY_INTERVAL', 300):
+        _failures.pop(format, None)
+        return False
+    return True
+
+# Format extension -> time of its last failure
+_failures = {}
+
+def accepted_types(accept):
+    """ Returns the set of mimetypes in an Accept header whose quality is above 0. """
+    types = set()
+    for entry in accept.split(','):
+        parts = [part.strip() for part in entry.split(';')]
+        quality = 1.0
+        for parameter in parts[1:]:
+            if parameter.startswith('q='):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    quality = 0.0
+        if parts[0] and quality > 0:
+            types.add(parts[0].lower())
+    return types
+
+def output_command(command, target):
+    """ Appends the encoder options of target's format to an imagemagick command. """
+    args = output_args(os.path.splitext(target)[1].lstrip('.').lower())
+    if not args:
+        return command
+    return '  '.join([command] + args)
+
+def output_args(extension):
+    """ Returns the imagemagick arguments for settings.RESIZE_FORMAT_OPTIONS, a dict of format extension and
+        options, for example {'webp': {'quality': 75, 'strip': True}, 'jpg': {'quality': 85, 'interlace': True}}.
+
+        quality: Encoder quality, 1 to 100.
+
+        strip: Remove metadata (EXIF, comments, color profiles).
+
+        interlace: Progressive JPEGs, interlaced PNGs and GIFs.
+
+        defines: Dict of further encoder options, for example {'webp:method': 6}.
+    """
+    format_options = getattr(settings, 'RESIZE_FORMAT_OPTIONS', {})
+    options = format_options.get(extension)
+    if options is None and extension == 'jpeg':
+        options = format_options.get('jpg')
+    if not options:
+        return []
+
+    args = []
+    if options.get('strip'):
+        args.append('-strip')
+    if options.get('interlace'):
+        args += ['-interlace', 'Plane']
+    if options.get('quality') is not None:
+        args += ['-quality', str(options['quality'])]
+    for (name, value) in sorted(options.get('defines', {}).items()):
+        args += ['-define', '%s=%s' % (name, value)]
+    return args
@@ -0,0 +1,142 @@
+from __future__ import with_statement
+
+import time
+import threading
+
+from django.conf import settings
+
+def get_cache():
+    """ Returns the in-memory cache of small rendered images of this process, or None if
+        settings.RESIZE_HOT_CACHE_BYTES (total size, for example '64M') is not set.
+
+        Images larger than settings.RESIZE_HOT_CACHE_MAX_ENTRY_BYTES (default 20K) are not kept.
+        An entry is used without looking at the file for settings.RESIZE_HOT_CACHE_TTL seconds
+        (default 60) and compared with the file afterwards.
+    """
+    global _cache
+    max_bytes = getattr(settings, 'RESIZE_HOT_CACHE_BYTES', None)
+    if not max_bytes:
+        return None
+    if _cache is None or _cache.settings != (max_bytes, _max_entry_bytes(), _ttl()):
+        with _cache_guard:
+            if _cache is None or _cache.settings != (max_bytes, _max_entry_bytes(), _ttl()):
+                _cache = HotCache(max_bytes, _max_entry_bytes(), _ttl())
+    return _cache
+
+def discard(path):
+    """ Removes the image path from the in-memory cache, if there is one. """
+    cache = get_cache()
+    if cache is not None:
+        cache.discard(path)
+
+def _max_entry_bytes():
+    return getattr(settings, 'RESIZE_HOT_CACHE_MAX_ENTRY_BYTES', '20K')
+
+def _ttl():
+    return getattr(settings, 'RESIZE_HOT_CACHE_TTL', 60)
+
+_cache = None
+_cache_guard = threading.Lock()
+
+class Entry(object):
+    """ The bytes of an image file and the file's validators. """
+
+    def __init__(self, path, data, stat):
+        self.path = path
+        self.data = data
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.ino = stat.st_ino
+        self.checked = self.touched = time.time()
+        self.previous = self.next = None
+
+    def matches(self, stat):
+        return (self.mtime, self.size, self.ino) == (stat.st_mtime, stat.st_size, stat.st_ino)
+
+class HotCache(object):
+    """ Least recently used images of at most max_bytes bytes in total. """
+
+    def __init__(self, max_bytes, max_entry_bytes, ttl):
+        from imageservice.cacheindex import parse_size
+        self.settings = (max_bytes, max_entry_bytes, ttl)
+        self.max_bytes = parse_size(max_bytes)
+        self.max_entry_bytes = parse_size(max_entry_bytes)
+        self.ttl = ttl
+        self.bytes = 0
+        self.entries = {}
+        self._head = self._tail = None # Most and least recently used entry
+        self._guard = threading.Lock()
+
+    def fresh(self, path):
+        """ Returns the entry of path if it was compared with the file less than ttl seconds ago,
+            without touching the file system. Returns None otherwise.
+        """
+        with self._guard:
+            entry = self.entries.get(path)
+            if entry is None or time.time() - entry.checked > self.ttl:
+                return None
+            self._use(entry)
+            return entry
+
+    def get(self, path, stat):
+        """ Returns the entry of path if it still matches the file's stat, None otherwise. """
+        with self._guard:
+            entry = self.entries.get(path)
+            if entry is None:
+                return None
+            if not entry.matches(stat):
+                self._remove(entry)
+                return None
+            entry.checked = time.time()
+            self._use(entry)
+            return entry
+
+    def accepts(self, size):
+        return size <= self.max_entry_bytes and size <= self.max_bytes
+
+    def put(self, path, data, stat):
+        """ Keeps the bytes of the image file path, unless they are too large. Returns the entry or None. """
+        if not self.accepts(len(data)):
+            return None
+        entry = Entry(path, data, stat)
+        with self._guard:
+            if path in self.entries:
+                self._remove(self.entries[path])
+            self.entries[path] = entry
+            self.bytes += len(data)
+            self._use(entry)
+            while self.bytes > self.max_bytes:
+                self._remove(self._tail)
+        return entry
+
+    def discard(self, path):
+        with self._guard:
+            if path in self.entries:
+                self._remove(self.entries[path])
+
+    def _use(self, entry):
+        if self._head is entry:
+            return
+        self._unlink(entry)
+        entry.next = self._head
+        if self._head is not None:
+            self._head.previous = entry
+        self._head = entry
+        if self._tail is None:
+            self._tail = entry
+
+    def _unlink(self, entry):
+        if entry.previous is not None:
+            entry.previous.next = entry.next
+        if entry.next is not None:
+            entry.next.previous = entry.previous
+        if self._head is entry:
+            self._head = entry.next
+        if self._tail is entry:
+            self._tail = entry.previous
+        entry.previous = entry.next = None
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self.entries[entry.path]
+        self.bytes -= len(entry.data)
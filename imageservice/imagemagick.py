@@ -7,8 +7,10 @@ import shutil
 import re
 
 from contextlib import contextmanager
+from django.conf import settings
+from imageservice import admission, animation, backends, cacheindex, formats, hotcache, locks, metadata, metrics, paths, probe, renditions, sourceindex, storage, tracing, workerpool
 
-def resize(src, target, width, height):
+def resize(src, target, width, height, backend=None):
     """ Resizes a source image to given dimensions and stores the resized image as target
     
         src: Full path to image to be resized.
@@ -18,22 +20,275 @@ def resize(src, target, width, height):
         width: Width of the resized image.
         
         height: Height of the resized image.
+        
+        backend: Name of the imaging backend to use. (Defaults to settings.RESIZE_BACKEND)
+        
+        If settings.RESIZE_RENDITION_LEVELS is set, the image is derived from a trimmed intermediate image 
+        instead of src (see _renditionSource).
+        
+        Animated GIF sources are resized frame by frame to GIF targets (see animation.animates), without 
+        trimming and without intermediate images, unless settings.RESIZE_FLATTEN_ANIMATIONS contains 'resize'.
     
     """
-    command = '-trim  -resize  %dx%d>  -size  %dx%d  xc:white  +swap  -gravity  center  -composite' % (width, height, width, height)
+    if _isCached(src, target):
+        execute(resize_command(width, height), src, target, backend, metrics.size_bucket(width, height))
+        return
+    if animates(src, target, animation.flattened('resize')):
+        execute(animation.resize_command(width, height), src, target, backend, metrics.size_bucket(width, height))
+        return
+    (rendition, trimmed) = _renditionSource(src, width, height, backend)
+    execute(resize_command(width, height, not trimmed), rendition, target, backend, metrics.size_bucket(width, height), flatten=True, origin=src);
+
+def resize_command(width, height, trim=True):
+    """ Returns the imagemagick command used by resize. """
+    command = '-resize  %dx%d>  -size  %dx%d  xc:white  +swap  -gravity  center  -composite' % (width, height, width, height)
+    if trim:
+        return '-trim  ' + command
+    return command
+
+def _renditionSource(src, width, height, backend):
+    """ Returns the image to derive a width x height image of src from and whether it is trimmed already.
+    
+        That is the intermediate of the smallest level in settings.RESIZE_RENDITION_LEVELS, for example 
+        (256, 512, 1024, 2048), that the image fits into. A missing intermediate is rendered from the 
+        nearest larger intermediate that is cached, or from src. Decoding a small intermediate instead 
+        of a large source saves time and memory for every size.
     
-    execute(command, src, target);
+    """
+    level = renditions.level_for(width, height)
+    root = settings.MEDIA_ROOT.rstrip('/') + '/'
+    if level is None or not src.startswith(root):
+        return (src, False)
+    
+    src = _findAndVerifySource(src)
+    (name, extension) = os.path.splitext(src[len(root):])
+    (source, trimmed) = (src, False)
+    index = cacheindex.get_index()
+    for larger in [larger for larger in renditions.levels() if larger > level]:
+        if _isFresh(src, paths.rendition_file(name, larger, extension), index):
+            (source, trimmed) = (paths.rendition_file(name, larger, extension), True)
+            break
     
-def execute(command, src, target):
-    if os.path.isfile(target):
+    rendition = paths.rendition_file(name, level, extension)
+    command = '-resize  %dx%d>' % (level, level)
+    if not trimmed:
+        command = '-trim  ' + command
+    execute(command, source, rendition, backend, 'rendition', flatten=True, origin=src)
+    return (rendition, True)
+
+def execute_stages(stages, src, target, backend=None, label=None, flatten=False):
+    """ Renders a template pipeline, a list of imagemagick commands (see template_repository.Template.stages), 
+        from src to target like execute.
+        
+        The result of the first stage is cached as an intermediate image (see paths.stage_file) that the other 
+        stages are rendered from. Pipelines starting with the same command, for example a costly trim or 
+        colorspace conversion, share that intermediate image.
+    
+    """
+    root = settings.MEDIA_ROOT.rstrip('/') + '/'
+    if _isCached(src, target) or len(stages) < 2 or not src.startswith(root):
+        execute('  '.join(stages), src, target, backend, label, flatten)
         return
+    
+    src = _findAndVerifySource(src)
+    (name, extension) = os.path.splitext(src[len(root):])
+    intermediate = paths.stage_file(name, stages[0], extension)
+    execute(stages[0], src, intermediate, backend, 'stage', flatten)
+    execute('  '.join(stages[1:]), intermediate, target, backend, label, flatten, origin=src)
+
+def _isCached(src, target):
+    """ Whether target is fresh, so that execute serves it without rendering intermediate images first. """
+    if not os.path.isfile(target):
+        return False
+    if not _checkSource():
+        return True
+    try:
+        return _isFresh(_findAndVerifySource(src), target, cacheindex.get_index())
+    except IOError:
+        return False # Reported by execute
+
+def animates(src, target, flatten):
+    """ Whether target is rendered frame by frame from src, see animation.animates. Looks up src for GIF targets only. """
+    if flatten or not target.lower().endswith('.gif'):
+        return False
+    try:
+        return animation.animates(_findAndVerifySource(src), target)
+    except IOError:
+        return False # Reported by execute
+    
+def execute(command, src, target, backend=None, label=None, flatten=False, origin=None):
+    """ Runs an imagemagick command on src and stores the result as target, unless target already exists.
+    
+        Concurrent calls for the same target are coalesced: the first caller renders while the
+        others wait (at most settings.RESIZE_LOCK_TIMEOUT seconds) and then reuse the result.
+        A caller that gives up waiting renders the image itself.
+        
+        If settings.RESIZE_CHECK_SOURCE is True, an existing target is rendered again when src has
+        changed since target was rendered.
+        
+        Rendered images and accesses to them are recorded in the cache index, if one is configured.
+        
+        The image is rendered by the named backend (default settings.RESIZE_BACKEND), or by 
+        imagemagick if the backend does not support the command. Renders wait for a free render slot
+        (see admission.render_slot) and may raise admission.RendererBusy.
+        
+        label names the kind of image (a template name or size bucket) in the metrics of the render.
+        
+        The encoder options of target's format (see formats.output_args) are appended to the command.
+        
+        If a shared storage is configured (see storage.shared_storage), a missing target is fetched from 
+        there when another host has rendered it already, and rendered images are published there. 
+        Sources missing in MEDIA_ROOT are fetched from the source storage (see storage.source_storage).
+        
+        Animated GIF sources are rendered frame by frame to GIF targets (see animation.command), unless 
+        flatten is True or the animation is too large (see animation.animates). Otherwise only their
+        first frame is read.
+        
+        origin is the source image that src was rendered from, if src is an intermediate image. The 
+        freshness of target is then checked against origin, and target is recorded in the cache index as
+        derived from origin.
+    
+    """
+    command = formats.output_command(command, target)
+    index = cacheindex.get_index()
+    with tracing.phase('lookup'):
+        cached = os.path.isfile(target) and not _checkSource()
+    if cached:
+        _touch(index, target)
+        metrics.incr('cache', result='hit')
+        return
+    with tracing.phase('shared'):
+        fetched = not _checkSource() and storage.fetch_render(target)
+    if fetched:
+        metrics.incr('cache', result='shared')
+        if index is not None:
+            index.add(target, origin or src)
+        return
+    try:
+        with tracing.phase('source'):
+            with metrics.timer('source_resolution_seconds'):
+                src = _findAndVerifySource(src)
+                origin = origin and _findAndVerifySource(origin) or src
+    except IOError:
+        metrics.incr('cache', result='missing')
+        raise
+    with tracing.phase('lookup'):
+        fresh = _isFresh(origin, target, index)
+    if fresh:
+        _touch(index, target)
+        metrics.incr('cache', result='hit')
+        return
+    metrics.incr('cache', result=os.path.isfile(target) and 'stale' or 'miss')
+    _checkPixelBudget(src)
+    if animation.animates(src, target, flatten):
+        command = animation.command(command)
+    with tracing.phase('prepare'):
+        _prepareTargetFolder(target)
+    
+    backend = backend or backends.backend_name()
+    try:
+        with locks.render_lock(target, _lock_timeout()):
+            if _isFresh(origin, target, index):
+                return
+            _render(command, src, target, backend, label)
+    except locks.LockTimeout:
+        if _isFresh(origin, target, index):
+            return
+        _render(command, src, target, backend, label)
+    
+    hotcache.discard(target)
+    _publish(target)
+    _recordMetadata(origin)
+    if index is not None:
+        index.add(target, origin, source_fingerprint(origin))
+
+def execute_batch(jobs, src):
+    """ Renders several images from one source with a single imagemagick process, decoding the source once.
+        Targets that already exist are skipped. Returns the targets that were rendered.
+        
+        jobs: List of (command, target) tuples.
+    
+    """
+    index = cacheindex.get_index()
     src = _findAndVerifySource(src)
-    _prepareTargetFolder(target)        
-    _callImageMagick(command, src, target);
+    jobs = [(command, target) for (command, target) in jobs if not _isFresh(src, target, index)]
+    if not jobs:
+        return []
+    _checkPixelBudget(src)
+    
+    for (_, target) in jobs:
+        _prepareTargetFolder(target)
+    
+    jobs = [(formats.output_command(command, target), target) for (command, target) in jobs]
+    targets = [target for (_, target) in jobs]
+    with _temp_files(targets) as tmp_targets:
+        # Parentheses only scope the image list unless settings like -gravity are scoped too
+        args = ['convert', '-respect-parentheses', animation.input_file(src, [])]
+        for ((command, _), tmp_target) in zip(jobs, tmp_targets):
+            args += ['(', '+clone'] + command.split('  ') + ['-write', tmp_target, '+delete', ')']
+        args.append('null:')
+        subprocess.check_call(args)
+    
+    for target in targets:
+        shutil.copymode(src, target)
+        _publish(target)
+        if index is not None:
+            index.add(target, src, source_fingerprint(src))
+    _recordMetadata(src)
+    return targets
+
+def source_fingerprint(src):
+    """ Returns a string that changes whenever src is modified or replaced. """
+    stat = os.stat(src)
+    return "%r-%d-%d" % (stat.st_mtime, stat.st_size, stat.st_ino)
+
+def _checkPixelBudget(src):
+    try:
+        probe.check_pixel_budget(src)
+    except probe.SourceTooLarge:
+        metrics.incr('rejected_sources')
+        raise
+
+def _recordMetadata(src):
+    try:
+        metadata.record_source(src)
+    except Exception:
+        metrics.incr('metadata_errors') # Only needed for rendering pages
+
+def _publish(target):
+    try:
+        with tracing.phase('publish'):
+            storage.publish_render(target)
+    except Exception:
+        metrics.incr('publish_errors') # The image is served from the local cache anyway
+
+def _checkSource():
+    return getattr(settings, 'RESIZE_CHECK_SOURCE', False)
+
+def _isFresh(src, target, index):
+    if not os.path.isfile(target):
+        return False
+    if not _checkSource():
+        return True
+    
+    fingerprint = index and index.fingerprint(target)
+    if fingerprint:
+        return fingerprint == source_fingerprint(src)
+    
+    # Without a recorded fingerprint, compare timestamps. Replacing a file changes its ctime.
+    source_stat = os.stat(src)
+    return max(source_stat.st_mtime, source_stat.st_ctime) <= os.path.getmtime(target)
+
+def _touch(index, target):
+    if index is not None:
+        index.touch(target)
+
+def _lock_timeout():
+    return getattr(settings, 'RESIZE_LOCK_TIMEOUT', 30)
     
 def _findAndVerifySource(src):
     if (_hasExtension(src)):
-        if not os.path.isfile(src):
+        if _firstExistingSource([src]) is None:
             raise IOError("Source image not found: %s." % src)
         return src
     else:
@@ -49,14 +304,24 @@ def _guessAndAppendExtension(srcWithoutExtension):
         yield extension
         yield extension.upper()        
 
-    for extension in exts:
-        for ext in allcases(extension):
-            file = srcWithoutExtension + ext
+    candidates = [srcWithoutExtension + ext for extension in exts for ext in allcases(extension)]
+    file = _firstExistingSource(candidates)
+    if file is not None:
+        return file
         
+    raise IOError("Source image not found: %s. Tried with following extensions: %s" %(srcWithoutExtension,", ".join(exts)) ) 
+
+def _firstExistingSource(files):
+    index = sourceindex.get_index()
+    if index is not None:
+        file = index.first_existing(files)
+        if file is not None:
+            return file
+    else:
+        for file in files:
             if (os.path.isfile(file)):
                 return file
-        
-    raise IOError("Source image not found: %s. Tried with following extensions: %s" %(srcWithoutExtension,", ".join(exts)) ) 
+    return storage.stage_source(files)
 
 def _prepareTargetFolder(target):
     (target_path, _) = os.path.split(target)
@@ -64,13 +329,49 @@ def _prepareTargetFolder(target):
     if not os.path.isdir(target_path):
         os.makedirs(target_path)
         
+def _render(command, src, target, backend, label=None):
+    with admission.render_slot():
+        try:
+            with metrics.timer('render_seconds', label=label, backend=backend):
+                _renderWithBackend(command, src, target, backend)
+        except Exception:
+            metrics.incr('render_errors', label=label, backend=backend)
+            raise
+
+def _renderWithBackend(command, src, target, backend):
+    if backend != 'imagemagick':
+        try:
+            _callBackend(backends.get_backend(backend), command, src, target)
+            return
+        except backends.UnsupportedCommand:
+            pass # Let imagemagick render what the backend can not
+    _callImageMagick(command, src, target)
+
+def _callBackend(backend, command, src, target):
+    with temp_file(target) as tmp_target:
+        backend.render(command, src, tmp_target)
+
+    shutil.copymode(src, target)
+
 def _callImageMagick(command, src, target):
+    args = command.split('  ')
     with temp_file(target) as tmp_target: 
-        args = ['convert', src] + command.split('  ')
-        args.append(tmp_target)
-        subprocess.check_call(args)
+        _runImageMagick(animation.input_file(src, args), args, tmp_target, probe.decode_hint(src, args))
 
     shutil.copymode(src, target)
+
+def _runImageMagick(src, args, target, input_args=()):
+    """ Renders src with the imagemagick arguments args to target. input_args are settings for reading src. """
+    pool = workerpool.get_pool()
+    if pool is not None:
+        try:
+            pool.run(src, args, target, input_args)
+            return
+        except workerpool.WorkerError:
+            pass # Fall back to a convert process of our own
+    
+    with tracing.phase('convert'):
+        subprocess.check_call(['convert'] + admission.imagemagick_limits() + list(input_args) + [src] + args + [target])
     
     
  
@@ -89,14 +390,47 @@ def temp_file(target):
     finally:
         _remove_tempfile(temp)   
 
+@contextmanager
+def _temp_files(targets):
+    """ Like temp_file, but for several targets. """
+    if not targets:
+        yield []
+        return
+    with temp_file(targets[0]) as first:
+        with _temp_files(targets[1:]) as rest:
+            yield [first] + rest
+
+TEMP_PREFIX = '.tmp-'
+
 def _create_tempfile_for_target(target):
-    (_, target_filename) = os.path.split(target)    
+    # In the target's directory, so that the temp file can be renamed to target without copying
+    (target_dir, target_filename) = os.path.split(target)    
     target_fileending = target_filename.split(".")[-1]
-    (_, temp_file) = tempfile.mkstemp(suffix="." + target_fileending)
+    (fd, temp_file) = tempfile.mkstemp(suffix="." + target_fileending, prefix=TEMP_PREFIX, dir=target_dir or '.')
+    os.close(fd)
     return temp_file
 
 def _replace_target_file_with_temp_file(temp_file, target):    
-    shutil.move(temp_file, target)
+    """ Atomically replaces target with temp_file. settings.RESIZE_CACHE_FSYNC decides what is flushed to disk first:
+        None (default) nothing, 'file' the image and 'directory' the image and the directory entry of target.
+    """
+    with tracing.phase('move'):
+        fsync = getattr(settings, 'RESIZE_CACHE_FSYNC', None)
+        if fsync in ('file', 'directory'):
+            _fsync(temp_file)
+        try:
+            os.rename(temp_file, target)
+        except OSError:
+            shutil.move(temp_file, target) # On another file system
+        if fsync == 'directory':
+            _fsync(os.path.dirname(target) or '.')
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
     
 def _remove_tempfile(temp_file):
     if temp_file and os.path.isfile(temp_file):
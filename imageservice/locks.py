@@ -0,0 +1,117 @@
+from __future__ import with_statement
+
+import os
+import time
+import threading
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+POLL_INTERVAL = 0.05
+
+class LockTimeout(IOError):
+    """ Raised when a lock could not be acquired within the given timeout. """
+    pass
+
+@contextmanager
+def render_lock(target, timeout):
+    """ Makes sure only one renderer at a time works on target.
+
+        Threads in this process are serialized with an in-memory lock and processes on
+        the same host with an exclusive lock on a lock file next to target. The lock file
+        is removed again when the lock is released.
+
+        target: Full path of the file to be rendered. (The folder must exist)
+
+        timeout: Maximum number of seconds to wait for the lock before LockTimeout is raised.
+
+    """
+    deadline = time.time() + timeout
+    thread_lock = _acquire_thread_lock(target, deadline)
+    try:
+        lock_file = _acquire_file_lock(target + '.lock', deadline)
+        try:
+            yield
+        finally:
+            _release_file_lock(lock_file)
+    finally:
+        _release_thread_lock(target, thread_lock)
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+def _acquire_thread_lock(key, deadline):
+    with _thread_locks_guard:
+        entry = _thread_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+
+    lock = entry[0]
+    while not lock.acquire(False):
+        if time.time() >= deadline:
+            _forget_thread_lock(key)
+            raise LockTimeout("Timed out waiting for lock on %s." % key)
+        time.sleep(POLL_INTERVAL)
+    return lock
+
+def _release_thread_lock(key, lock):
+    lock.release()
+    _forget_thread_lock(key)
+
+def _forget_thread_lock(key):
+    with _thread_locks_guard:
+        entry = _thread_locks[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _thread_locks[key]
+
+def try_lock_file(path):
+    """ Takes an exclusive lock on the file path without waiting. Returns the open lock file, 
+        to be passed to release_lock_file, or None if somebody else holds the lock.
+    """
+    while True:
+        lock_file = open(path, 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return None
+
+        # The previous holder may have removed the lock file after we opened it,
+        # in which case we hold a lock nobody else can see.
+        if _is_same_file(lock_file, path):
+            return lock_file
+        lock_file.close()
+
+def release_lock_file(lock_file):
+    """ Releases a lock taken with try_lock_file and removes the lock file. """
+    try:
+        os.remove(lock_file.name)
+    except OSError:
+        pass
+    lock_file.close()
+
+def _acquire_file_lock(path, deadline):
+    if fcntl is None:
+        return None
+
+    while True:
+        lock_file = try_lock_file(path)
+        if lock_file is not None:
+            return lock_file
+        if time.time() >= deadline:
+            raise LockTimeout("Timed out waiting for lock file %s." % path)
+        time.sleep(POLL_INTERVAL)
+
+def _is_same_file(opened_file, path):
+    try:
+        return os.path.samestat(os.fstat(opened_file.fileno()), os.stat(path))
+    except OSError:
+        return False
+
+def _release_file_lock(lock_file):
+    if lock_file is not None:
+        release_lock_file(lock_file)
@@ -0,0 +1,53 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from imageservice import cacheindex
+
+class Command(BaseCommand):
+    help = ("Removes the least recently or least frequently used images from MEDIA_CACHE_ROOT until the cache "
+            "fits within its budget. Requires RESIZE_CACHE_INDEX.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--max-bytes', dest='max_bytes',
+                    help='Maximum total size of the cache, for example 10G. Defaults to RESIZE_CACHE_MAX_BYTES.'),
+        make_option('--max-files', dest='max_files', type='int',
+                    help='Maximum number of cached images. Defaults to RESIZE_CACHE_MAX_FILES.'),
+        make_option('--policy', dest='policy', choices=sorted(cacheindex.ORDER_BY.keys()),
+                    help='Eviction policy, lru or lfu. Defaults to RESIZE_CACHE_POLICY or lru.'),
+        make_option('--grace', dest='grace', type='float',
+                    help='Keep images accessed during the last GRACE seconds. Defaults to RESIZE_CACHE_EVICT_GRACE or 300.'),
+        make_option('--interval', dest='interval', type='float',
+                    help='Keep running and sweep the cache every INTERVAL seconds.'),
+        make_option('--rebuild', dest='rebuild', action='store_true', default=False,
+                    help='Rebuild the index from the files in MEDIA_CACHE_ROOT before evicting.'),
+    )
+
+    def handle(self, *args, **options):
+        index = cacheindex.get_index()
+        if index is None:
+            raise CommandError("RESIZE_CACHE_INDEX is not configured.")
+
+        max_bytes = options.get('max_bytes') or getattr(settings, 'RESIZE_CACHE_MAX_BYTES', None)
+        max_files = options.get('max_files') or getattr(settings, 'RESIZE_CACHE_MAX_FILES', None)
+        policy = options.get('policy') or getattr(settings, 'RESIZE_CACHE_POLICY', 'lru')
+        grace = options.get('grace')
+        if grace is None:
+            grace = getattr(settings, 'RESIZE_CACHE_EVICT_GRACE', 300)
+        if max_bytes is not None:
+            max_bytes = cacheindex.parse_size(max_bytes)
+        if max_bytes is None and max_files is None:
+            raise CommandError("No budget given. Use --max-bytes or --max-files.")
+
+        if options.get('rebuild'):
+            index.rebuild(settings.MEDIA_CACHE_ROOT)
+
+        while True:
+            evicted = index.evict(max_bytes, max_files, policy, grace)
+            (count, size) = index.totals()
+            self.stdout.write("Evicted %d images, %d images (%d bytes) left.\n" % (len(evicted), count, size))
+            if not options.get('interval'):
+                break
+            time.sleep(options.get('interval'))
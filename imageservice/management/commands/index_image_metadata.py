@@ -0,0 +1,34 @@
+import sys
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from imageservice import metadata, paths
+from imageservice.management.commands.pregenerate_images import find_sources
+
+class Command(BaseCommand):
+    help = ("Records the size and trim box of source images in the metadata index, which the responsive_image "
+            "template tag reads. Requires RESIZE_METADATA_INDEX.")
+    args = "[<source path relative to MEDIA_ROOT> ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--no-trim', dest='trim', action='store_false', default=True,
+                    help='Only read the size from the header of each image instead of computing its trim box.'),
+    )
+
+    def handle(self, *sources, **options):
+        index = metadata.get_index()
+        if index is None:
+            raise CommandError("RESIZE_METADATA_INDEX is not configured.")
+
+        sources = sources or list(find_sources(settings.MEDIA_ROOT))
+        failed = 0
+        for source in sources:
+            try:
+                metadata.record_source(paths.source_file(source), options.get('trim', True))
+            except Exception, e:
+                failed += 1
+                sys.stderr.write("%s: %s\n" % (source, e))
+        index.save()
+        self.stdout.write("Indexed %d images, %d failed.\n" % (len(sources) - failed, failed))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from imageservice import cache
+
+class Command(BaseCommand):
+    help = "Removes all cached images derived from the given source images, leaving the rest of the cache untouched."
+    args = "<source path relative to MEDIA_ROOT> ..."
+
+    def handle(self, *sources, **options):
+        if not sources:
+            raise CommandError("Give at least one source image.")
+
+        for source in sources:
+            removed = cache.invalidate(source)
+            self.stdout.write("%s: removed %d cached images.\n" % (source, len(removed)))
@@ -0,0 +1,66 @@
+import os
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from imageservice import cacheindex, paths
+
+LAYOUTS = ('mirror', 'hashed')
+
+class Command(BaseCommand):
+    help = ("Moves the images in MEDIA_CACHE_ROOT to the directories of a cache layout, so that a changed "
+            "RESIZE_CACHE_LAYOUT does not start with an empty cache.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--layout', dest='layout', choices=LAYOUTS,
+                    help='Layout to move the images to, mirror or hashed. Defaults to RESIZE_CACHE_LAYOUT.'),
+        make_option('--dry-run', dest='dry_run', action='store_true', default=False,
+                    help='Only print the images that would be moved.'),
+    )
+
+    def handle(self, *args, **options):
+        layout = options.get('layout') or paths.cache_layout()
+        if layout not in LAYOUTS:
+            raise CommandError("Unknown cache layout: %s" % layout)
+
+        cache_root = settings.MEDIA_CACHE_ROOT.rstrip('/')
+        index = cacheindex.get_index()
+        moved = 0
+        for (path, new_path) in migrations(cache_root, layout, index and index.path):
+            if options.get('dry_run'):
+                self.stdout.write("%s -> %s\n" % (path, new_path))
+            else:
+                move(path, new_path)
+                if index is not None:
+                    index.move(path, new_path)
+            moved += 1
+        if not options.get('dry_run'):
+            remove_empty_directories(cache_root)
+        self.stdout.write("Moved %d images to the %s layout.\n" % (moved, layout))
+
+def migrations(cache_root, layout, index_path=None):
+    """ Yields (path, new path) of every cached image that is not stored according to layout. """
+    for path in list(cacheindex.cached_files(cache_root)):
+        if index_path and path.startswith(index_path):
+            continue # The index itself and its journal
+        relative = paths.unshard(path[len(cache_root) + 1:])
+        (name, suffix) = _split_name(relative)
+        new_path = paths.cache_file(name, suffix, layout)
+        if os.path.normpath(new_path) != os.path.normpath(path):
+            yield (path, new_path)
+
+def move(path, new_path):
+    (dir, _) = os.path.split(new_path)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    os.rename(path, new_path)
+
+def remove_empty_directories(cache_root):
+    for (dir, dirs, files) in os.walk(cache_root, topdown=False):
+        if dir != cache_root and not os.listdir(dir):
+            os.rmdir(dir)
+
+def _split_name(relative):
+    name = paths.source_name(relative)
+    return (name, relative[len(name):])
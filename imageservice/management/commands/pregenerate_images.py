@@ -0,0 +1,112 @@
+import os
+import re
+import functools
+import sys
+import multiprocessing
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from imageservice import animation, imagemagick, paths
+from imageservice.template_repository import TemplateRepository
+
+class Command(BaseCommand):
+    help = ("Renders sizes and templates of source images ahead of their first request. Every source is decoded "
+            "once for all of its images. Images that are already cached are skipped, so an interrupted run can "
+            "simply be started again.")
+    args = "[<source path relative to MEDIA_ROOT> ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='',
+                    help='Comma separated sizes to render, for example 100x100,200x150.'),
+        make_option('--templates', dest='templates', default='',
+                    help='Comma separated names of templates in imagemagick.templates to render.'),
+        make_option('--list', dest='list',
+                    help='File with one source path relative to MEDIA_ROOT per line. Without it and without '
+                         'source arguments, all images below MEDIA_ROOT are rendered.'),
+        make_option('--processes', dest='processes', type='int',
+                    help='Number of sources rendered in parallel. Defaults to the number of CPUs.'),
+    )
+
+    def handle(self, *sources, **options):
+        sizes = [_parse_size(size) for size in _split(options.get('sizes'))]
+        templates = TemplateRepository()
+        template_commands = [(name, templates.getTemplate(name)) for name in _split(options.get('templates'))]
+        if not sizes and not template_commands:
+            raise CommandError("Nothing to render. Use --sizes and/or --templates.")
+
+        if options.get('list'):
+            sources = [line.strip() for line in open(options['list']) if line.strip()]
+        elif not sources:
+            sources = list(find_sources(settings.MEDIA_ROOT))
+
+        tasks = [(source, sizes, template_commands) for source in sources]
+        pool = multiprocessing.Pool(options.get('processes') or multiprocessing.cpu_count())
+        try:
+            rendered = failed = 0
+            for (done, (source, result, error)) in enumerate(pool.imap_unordered(pregenerate, tasks)):
+                if error:
+                    failed += 1
+                    sys.stderr.write("%s: %s\n" % (source, error))
+                else:
+                    rendered += result
+                self.stdout.write("[%d/%d] %s: %d images rendered\n" % (done + 1, len(tasks), source, result))
+        finally:
+            pool.close()
+            pool.join()
+        self.stdout.write("Rendered %d images, %d sources failed.\n" % (rendered, failed))
+
+def pregenerate(task):
+    """ Renders all sizes and templates of one source. Runs in a pool process. Animated GIF targets are rendered
+        one by one, frame by frame like the views render them (see imagemagick.animates), the others in one batch.
+    """
+    (source, sizes, template_commands) = task
+    (name, extension) = _split_extension(source)
+    src = paths.source_file(name, extension)
+    (jobs, animations) = ([], [])
+    for (width, height) in sizes:
+        target = paths.resized_file(name, width, height, extension)
+        if imagemagick.animates(src, target, animation.flattened('resize')):
+            animations.append((target, functools.partial(imagemagick.resize, src, target, width, height)))
+        else:
+            jobs.append((imagemagick.resize_command(width, height), target))
+    for (template_name, command) in template_commands:
+        target = paths.template_file(name, template_name, extension)
+        if imagemagick.animates(src, target, animation.flattened(template_name)):
+            animations.append((target, functools.partial(imagemagick.execute, command, src, target)))
+        else:
+            jobs.append((command, target))
+    try:
+        rendered = len(imagemagick.execute_batch(jobs, src))
+        for (target, render) in animations:
+            if not os.path.isfile(target):
+                render()
+                rendered += 1
+        return (source, rendered, None)
+    except Exception, e:
+        return (source, 0, str(e))
+
+def find_sources(media_root):
+    """ Yields the paths, relative to media_root, of all images that can be requested by url. """
+    cache_root = os.path.abspath(settings.MEDIA_CACHE_ROOT)
+    for (dir, dirs, files) in os.walk(media_root):
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(dir, d)) != cache_root]
+        for file in files:
+            (name, extension) = _split_extension(file)
+            if extension.lower() in imagemagick.exts:
+                yield os.path.relpath(os.path.join(dir, file), media_root)
+
+def _split_extension(path):
+    (dir, file) = os.path.split(path)
+    (name, dot, extension) = file.partition('.')
+    return (os.path.join(dir, name), dot + extension)
+
+def _split(value):
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+def _parse_size(size):
+    match = re.match(r'^(\d+)x(\d+)$', size)
+    if not match:
+        raise CommandError("Invalid size: %s" % size)
+    return (int(match.group(1)), int(match.group(2)))
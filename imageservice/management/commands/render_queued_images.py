@@ -0,0 +1,27 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from imageservice import background
+
+class Command(BaseCommand):
+    help = ("Renders the images queued by requests for images that were not cached yet. "
+            "Used with RESIZE_MISS_POLICY and RESIZE_BACKGROUND_QUEUE = 'file'.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--queue-dir', dest='queue_dir',
+                    help='Directory of the queue. Defaults to RESIZE_BACKGROUND_QUEUE_DIR.'),
+        make_option('--interval', dest='interval', type='float',
+                    help='Keep running and look for queued images every INTERVAL seconds.'),
+    )
+
+    def handle(self, *args, **options):
+        queue = background.FileQueue(options.get('queue_dir') or background.queue_dir())
+        while True:
+            (done, failures) = queue.drain()
+            if done or not options.get('interval'):
+                self.stdout.write("Rendered %d images, %d failed.\n" % (done - failures, failures))
+            if not options.get('interval'):
+                break
+            time.sleep(options.get('interval'))
@@ -0,0 +1,176 @@
+from __future__ import with_statement
+
+import os
+import re
+import time
+import tempfile
+import subprocess
+import threading
+
+from django.conf import settings
+from django.utils import simplejson as json
+from imageservice import locks, metrics, paths, probe
+
+TRIM_BOX = re.compile(r'^(\d+)x(\d+)([+-]\d+)([+-]\d+)$')
+
+def get_index():
+    """ Returns the index of source image metadata, or None if settings.RESIZE_METADATA_INDEX (the path of the
+        index file) is not set.
+
+        settings.RESIZE_METADATA_INDEX_SAVE_INTERVAL: New entries are written at most once every so many
+        seconds. (Default 60)
+
+        settings.RESIZE_METADATA_INDEX_CHECK_INTERVAL: Entries written by other processes are read at most
+        once every so many seconds. (Default 10)
+
+    """
+    global _index
+    path = getattr(settings, 'RESIZE_METADATA_INDEX', None)
+    if not path:
+        return None
+    if _index is None or _index.path != path:
+        _index = MetadataIndex(path, getattr(settings, 'RESIZE_METADATA_INDEX_SAVE_INTERVAL', 60),
+                               getattr(settings, 'RESIZE_METADATA_INDEX_CHECK_INTERVAL', 10))
+    return _index
+
+_index = None
+
+class Metadata(object):
+    """ Size of a source image and the box that -trim keeps of it, (width, height, x, y), if known. """
+
+    def __init__(self, width, height, trim=None):
+        self.width = width
+        self.height = height
+        self.trim = trim and tuple(trim)
+
+    def trimmed_size(self):
+        """ Size of the trimmed image, which resized images are derived from. The whole image if the trim box is unknown. """
+        if self.trim:
+            return self.trim[:2]
+        return (self.width, self.height)
+
+class MetadataIndex(object):
+    """ Keeps the Metadata of source images, by name relative to MEDIA_ROOT without extension, in memory
+        and in a JSON file shared by all processes, so that pages can be rendered without reading images.
+
+        path: Full path of the index file. (Created if it does not exist)
+
+    """
+
+    def __init__(self, path, save_interval=60, check_interval=10):
+        self.path = path
+        self.save_interval = save_interval
+        self.check_interval = check_interval
+        self._entries = {}
+        self._dirty = {}
+        self._mtime = None
+        self._checked = 0
+        self._saved = time.time()
+        self._guard = threading.Lock()
+
+    def get(self, name):
+        """ Returns the Metadata of a source, or None if it is not in the index. """
+        if time.time() - self._checked >= self.check_interval:
+            self._reload()
+        entry = self._entries.get(name)
+        return entry and Metadata(*entry)
+
+    def record(self, name, width, height, trim=None):
+        """ Adds or updates a source. A known trim box is kept as long as the size of the source does not change. """
+        old = self._entries.get(name)
+        if trim is None and old is not None and tuple(old[:2]) == (width, height):
+            trim = old[2]
+        entry = (width, height, trim and list(trim))
+        if old is not None and tuple(old) == entry:
+            return
+        with self._guard:
+            self._entries[name] = entry
+            self._dirty[name] = entry
+        if time.time() - self._saved >= self.save_interval:
+            self.save()
+
+    def save(self):
+        """ Writes the entries recorded by this process to the index file, keeping those of other processes.
+            Processes save one at a time (see locks.render_lock). If the index file stays locked for
+            settings.RESIZE_LOCK_TIMEOUT seconds, the entries are kept for the next save.
+        """
+        with self._guard:
+            (dirty, self._dirty) = (self._dirty, {})
+            self._saved = time.time()
+        if not dirty:
+            return
+        dir = os.path.dirname(self.path) or '.'
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        try:
+            with locks.render_lock(self.path, getattr(settings, 'RESIZE_LOCK_TIMEOUT', 30)):
+                entries = self._read()
+                entries.update(dirty)
+                (fd, temp) = tempfile.mkstemp(dir=dir, prefix='.tmp-')
+                try:
+                    os.write(fd, json.dumps(entries))
+                finally:
+                    os.close(fd)
+                os.rename(temp, self.path)
+        except locks.LockTimeout:
+            with self._guard:
+                dirty.update(self._dirty)
+                self._dirty = dirty
+            return
+        with self._guard:
+            entries.update(self._dirty)
+            self._entries = entries
+
+    def _reload(self):
+        self._checked = time.time()
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            entries = self._read()
+            with self._guard:
+                entries.update(self._dirty)
+                self._entries = entries
+            self._mtime = mtime
+
+    def _read(self):
+        try:
+            f = open(self.path)
+        except IOError:
+            return {}
+        try:
+            return dict((name, tuple(entry)) for (name, entry) in json.load(f).items())
+        except ValueError:
+            metrics.incr('metadata_errors') # Written by a crashed process, rebuilt by new entries
+            return {}
+        finally:
+            f.close()
+
+def source_name(src):
+    """ Returns the name of a source in the index, or None if src is not below MEDIA_ROOT. """
+    root = settings.MEDIA_ROOT.rstrip('/') + '/'
+    if not src.startswith(root):
+        return None
+    return paths.source_name(src[len(root):])
+
+def record_source(src, trim=False):
+    """ Records the size of the source image src, read from its header (see probe.probe), in the index.
+        If trim is True, the trim box is computed too, which decodes the image.
+    """
+    index = get_index()
+    name = source_name(src)
+    if index is None or name is None:
+        return
+    info = probe.probe(src)
+    if info is None:
+        return
+    index.record(name, info.width, info.height, trim and trim_box(src) or None)
+
+def trim_box(src):
+    """ Returns the box, (width, height, x, y), of the first frame of src that imagemagick's -trim keeps. """
+    output = subprocess.Popen(['convert', src + '[0]', '-format', '%@', 'info:'], stdout=subprocess.PIPE).communicate()[0]
+    match = TRIM_BOX.match(output.strip())
+    if match is None:
+        raise IOError("Unexpected trim box of %s: %s" % (src, output))
+    return tuple(int(group) for group in match.groups())
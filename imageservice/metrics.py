@@ -0,0 +1,166 @@
+from __future__ import with_statement
+
+import time
+import socket
+import threading
+
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils.importlib import import_module
+
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def incr(name, value=1, **tags):
+    """ Increases the counter name by value. Does nothing unless settings.RESIZE_METRICS_SINKS is set. """
+    for sink in _sinks():
+        sink.incr(name, value, _clean(tags))
+
+def timing(name, seconds, **tags):
+    """ Records a duration in seconds. Does nothing unless settings.RESIZE_METRICS_SINKS is set. """
+    for sink in _sinks():
+        sink.timing(name, seconds, _clean(tags))
+
+@contextmanager
+def timer(name, **tags):
+    """ Records the duration of the with block. """
+    if not _sinks():
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        timing(name, time.time() - start, **tags)
+
+def enabled():
+    return bool(_sinks())
+
+def size_bucket(width, height):
+    """ Groups sizes for metrics, for example '<=256' for 200x100. """
+    for limit in (64, 128, 256, 512, 1024, 2048):
+        if max(width, height) <= limit:
+            return '<=%d' % limit
+    return '>2048'
+
+def _sinks():
+    """ Returns the sinks of settings.RESIZE_METRICS_SINKS, a list of dotted paths to sink classes. """
+    global _configured, _loaded
+    configured = getattr(settings, 'RESIZE_METRICS_SINKS', ())
+    if configured is not _configured:
+        _loaded = [_load(path) for path in configured]
+        _configured = configured
+    return _loaded
+
+_configured = ()
+_loaded = []
+
+def _load(path):
+    (module, _, name) = path.rpartition('.')
+    return getattr(import_module(module), name)()
+
+def _clean(tags):
+    return dict([(key, str(value)) for (key, value) in tags.items() if value is not None])
+
+class SignalSink(object):
+    """ Sends imageservice.signals.metric for every metric. """
+
+    def incr(self, name, value, tags):
+        from imageservice.signals import metric
+        metric.send(sender=SignalSink, name=name, kind='counter', value=value, tags=tags)
+
+    def timing(self, name, seconds, tags):
+        from imageservice.signals import metric
+        metric.send(sender=SignalSink, name=name, kind='timing', value=seconds, tags=tags)
+
+class StatsdSink(object):
+    """ Sends metrics over UDP to the StatsD server at settings.RESIZE_STATSD_HOST (default localhost)
+        and settings.RESIZE_STATSD_PORT (default 8125), prefixed with settings.RESIZE_STATSD_PREFIX.
+        Tags are sent in the DogStatsD format.
+    """
+
+    def __init__(self):
+        self.address = (getattr(settings, 'RESIZE_STATSD_HOST', 'localhost'), getattr(settings, 'RESIZE_STATSD_PORT', 8125))
+        self.prefix = getattr(settings, 'RESIZE_STATSD_PREFIX', 'imageservice')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def incr(self, name, value, tags):
+        self._send(name, '%d|c' % value, tags)
+
+    def timing(self, name, seconds, tags):
+        self._send(name, '%.3f|ms' % (seconds * 1000), tags)
+
+    def _send(self, name, value, tags):
+        line = '%s.%s:%s' % (self.prefix, name, value)
+        if tags:
+            line += '|#' + ','.join(['%s:%s' % item for item in sorted(tags.items())])
+        try:
+            self.socket.sendto(line, self.address)
+        except socket.error:
+            pass # Metrics must never break serving images
+
+class PrometheusSink(object):
+    """ Collects metrics in this process' registry, which imageservice.views.prometheus_metrics
+        serves in the Prometheus text format.
+    """
+
+    def incr(self, name, value, tags):
+        registry.incr(name, value, tags)
+
+    def timing(self, name, seconds, tags):
+        registry.observe(name, seconds, tags)
+
+class Registry(object):
+    """ Counters and histograms of one process. """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._guard = threading.Lock()
+
+    def incr(self, name, value, tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self._guard:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self._guard:
+            histogram = self.histograms.setdefault(key, [[0] * len(HISTOGRAM_BUCKETS), 0, 0.0])
+            for (i, bucket) in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bucket:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def render(self):
+        """ Returns all metrics in the Prometheus text exposition format. """
+        lines = []
+        with self._guard:
+            # Sorted by name, so that the samples of a metric follow its TYPE line, which is written once
+            previous = None
+            for (name, tags) in sorted(self.counters):
+                metric_name = 'imageservice_%s_total' % name
+                if name != previous:
+                    lines.append('# TYPE %s counter' % metric_name)
+                    previous = name
+                lines.append('%s%s %s' % (metric_name, _labels(tags), self.counters[(name, tags)]))
+            previous = None
+            for (name, tags) in sorted(self.histograms):
+                (buckets, count, total) = self.histograms[(name, tags)]
+                metric_name = 'imageservice_%s' % name
+                if name != previous:
+                    lines.append('# TYPE %s histogram' % metric_name)
+                    previous = name
+                for (bucket, bucket_count) in zip(HISTOGRAM_BUCKETS, buckets):
+                    lines.append('%s_bucket%s %d' % (metric_name, _labels(tags + (('le', str(bucket)),)), bucket_count))
+                lines.append('%s_bucket%s %d' % (metric_name, _labels(tags + (('le', '+Inf'),)), count))
+                lines.append('%s_sum%s %s' % (metric_name, _labels(tags), total))
+                lines.append('%s_count%s %d' % (metric_name, _labels(tags), count))
+        return '\n'.join(lines) + '\n'
+
+def _labels(tags):
+    if not tags:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (key, value.replace('\\', '\\\\').replace('"', '\\"')) for (key, value) in tags])
+
+registry = Registry()
@@ -0,0 +1,67 @@
+import os
+import re
+
+from django.conf import settings
+from django.utils.hashcompat import md5_constructor
+
+def source_file(file_name_without_extension, file_extension=""):
+    """ Full path of a source image below MEDIA_ROOT. """
+    return "%s/%s%s" % (settings.MEDIA_ROOT, file_name_without_extension, file_extension)
+
+def resized_file(file_name_without_extension, width, height, file_extension=""):
+    """ Full path below MEDIA_CACHE_ROOT where a source image resized to width x height is stored. """
+    return cache_file(file_name_without_extension, ".%dx%d%s" % (width, height, file_extension))
+
+def template_file(file_name_without_extension, template_name, file_extension=""):
+    """ Full path below MEDIA_CACHE_ROOT where a source image processed with a template is stored. """
+    return cache_file(file_name_without_extension, ".%s%s" % (template_name, file_extension))
+
+def rendition_file(file_name_without_extension, level, file_extension=""):
+    """ Full path below MEDIA_CACHE_ROOT of the trimmed intermediate image of a source that fits into level x level. """
+    return cache_file(file_name_without_extension, ".chain-%d%s" % (level, file_extension))
+
+def stage_file(file_name_without_extension, stage_command, file_extension=""):
+    """ Full path below MEDIA_CACHE_ROOT of the intermediate image of a source processed with the first stage of a template pipeline. """
+    return cache_file(file_name_without_extension, ".stage-%s%s" % (md5_constructor(stage_command).hexdigest()[:12], file_extension))
+
+def cache_file(file_name_without_extension, suffix, layout=None):
+    """ Full path below MEDIA_CACHE_ROOT of an image derived from a source, depending on settings.RESIZE_CACHE_LAYOUT:
+
+        'mirror' (default): The cache mirrors the directories of MEDIA_ROOT, for example photos/cat.100x100.png.
+
+        'hashed': The mirrored path is put below two levels of directories named after the hash of the source
+        name, for example 3f/a2/photos/cat.100x100.png, so that no directory gets too many entries.
+        All images derived from a source stay in the same directory.
+
+    """
+    if (layout or cache_layout()) == 'hashed':
+        return "%s/%s/%s%s" % (settings.MEDIA_CACHE_ROOT, shard(file_name_without_extension), file_name_without_extension.lstrip('/'), suffix)
+    return "%s/%s%s" % (settings.MEDIA_CACHE_ROOT, file_name_without_extension, suffix)
+
+def derivatives_prefix(source, layout=None):
+    """ Full path prefix of all images derived from source, a path relative to MEDIA_ROOT with or without extension. """
+    return cache_file(source_name(source), '.', layout)
+
+def source_name(path):
+    """ Returns the name without extension of the source of a path relative to MEDIA_ROOT or MEDIA_CACHE_ROOT,
+        for example 'photos/cat' for 'photos/cat.png' or 'photos/cat.100x100.png'.
+    """
+    (dir, file_name) = os.path.split(path)
+    return os.path.join(dir, file_name.split('.')[0])
+
+def cache_layout():
+    return getattr(settings, 'RESIZE_CACHE_LAYOUT', 'mirror')
+
+def shard(file_name_without_extension):
+    """ Returns the directories of a source's images in the hashed layout, for example '3f/a2'. """
+    digest = md5_constructor(file_name_without_extension.strip('/')).hexdigest()
+    return "%s/%s" % (digest[0:2], digest[2:4])
+
+SHARD = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/')
+
+def unshard(relative_path):
+    """ Returns a path relative to MEDIA_CACHE_ROOT without its hashed layout directories, if it has them. """
+    match = SHARD.match(relative_path)
+    if match and shard(source_name(relative_path[match.end():])) + '/' == match.group(0):
+        return relative_path[match.end():]
+    return relative_path
@@ -0,0 +1,146 @@
+from __future__ import with_statement
+
+import os
+import re
+
+from PIL import Image, ImageChops
+
+from imageservice import formats, tracing
+from imageservice.backends import UnsupportedCommand
+
+GEOMETRY = re.compile(r'^(\d+)x(\d+)(>?)$')
+
+class PillowBackend(object):
+    """ Renders images inside the python process with Pillow. Understands the following imagemagick options,
+        which cover the commands of imagemagick.resize:
+
+        -trim, -resize WxH, -resize WxH>, -thumbnail WxH, -thumbnail WxH>, -strip, -quality N,
+        -interlace TYPE (progressive JPEGs only) and
+        -size WxH xc:COLOR +swap -gravity center -composite (centers the image on a WxH canvas)
+
+        Any other option raises UnsupportedCommand. JPEG sources are decoded at reduced size
+        when the command shrinks them before trimming them.
+
+    """
+
+    def render(self, command, src, target):
+        operations = parse(command.split('  '))
+        image = Image.open(src)
+        source_format = image.format
+
+        size = _first_resize(operations)
+        if size is not None and source_format == 'JPEG':
+            image.draft(image.mode, size)
+        with tracing.phase('decode'):
+            image.load()
+
+        save_options = {}
+        with tracing.phase('transform'):
+            for (name, value) in operations:
+                if name == 'trim':
+                    image = trim(image)
+                elif name == 'resize':
+                    image = fit(image, value)
+                elif name == 'pad':
+                    image = pad(image, *value)
+                elif name == 'strip':
+                    image.info = {}
+                elif name == 'quality':
+                    save_options['quality'] = value
+                elif name == 'interlace' and value:
+                    save_options['progressive'] = True
+
+        image_format = _format_of(target) or source_format
+        if image_format not in Image.SAVE:
+            raise UnsupportedCommand("Pillow can not write %s images" % image_format)
+        if image_format != 'JPEG':
+            save_options.pop('progressive', None)
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        with tracing.phase('encode'):
+            image.save(target, image_format, **save_options)
+
+def parse(args):
+    """ Translates imagemagick arguments to a list of (operation, value) tuples. """
+    operations = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '-trim':
+            operations.append(('trim', None))
+        elif arg in ('-resize', '-thumbnail') and args:
+            operations.append(('resize', _geometry(args.pop(0))))
+            if arg == '-thumbnail':
+                operations.append(('strip', None))
+        elif arg == '-strip':
+            operations.append(('strip', None))
+        elif arg == '-quality' and args and args[0].isdigit():
+            operations.append(('quality', int(args.pop(0))))
+        elif arg == '-interlace' and args:
+            operations.append(('interlace', args.pop(0).lower() != 'none'))
+        elif arg == '-size' and len(args) >= 6 and args[1].startswith('xc:') and args[2:6] == ['+swap', '-gravity', 'center', '-composite']:
+            (width, height, _) = _geometry(args[0])
+            operations.append(('pad', ((width, height), args[1][3:])))
+            del args[:6]
+        else:
+            raise UnsupportedCommand("Not supported by the pillow backend: %s" % arg)
+    return operations
+
+def trim(image):
+    """ Removes borders with the color of the top left pixel, like imagemagick's -trim. """
+    rgba = image.convert('RGBA')
+    background = Image.new('RGBA', rgba.size, rgba.getpixel((0, 0)))
+    boxes = [band.getbbox() for band in ImageChops.difference(rgba, background).split()]
+    boxes = [box for box in boxes if box]
+    if not boxes:
+        return image
+    return image.crop((min([box[0] for box in boxes]), min([box[1] for box in boxes]),
+                       max([box[2] for box in boxes]), max([box[3] for box in boxes])))
+
+def fit(image, geometry):
+    """ Scales image to fit within width x height keeping its aspect ratio, like imagemagick's -resize. """
+    (width, height, only_shrink) = geometry
+    scale = min(float(width) / image.size[0], float(height) / image.size[1])
+    if only_shrink and scale >= 1:
+        return image
+    size = (max(1, int(image.size[0] * scale + 0.5)), max(1, int(image.size[1] * scale + 0.5)))
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    return image.resize(size, Image.ANTIALIAS)
+
+def pad(image, size, color):
+    """ Centers image on a canvas of the given size and color, flattening any transparency. """
+    (width, height) = size
+    canvas = Image.new('RGB', (width, height), color)
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    offset = ((width - image.size[0]) // 2, (height - image.size[1]) // 2)
+    if image.mode in ('RGBA', 'LA'):
+        canvas.paste(image, offset, image)
+    else:
+        canvas.paste(image.convert('RGB'), offset)
+    return canvas
+
+def _first_resize(operations):
+    """ Returns the size of the first resize, or None if the image is trimmed first. Decoding at reduced
+        size before trimming would leave the trimmed image smaller than the resize, as imagemagick does not.
+    """
+    for (name, value) in operations:
+        if name == 'trim':
+            return None
+        if name == 'resize':
+            return value[:2]
+    return None
+
+def _geometry(geometry):
+    match = GEOMETRY.match(geometry)
+    if not match:
+        raise UnsupportedCommand("Geometry not supported by the pillow backend: %s" % geometry)
+    return (int(match.group(1)), int(match.group(2)), match.group(3) == '>')
+
+def _format_of(file_name):
+    Image.init()
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension.lstrip('.') in formats.VARIANTS and extension not in Image.EXTENSION:
+        return extension.lstrip('.').upper() # Unknown to this Pillow, render raises UnsupportedCommand
+    return Image.EXTENSION.get(extension)
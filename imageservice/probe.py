@@ -0,0 +1,175 @@
+from __future__ import with_statement
+
+import os
+import re
+import struct
+import threading
+
+from django.conf import settings
+
+MAX_ENTRIES = 10000
+
+GEOMETRY = re.compile(r'^(\d+)x(\d+)')
+RESIZE_OPTIONS = ('-resize', '-thumbnail', '-scale', '-sample')
+
+# JPEG start of frame markers, which hold the image size. C4, C8 and CC are other markers.
+SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - frozenset((0xC4, 0xC8, 0xCC))
+
+class SourceTooLarge(IOError):
+    """ Raised for source images with more pixels than settings.RESIZE_MAX_SOURCE_PIXELS. """
+    pass
+
+class ImageInfo(object):
+    """ Format, size and number of frames of an image, read from its header. """
+
+    def __init__(self, format, width, height, frames=1):
+        self.format = format
+        self.width = width
+        self.height = height
+        self.frames = frames
+
+    def pixels(self):
+        return self.width * self.height
+
+def probe(path):
+    """ Returns the ImageInfo of a PNG, JPEG or GIF image without decoding it, or None for other files.
+        The frames of GIF images are counted by skipping over their image data. Results are cached until 
+        the file changes.
+    """
+    stat = os.stat(path)
+    key = (stat.st_mtime, stat.st_size, stat.st_ino)
+    entry = _cache.get(path)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+
+    f = open(path, 'rb')
+    try:
+        info = read_header(f)
+    finally:
+        f.close()
+
+    with _guard:
+        if len(_cache) >= MAX_ENTRIES:
+            _cache.clear()
+        _cache[path] = (key, info)
+    return info
+
+_cache = {}
+_guard = threading.Lock()
+
+def check_pixel_budget(path):
+    """ Raises SourceTooLarge if the image has more pixels than settings.RESIZE_MAX_SOURCE_PIXELS
+        (for example 50000000), unless the setting is None (default) or the format is unknown.
+    """
+    max_pixels = getattr(settings, 'RESIZE_MAX_SOURCE_PIXELS', None)
+    if not max_pixels:
+        return
+    info = probe(path)
+    if info is not None and info.pixels() > max_pixels:
+        raise SourceTooLarge("Source image has %dx%d pixels, more than %d: %s" % (info.width, info.height, max_pixels, path))
+
+def decode_hint(path, args):
+    """ Returns imagemagick options to put before a JPEG source so that it is decoded at reduced size, as
+        far as the first resize in args allows. The decoded image is at least settings.RESIZE_JPEG_SIZE_HINT
+        (default 2, None disables the hint) times the size of the resized image.
+        
+        There is no hint if the image is trimmed before it is resized: the trimmed image would be smaller
+        than the resize and is never scaled up again.
+    """
+    factor = getattr(settings, 'RESIZE_JPEG_SIZE_HINT', 2)
+    size = _first_resize(args)
+    if not factor or size is None:
+        return []
+    info = probe(path)
+    (width, height) = (size[0] * factor, size[1] * factor)
+    if info is None or info.format != 'JPEG' or (info.width <= width and info.height <= height):
+        return []
+    return ['-define', 'jpeg:size=%dx%d' % (width, height)]
+
+def _first_resize(args):
+    args = list(args)
+    for (i, arg) in enumerate(args[:-1]):
+        if arg == '-trim':
+            return None
+        if arg in RESIZE_OPTIONS:
+            match = GEOMETRY.match(args[i + 1])
+            if match:
+                return (int(match.group(1)), int(match.group(2)))
+            return None
+    return None
+
+def read_header(f):
+    """ Returns the ImageInfo of the image in the open file f, or None if it is no PNG, JPEG or GIF. """
+    head = f.read(26)
+    if head.startswith('\x89PNG\r\n\x1a\n') and head[12:16] == 'IHDR' and len(head) >= 24:
+        (width, height) = struct.unpack('>II', head[16:24])
+        return ImageInfo('PNG', width, height)
+    if head[:6] in ('GIF87a', 'GIF89a') and len(head) >= 10:
+        (width, height) = struct.unpack('<HH', head[6:10])
+        f.seek(10)
+        return ImageInfo('GIF', width, height, _count_gif_frames(f))
+    if head.startswith('\xff\xd8'):
+        f.seek(2)
+        return _read_jpeg_header(f)
+    return None
+
+def _read_jpeg_header(f):
+    while True:
+        byte = f.read(1)
+        while byte and byte != '\xff':
+            byte = f.read(1)
+        while byte == '\xff':
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = ord(byte)
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue # Markers without length
+        if marker in (0xD9, 0xDA):
+            return None # End of image or start of scan before any frame
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+        if marker in SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            (_, height, width) = struct.unpack('>BHH', frame)
+            return ImageInfo('JPEG', width, height)
+        f.seek(length - 2, 1)
+
+def _count_gif_frames(f):
+    """ Counts the image descriptors of the GIF file f, positioned after the logical screen size. """
+    flags = f.read(3)[:1]
+    if not flags:
+        return 1
+    if ord(flags) & 0x80:
+        f.seek(3 << ((ord(flags) & 0x07) + 1), 1) # Global color table
+    frames = 0
+    while True:
+        block = f.read(1)
+        if block == '\x2c': # Image descriptor
+            descriptor = f.read(9)
+            if len(descriptor) < 9:
+                break
+            if ord(descriptor[8]) & 0x80:
+                f.seek(3 << ((ord(descriptor[8]) & 0x07) + 1), 1) # Local color table
+            f.seek(1, 1) # LZW minimum code size
+            frames += 1
+        elif block == '\x21': # Extension
+            f.seek(1, 1)
+        else:
+            break # Trailer, or a truncated file
+        if not _skip_sub_blocks(f):
+            break
+    return max(frames, 1)
+
+def _skip_sub_blocks(f):
+    while True:
+        size = f.read(1)
+        if not size:
+            return False
+        if size == '\x00':
+            return True
+        f.seek(ord(size), 1)
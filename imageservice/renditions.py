@@ -0,0 +1,41 @@
+from django.conf import settings
+
+def buckets():
+    """ Returns settings.RESIZE_SIZE_BUCKETS, sizes like (320, 240) or '320x240', as (width, height) tuples. """
+    sizes = []
+    for size in getattr(settings, 'RESIZE_SIZE_BUCKETS', ()):
+        if isinstance(size, basestring):
+            size = size.lower().split('x')
+        sizes.append((int(size[0]), int(size[1])))
+    return sizes
+
+def bucket(width, height):
+    """ Returns the smallest of the configured sizes that a width x height image fits into, the largest
+        one if it fits into none, or (width, height) itself if no sizes are configured.
+    """
+    sizes = sorted(buckets(), key=lambda size: (size[0] * size[1], size))
+    if not sizes:
+        return (width, height)
+    for size in sizes:
+        if size[0] >= width and size[1] >= height:
+            return size
+    return sizes[-1]
+
+def bucket_mode():
+    """ settings.RESIZE_SIZE_BUCKET_MODE: 'snap' (default) serves the bucket's image at the requested url,
+        'redirect' redirects to the url of the bucket's size.
+    """
+    return getattr(settings, 'RESIZE_SIZE_BUCKET_MODE', 'snap')
+
+def levels():
+    """ Returns settings.RESIZE_RENDITION_LEVELS, the sizes of the trimmed intermediate images, ascending. """
+    return sorted(getattr(settings, 'RESIZE_RENDITION_LEVELS', ()))
+
+def level_for(width, height):
+    """ Returns the smallest intermediate size that a width x height image can be derived from,
+        or None if there is none.
+    """
+    for level in levels():
+        if level >= max(width, height):
+            return level
+    return None
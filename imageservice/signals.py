@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# Sent for every metric when imageservice.metrics.SignalSink is configured. kind is 'counter' or 'timing'.
+metric = Signal(providing_args=['name', 'kind', 'value', 'tags'])
@@ -0,0 +1,80 @@
+from __future__ import with_statement
+
+import os
+import time
+import threading
+
+from django.conf import settings
+
+MAX_DIRECTORIES = 10000
+
+def get_index():
+    """ Returns the index of source images, or None unless settings.RESIZE_SOURCE_INDEX is True.
+
+        settings.RESIZE_SOURCE_INDEX_TTL: Seconds a directory listing is trusted without looking at the
+        directory. With 0 (default) the directory's modification time is checked on every lookup.
+
+    """
+    global _index
+    if not getattr(settings, 'RESIZE_SOURCE_INDEX', False):
+        return None
+    ttl = getattr(settings, 'RESIZE_SOURCE_INDEX_TTL', 0)
+    if _index is None or _index.ttl != ttl:
+        _index = SourceIndex(ttl)
+    return _index
+
+_index = None
+
+class SourceIndex(object):
+    """ Answers whether source images exist from cached directory listings instead of stat calls per file.
+        Listings are read lazily per directory and read again when the directory has been modified or,
+        if ttl is set, when they are older than ttl seconds. Missing files and directories are cached too.
+    """
+
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self._listings = {}
+        self._guard = threading.Lock()
+
+    def exists(self, path):
+        (dir, file_name) = os.path.split(path)
+        return file_name in self._listing(dir)
+
+    def first_existing(self, paths):
+        """ Returns the first of paths that exists, or None. Every directory is looked up once. """
+        listings = {}
+        for path in paths:
+            (dir, file_name) = os.path.split(path)
+            if dir not in listings:
+                listings[dir] = self._listing(dir)
+            if file_name in listings[dir]:
+                return path
+        return None
+
+    def forget(self, path):
+        """ Drops the cached listing of the directory of path, for example after a file was added to it. """
+        with self._guard:
+            self._listings.pop(os.path.dirname(path), None)
+
+    def _listing(self, dir):
+        now = time.time()
+        entry = self._listings.get(dir)
+        if entry is not None and self.ttl and now - entry[1] < self.ttl:
+            return entry[2]
+
+        try:
+            mtime = os.stat(dir).st_mtime
+        except OSError:
+            mtime = None
+        if entry is not None and entry[0] == mtime:
+            files = entry[2]
+        elif mtime is None:
+            files = frozenset()
+        else:
+            files = frozenset(os.listdir(dir))
+
+        with self._guard:
+            if len(self._listings) >= MAX_DIRECTORIES:
+                self._listings.clear()
+            self._listings[dir] = (mtime, now, files)
+        return files
@@ -0,0 +1,169 @@
+from __future__ import with_statement
+
+import os
+import time
+import shutil
+import threading
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import get_storage_class
+from imageservice import locks, paths, sourceindex
+
+MAX_MISSING = 10000
+
+def source_storage():
+    """ Returns the storage of source images, or None if the sources are in MEDIA_ROOT only.
+
+        settings.RESIZE_SOURCE_STORAGE: Dotted path of a Django storage class, for example
+        'storages.backends.s3boto.S3BotoStorage'. Source images not found in MEDIA_ROOT are
+        fetched from there once and kept in MEDIA_ROOT.
+
+        settings.RESIZE_SOURCE_STORAGE_OPTIONS: Keyword arguments of the storage class.
+    """
+    return _storage('RESIZE_SOURCE_STORAGE')
+
+def shared_storage():
+    """ Returns the storage of rendered images shared by all hosts, or None if every host keeps its own.
+
+        settings.RESIZE_SHARED_CACHE_STORAGE: Dotted path of a Django storage class. Images rendered
+        on one host are published there and fetched from there by the others instead of rendering them again.
+
+        settings.RESIZE_SHARED_CACHE_STORAGE_OPTIONS: Keyword arguments of the storage class.
+    """
+    return _storage('RESIZE_SHARED_CACHE_STORAGE')
+
+def _storage(name):
+    configured = (getattr(settings, name, None), getattr(settings, name + '_OPTIONS', {}))
+    if configured[0] is None:
+        return None
+    if _storages.get(name, (None, None))[0] != configured:
+        (import_path, options) = configured
+        _storages[name] = (configured, get_storage_class(import_path)(**options))
+    return _storages[name][1]
+
+_storages = {}
+
+def stage_source(files):
+    """ Fetches the first of the source files, full paths below MEDIA_ROOT, that exists in the source storage
+        and stores it at its path. Returns that path or None if there is no source storage or no such file.
+        
+        Files missing in the source storage are not looked up again for settings.RESIZE_SOURCE_STORAGE_MISS_TTL 
+        seconds (default 60). Concurrent requests for the same source fetch it only once (see locks.render_lock).
+    """
+    storage = source_storage()
+    if storage is None:
+        return None
+    now = time.time()
+    for file in files:
+        name = _relative(file, settings.MEDIA_ROOT)
+        if name is None or _missing.get(name, 0) > now:
+            continue
+        if storage.exists(name):
+            _stage(storage, name, file)
+            index = sourceindex.get_index()
+            if index is not None:
+                index.forget(file) # The listing of the directory may be trusted for a while
+            return file
+        _remember_missing(name, now + getattr(settings, 'RESIZE_SOURCE_STORAGE_MISS_TTL', 60))
+    return None
+
+def _remember_missing(name, expires):
+    with _missing_guard:
+        if len(_missing) >= MAX_MISSING:
+            _missing.clear()
+        _missing[name] = expires
+
+_missing = {}
+_missing_guard = threading.Lock()
+
+def unstage_source(file):
+    """ Removes the local copy of a source image, so it is fetched again from the source storage. """
+    if source_storage() is not None and _relative(file, settings.MEDIA_ROOT) is not None:
+        try:
+            os.remove(file)
+        except OSError:
+            pass
+
+def fetch_render(target):
+    """ Fetches the rendered image target, a full path below MEDIA_CACHE_ROOT, from the shared storage.
+        Returns True if it was there.
+    """
+    storage = shared_storage()
+    name = _relative(target, settings.MEDIA_CACHE_ROOT)
+    if storage is None or name is None or not storage.exists(name):
+        return False
+    try:
+        _download(storage, name, target)
+    except (IOError, OSError):
+        return False # Removed meanwhile
+    return True
+
+def publish_render(target):
+    """ Stores the rendered image target in the shared storage, replacing an older version. """
+    storage = shared_storage()
+    name = _relative(target, settings.MEDIA_CACHE_ROOT)
+    if storage is None or name is None:
+        return
+    if storage.exists(name):
+        storage.delete(name)
+    with open(target, 'rb') as f:
+        saved = storage.save(name, File(f))
+    if saved != name:
+        storage.delete(saved) # Published by another host meanwhile
+
+def remove_renders(source):
+    """ Removes the images rendered from source, relative to MEDIA_ROOT, from the shared storage.
+        Returns their full paths below MEDIA_CACHE_ROOT.
+    """
+    storage = shared_storage()
+    if storage is None:
+        return []
+    (dir, prefix) = os.path.split(_relative(paths.derivatives_prefix(source), settings.MEDIA_CACHE_ROOT))
+    try:
+        (_, files) = storage.listdir(dir)
+    except OSError:
+        return []
+    removed = []
+    for file in files:
+        if file.startswith(prefix):
+            name = dir and '%s/%s' % (dir, file) or file
+            storage.delete(name)
+            removed.append('%s/%s' % (settings.MEDIA_CACHE_ROOT, name))
+    return removed
+
+def _relative(path, root):
+    root = root.rstrip('/') + '/'
+    if not path.startswith(root):
+        return None
+    return path[len(root):]
+
+def _stage(storage, name, path):
+    _prepare_dir(path)
+    try:
+        with locks.render_lock(path, getattr(settings, 'RESIZE_LOCK_TIMEOUT', 30)):
+            if not os.path.isfile(path): # Unless staged by another thread or process while we waited
+                _download(storage, name, path)
+    except locks.LockTimeout:
+        if not os.path.isfile(path):
+            _download(storage, name, path)
+
+def _download(storage, name, path):
+    from imageservice.imagemagick import temp_file
+    _prepare_dir(path)
+    remote = storage.open(name, 'rb')
+    try:
+        with temp_file(path) as tmp:
+            with open(tmp, 'wb') as local:
+                shutil.copyfileobj(remote, local)
+    finally:
+        remote.close()
+    os.chmod(path, 0644)
+
+def _prepare_dir(path):
+    (dir, _) = os.path.split(path)
+    if not os.path.isdir(dir):
+        try:
+            os.makedirs(dir)
+        except OSError:
+            pass # Created by another thread
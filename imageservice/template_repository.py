@@ -1,29 +1,91 @@
 from django.conf import settings
+from imageservice import metrics
 import fnmatch
 import os
+import time
+
+class Template(object):
+    """ A compiled template: the imagemagick commands of its pipeline stages, in order.
+
+        command: The whole pipeline as one command, arguments separated by double spaces.
+
+    """
+
+    def __init__(self, name, stages):
+        self.name = name
+        self.stages = stages
+        self.command = '  '.join(stages)
 
 class TemplateRepository(object):
-    
+    """ The templates of the imagemagick.templates file, one per line:
+
+        name = -arg1  arg2
+
+        Arguments are separated by double spaces. A template can be a pipeline of stages separated by '|',
+        each of them a command or the name of another template, for example 'card = trim | -resize  400x300> | sharpen'.
+        Empty lines and lines starting with '#' are ignored.
+
+        The file is read again when it changes, checked at most every settings.RESIZE_TEMPLATES_CHECK_INTERVAL
+        seconds (default 2, None never).
+
+    """
+
     def __init__(self):
+        self.file = self._findTemplateFile()
         self.templates = self._readTemplates()
-    
+
     def getTemplate(self, templateName):
+        return self.get(templateName).command
+
+    def get(self, templateName):
+        """ Returns the compiled Template of a name. Raises KeyError for unknown names. """
+        self._reloadIfChanged()
         return self.templates[templateName]
-    
+
+    def _reloadIfChanged(self):
+        interval = getattr(settings, 'RESIZE_TEMPLATES_CHECK_INTERVAL', 2)
+        if interval is None or time.time() - self._checked < interval:
+            return
+        self._checked = time.time()
+        try:
+            if os.path.getmtime(self.file) != self._mtime:
+                # Replaced at once, so that readers never see a partly read file
+                self.templates = self._readTemplates()
+        except (IOError, OSError, ValueError):
+            metrics.incr('template_reload_errors') # Keep the templates read before
+
     def _readTemplates(self):
-        file = self._findTemplateFile()
-        
-        templates = {}
-        for line in open(file, "r"):
-            keyValue = line.split("=")
-            templates[keyValue[0].strip()] = keyValue[1].strip()
-        
-        return templates
-    
+        self._checked = time.time()
+        self._mtime = os.path.getmtime(self.file)
+
+        definitions = {}
+        for line in open(self.file, "r"):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if '=' not in line:
+                raise ValueError("Invalid template in %s: %s" % (self.file, line))
+            (name, value) = line.split("=", 1)
+            definitions[name.strip()] = [stage.strip() for stage in value.split('|')]
+
+        return dict((name, Template(name, _stages(name, definitions, ()))) for name in definitions)
+
     def _findTemplateFile(self):
         dirs = settings.TEMPLATE_DIRS
         for dir in dirs:
             for file in os.listdir(dir):
                 if fnmatch.fnmatch(file, 'imagemagick.templates'):
                     return dir + '/' + file
-        raise IOError('Templates file (imagemagick.templates) not found in Django templates dirs. Following dirs where searched: ' + ", ".join(dirs))
\ No newline at end of file
+        raise IOError('Templates file (imagemagick.templates) not found in Django templates dirs. Following dirs where searched: ' + ", ".join(dirs))
+
+def _stages(name, definitions, referencing):
+    """ Returns the commands of a template's pipeline, with referenced templates replaced by their stages. """
+    if name in referencing:
+        raise ValueError("Template %s references itself: %s" % (name, " | ".join(referencing + (name,))))
+    stages = []
+    for stage in definitions[name]:
+        if stage in definitions:
+            stages += _stages(stage, definitions, referencing + (name,))
+        elif stage:
+            stages.append(stage)
+    return stages
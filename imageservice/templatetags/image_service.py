@@ -1,5 +1,9 @@
 from django import template
+from django.conf import settings
 from django.template.defaultfilters import stringfilter
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from imageservice import metadata, metrics, paths, renditions
 register = template.Library() 
 @register.filter
 @stringfilter
@@ -8,4 +12,87 @@ def resize(url, size):
     (url_without_file_ending, delim, file_ending) = file_ending.rpartition(".")
     if url_without_file_ending == "":
         url_without_file_ending, file_ending = file_ending, ""
-    return path + slash + url_without_file_ending + "." + size + delim + file_ending
\ No newline at end of file
+    return path + slash + url_without_file_ending + "." + size + delim + file_ending
+
+@register.tag
+def responsive_image(parser, token):
+    """ {% responsive_image url [widths="320,640"] [sizes="50vw"] [alt="..."] [class="..."] %}
+    
+        Renders an <img> of the image at url with a srcset of resized images, see responsive_image_html.
+    """
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError("%r tag requires the url of an image" % bits[0])
+    attributes = {}
+    for bit in bits[2:]:
+        (name, equals, value) = bit.partition('=')
+        if not equals or name not in ('widths', 'sizes', 'alt', 'class'):
+            raise template.TemplateSyntaxError("%r tag got an unknown argument: %s" % (bits[0], bit))
+        attributes[name] = parser.compile_filter(value)
+    return ResponsiveImageNode(parser.compile_filter(bits[1]), attributes)
+
+class ResponsiveImageNode(template.Node):
+    
+    def __init__(self, url, attributes):
+        self.url = url
+        self.attributes = attributes
+    
+    def render(self, context):
+        attributes = dict((name, value.resolve(context)) for (name, value) in self.attributes.items())
+        return responsive_image_html(self.url.resolve(context), **attributes)
+
+def responsive_image_html(url, widths=None, sizes=None, alt='', **attributes):
+    """ Returns an <img> of the image at url with width, height, srcset and sizes attributes, computed from the 
+        metadata index (see imageservice.metadata) without reading any image. Returns a plain <img> for images 
+        that are not in the index yet.
+        
+        url: Url of a source image below settings.RESIZE_IMAGE_URL (default '/'), the url the image service is
+        served at.
+        
+        widths: Widths of the images in srcset, a list or a comma separated string. (Default 
+        settings.RESIZE_SRCSET_WIDTHS or 320, 640, 960, 1280 and 1920) Heights keep the aspect ratio of the trimmed 
+        source. Widths larger than the trimmed source are left out.
+        
+        sizes: The sizes attribute. (Default settings.RESIZE_SRCSET_SIZES or '100vw')
+    """
+    attributes['alt'] = alt
+    candidates = _candidates(url, widths)
+    if not candidates:
+        attributes['src'] = url
+    else:
+        (width, height) = candidates[-1]
+        attributes['src'] = resize(url, '%dx%d' % (width, height))
+        attributes['width'] = width
+        attributes['height'] = height
+        attributes['srcset'] = ', '.join('%s %dw' % (resize(url, '%dx%d' % size), size[0]) for size in candidates)
+        attributes['sizes'] = sizes or getattr(settings, 'RESIZE_SRCSET_SIZES', '100vw')
+    return mark_safe('<img %s>' % ' '.join('%s="%s"' % (name, escape(attributes[name])) 
+                                           for name in ATTRIBUTE_ORDER if attributes.get(name) is not None))
+
+ATTRIBUTE_ORDER = ('src', 'srcset', 'sizes', 'width', 'height', 'alt', 'class')
+
+def _candidates(url, widths):
+    """ Returns the sizes of the images in the srcset of url, narrowest first, or [] if the source is not indexed. """
+    index = metadata.get_index()
+    prefix = getattr(settings, 'RESIZE_IMAGE_URL', '/')
+    if index is None or not url.startswith(prefix):
+        return []
+    info = index.get(paths.source_name(url[len(prefix):]))
+    if info is None:
+        metrics.incr('metadata_misses')
+        return []
+    
+    if widths is None:
+        widths = getattr(settings, 'RESIZE_SRCSET_WIDTHS', (320, 640, 960, 1280, 1920))
+    if isinstance(widths, basestring):
+        widths = [width for width in widths.split(',') if width.strip()]
+    (trimmed_width, trimmed_height) = info.trimmed_size()
+    widths = sorted(set(int(width) for width in widths))
+    widths = [width for width in widths if width <= trimmed_width] or [trimmed_width]
+    
+    candidates = []
+    for width in widths:
+        size = renditions.bucket(width, max(1, int(round(width * trimmed_height / float(trimmed_width)))))
+        if size[0] <= settings.RESIZE_MAX_WIDTH and size[1] <= settings.RESIZE_MAX_HEIGHT and size not in candidates:
+            candidates.append(size)
+    return candidates
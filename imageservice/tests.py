@@ -1,13 +1,20 @@
 from __future__ import with_statement
 from nose.tools import raises
+from nose.plugins.skip import SkipTest
 
 import os
 import tempfile
 import shutil
 import unittest
+import threading
+import time
 from contextlib import contextmanager
 from django.conf import settings
 import stat
+import re
+import subprocess
+import struct
+import sys
 root = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..')
 settings.configure(RESIZE_MAX_HEIGHT=2048,RESIZE_MAX_WIDTH=2048,
                    MEDIA_ROOT="",
@@ -19,10 +26,12 @@ settings.configure(RESIZE_MAX_HEIGHT=2048,RESIZE_MAX_WIDTH=2048,
                    ROOT_URLCONF='imageservice.urls',
                    TEMPLATE_DIRS = (os.path.join(root, 'test_settings'),)
                    )
-from imageservice import views, imagemagick
+from imageservice import views, animation, background, imagemagick, metadata, locks, workerpool, cacheindex, cache, sourceindex, backends, admission, metrics, signals, tracing, formats, hotcache, storage, renditions, probe, paths
 from imageservice.template_repository import TemplateRepository
+from imageservice.templatetags import image_service
 from imageservice.templatetags.image_service import resize
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, HttpRequest
+from django.utils.http import http_date
 from django.test.client import Client
 class ImageMagickResizeTest(unittest.TestCase):
     
@@ -102,6 +111,1684 @@ class ImageMagickResizeTest(unittest.TestCase):
         imagemagick.resize(source, target, 320, 200)
         self.assertTrue(os.path.isfile(target))
   
+class SingleFlightTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.source = settings.TEST_MEDIA_ROOT + '/test.png'
+        self.tmp_dir = tempfile.mkdtemp()
+        self.target = self.tmp_dir + '/target.png'
+        self.calls = []
+        self.old_callImageMagick = imagemagick._callImageMagick
+        
+        def slow_callImageMagick(command, src, target):
+            self.calls.append(target)
+            time.sleep(0.2)
+            open(target, 'w').write("rendered")
+        
+        imagemagick._callImageMagick = slow_callImageMagick
+        settings.RESIZE_LOCK_TIMEOUT = 5
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        imagemagick._callImageMagick = self.old_callImageMagick
+        del settings.RESIZE_LOCK_TIMEOUT
+    
+    def test_should_render_concurrent_requests_for_same_target_only_once(self):
+        threads = [threading.Thread(target=imagemagick.execute, args=('cmd', self.source, self.target)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEquals([self.target], self.calls)
+        self.assertEquals("rendered", open(self.target).read())
+    
+    def test_should_render_anyway_when_waiting_for_lock_times_out(self):
+        settings.RESIZE_LOCK_TIMEOUT = 0.1
+        with locks.render_lock(self.target, 1):
+            imagemagick.execute('cmd', self.source, self.target)
+        
+        self.assertEquals([self.target], self.calls)
+    
+    def test_should_remove_lock_file_when_done(self):
+        imagemagick.execute('cmd', self.source, self.target)
+        self.assertFalse(os.path.exists(self.target + '.lock'))
+    
+    @raises(locks.LockTimeout)
+    def test_should_raise_lock_timeout_if_lock_is_held(self):
+        with locks.render_lock(self.target, 1):
+            with locks.render_lock(self.target, 0.1):
+                pass
+
+class FakeWorker(object):
+    instances = []
+    
+    def __init__(self, command):
+        self.jobs = 0
+        self.closed = False
+        FakeWorker.instances.append(self)
+    
+    def run(self, src, args, target, timeout, input_args=()):
+        self.jobs += 1
+        if src == 'fail':
+            raise workerpool.WorkerError
+    
+    def close(self):
+        self.closed = True
+
+# Mimics ImageMagick's script mode: writes every image to its -write target and prints a line
+FAKE_IMAGEMAGICK_SCRIPT = '''
+import shlex, sys
+for line in iter(sys.stdin.readline, ''):
+    tokens = shlex.split(line)
+    open(tokens[tokens.index('-write') + 1], 'w').write('image')
+    sys.stdout.write('done\\n')
+    sys.stdout.flush()
+'''
+
+class WorkerPoolTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_Worker = workerpool.Worker
+        workerpool.Worker = FakeWorker
+        FakeWorker.instances = []
+        self.pool = workerpool.WorkerPool(1, ['magick'], 2, 10)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        workerpool.Worker = self.old_Worker
+    
+    def test_should_reuse_idle_worker(self):
+        self.pool.run('src', [], 'target')
+        self.pool.run('src', [], 'target')
+        self.assertEquals(1, len(FakeWorker.instances))
+    
+    def test_should_replace_worker_after_max_jobs(self):
+        for _ in range(3):
+            self.pool.run('src', [], 'target')
+        self.assertEquals(2, len(FakeWorker.instances))
+        self.assertTrue(FakeWorker.instances[0].closed)
+    
+    def test_should_replace_worker_that_fails(self):
+        try:
+            self.pool.run('fail', [], 'target')
+        except workerpool.WorkerError:
+            pass
+        self.pool.run('src', [], 'target')
+        self.assertEquals(2, len(FakeWorker.instances))
+        self.assertTrue(FakeWorker.instances[0].closed)
+    
+    def test_should_be_disabled_by_default(self):
+        self.assertEquals(None, workerpool.get_pool())
+    
+    def test_should_write_image_to_target_using_script_protocol(self):
+        workerpool.Worker = self.old_Worker
+        target = self.tmp_dir + "/target with space.png"
+        worker = workerpool.Worker([sys.executable, '-c', FAKE_IMAGEMAGICK_SCRIPT])
+        try:
+            worker.run('src.png', ['-resize', '10x10>'], target, 10)
+            worker.run('src.png', ['-resize', '10x10>'], target, 10)
+        finally:
+            worker.close()
+        self.assertEquals('image', open(target).read())
+    
+    @raises(workerpool.WorkerError)
+    def test_should_raise_worker_error_if_worker_dies(self):
+        workerpool.Worker = self.old_Worker
+        worker = workerpool.Worker([sys.executable, '-c', 'pass'])
+        try:
+            worker.run('src.png', [], self.tmp_dir + '/target.png', 10)
+        finally:
+            worker.close()
+    
+    def test_script_should_quote_arguments_with_special_characters(self):
+        self.assertEquals("-read 'my src.png' -trim -write target.png -delete 0--1 -size 1x1 xc:black -write info:/dev/stdout -delete 0--1\n",
+                          workerpool.script('my src.png', ['-trim'], 'target.png'))
+    
+    def test_should_fall_back_to_convert_process_if_worker_fails(self):
+        class FailingPool(object):
+            def run(self, src, args, target, input_args=()):
+                raise workerpool.WorkerError
+        old_get_pool = workerpool.get_pool
+        old_check_call = subprocess.check_call
+        calls = []
+        workerpool.get_pool = lambda: FailingPool()
+        subprocess.check_call = lambda args: calls.append(args)
+        try:
+            imagemagick._runImageMagick('src.png', ['-trim'], 'target.png')
+        finally:
+            workerpool.get_pool = old_get_pool
+            subprocess.check_call = old_check_call
+        self.assertEquals([['convert', 'src.png', '-trim', 'target.png']], calls)
+
+class CacheIndexTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index = cacheindex.CacheIndex(self.tmp_dir + '/index.sqlite', touch_interval=0)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+    
+    def cached_file(self, name, size=10, last_access=None):
+        path = os.path.join(self.tmp_dir, name)
+        open(path, 'w').write('x' * size)
+        self.index.add(path, 'source/' + name)
+        if last_access is not None:
+            self.index._execute("UPDATE entries SET last_access = ? WHERE path = ?", (last_access, path))
+        return path
+    
+    def test_should_sum_up_cached_files(self):
+        self.cached_file('a.png', 10)
+        self.cached_file('b.png', 20)
+        self.assertEquals((2, 30), self.index.totals())
+    
+    def test_should_evict_least_recently_used_files_until_within_budget(self):
+        old = self.cached_file('old.png', last_access=100)
+        older = self.cached_file('older.png', last_access=50)
+        new = self.cached_file('new.png', last_access=200)
+        
+        evicted = self.index.evict(max_files=1, grace=0)
+        
+        self.assertEquals([older, old], evicted)
+        self.assertFalse(os.path.exists(older))
+        self.assertTrue(os.path.exists(new))
+        self.assertEquals((1, 10), self.index.totals())
+    
+    def test_should_evict_least_frequently_used_files_with_lfu_policy(self):
+        popular = self.cached_file('popular.png', last_access=50)
+        unpopular = self.cached_file('unpopular.png', last_access=100)
+        self.index.touch(popular)
+        self.index._execute("UPDATE entries SET last_access = 50", ())
+        
+        self.assertEquals([unpopular], self.index.evict(max_bytes=10, policy='lfu', grace=0))
+    
+    def test_should_not_evict_recently_accessed_files(self):
+        self.cached_file('a.png')
+        self.cached_file('b.png')
+        self.assertEquals([], self.index.evict(max_files=0, grace=60))
+    
+    def test_should_not_evict_anything_within_budget(self):
+        self.cached_file('a.png', last_access=0)
+        self.assertEquals([], self.index.evict(max_bytes=100, grace=0))
+    
+    def test_should_rebuild_index_from_files_on_disk(self):
+        os.mkdir(self.tmp_dir + '/dir')
+        open(self.tmp_dir + '/dir/a.png', 'w').write('abc')
+        self.index.rebuild(self.tmp_dir)
+        self.assertEquals((1, 3), self.index.totals())
+    
+    def test_should_parse_sizes_with_unit(self):
+        self.assertEquals(512, cacheindex.parse_size('512'))
+        self.assertEquals(2 * 1024 ** 3, cacheindex.parse_size('2G'))
+    
+    def test_execute_should_record_rendered_images_in_index(self):
+        old_callImageMagick = imagemagick._callImageMagick
+        imagemagick._callImageMagick = lambda command, src, target: open(target, 'w').write('image')
+        settings.RESIZE_CACHE_INDEX = self.index.path
+        target = self.tmp_dir + '/target.png'
+        try:
+            imagemagick.execute('cmd', settings.TEST_MEDIA_ROOT + '/test.png', target)
+        finally:
+            imagemagick._callImageMagick = old_callImageMagick
+            del settings.RESIZE_CACHE_INDEX
+        self.assertEquals((1, 5), self.index.totals())
+
+class SourceChangeTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source = self.tmp_dir + '/source.png'
+        self.target = self.tmp_dir + '/cache/source.100x100.png'
+        shutil.copy(settings.TEST_MEDIA_ROOT + '/test.png', self.source)
+        
+        self.renders = []
+        self.old_callImageMagick = imagemagick._callImageMagick
+        def mock_callImageMagick(command, src, target):
+            self.renders.append(src)
+            open(target, 'w').write('image')
+        imagemagick._callImageMagick = mock_callImageMagick
+        
+        self.old_settings = (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT)
+        settings.MEDIA_ROOT = self.tmp_dir
+        settings.MEDIA_CACHE_ROOT = self.tmp_dir + '/cache'
+        settings.RESIZE_CHECK_SOURCE = True
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        imagemagick._callImageMagick = self.old_callImageMagick
+        (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT) = self.old_settings
+        del settings.RESIZE_CHECK_SOURCE
+        if hasattr(settings, 'RESIZE_CACHE_INDEX'):
+            del settings.RESIZE_CACHE_INDEX
+    
+    def age_target(self):
+        os.utime(self.target, (time.time() + 10, time.time() + 10))
+    
+    def test_should_not_render_again_if_source_is_unchanged(self):
+        imagemagick.execute('cmd', self.source, self.target)
+        imagemagick.execute('cmd', self.source, self.target)
+        self.assertEquals(1, len(self.renders))
+    
+    def test_should_render_again_if_source_is_newer_than_cached_image(self):
+        imagemagick.execute('cmd', self.source, self.target)
+        os.utime(self.source, (time.time() + 10, time.time() + 10))
+        imagemagick.execute('cmd', self.source, self.target)
+        self.assertEquals(2, len(self.renders))
+    
+    def test_should_not_check_source_unless_configured(self):
+        settings.RESIZE_CHECK_SOURCE = False
+        imagemagick.execute('cmd', self.source, self.target)
+        os.utime(self.source, (time.time() + 10, time.time() + 10))
+        imagemagick.execute('cmd', self.source, self.target)
+        self.assertEquals(1, len(self.renders))
+    
+    def test_should_render_again_if_source_fingerprint_in_index_has_changed(self):
+        settings.RESIZE_CACHE_INDEX = self.tmp_dir + '/index.sqlite'
+        imagemagick.execute('cmd', self.source, self.target)
+        self.age_target()
+        imagemagick.execute('cmd', self.source, self.target)
+        
+        open(self.source, 'a').write('changed')
+        imagemagick.execute('cmd', self.source, self.target)
+        self.assertEquals(2, len(self.renders))
+    
+    def test_invalidate_should_remove_all_derivatives_of_source_only(self):
+        other_target = self.tmp_dir + '/cache/other.100x100.png'
+        imagemagick.execute('cmd', self.source, self.target)
+        imagemagick.execute('cmd', self.source, self.tmp_dir + '/cache/source.thumb.png')
+        imagemagick.execute('cmd', self.source, other_target)
+        
+        removed = cache.invalidate('source.png')
+        
+        self.assertEquals([self.target, self.tmp_dir + '/cache/source.thumb.png'], removed)
+        self.assertTrue(os.path.isfile(other_target))
+        self.assertTrue(os.path.isfile(self.source))
+    
+    def test_invalidate_should_remove_derivatives_found_in_index(self):
+        settings.RESIZE_CACHE_INDEX = self.tmp_dir + '/index.sqlite'
+        elsewhere = self.tmp_dir + '/elsewhere/source.100x100.png'
+        imagemagick.execute('cmd', self.source, elsewhere)
+        
+        self.assertEquals([elsewhere], cache.invalidate('source'))
+        self.assertFalse(os.path.isfile(elsewhere))
+
+class BatchRenderTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.source = settings.TEST_MEDIA_ROOT + '/test.png'
+        self.tmp_dir = tempfile.mkdtemp()
+        self.calls = []
+        self.old_check_call = subprocess.check_call
+        def mock_check_call(args):
+            self.calls.append(args)
+            for (i, arg) in enumerate(args):
+                if arg == '-write':
+                    open(args[i + 1], 'w').write('image')
+        subprocess.check_call = mock_check_call
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        subprocess.check_call = self.old_check_call
+    
+    def test_should_render_all_targets_with_one_imagemagick_call(self):
+        targets = [self.tmp_dir + '/a/test.100x100.png', self.tmp_dir + '/test.thumb.png']
+        rendered = imagemagick.execute_batch([(imagemagick.resize_command(100, 100), targets[0]), ('-trim', targets[1])], self.source)
+        
+        self.assertEquals(targets, rendered)
+        self.assertEquals(1, len(self.calls))
+        self.assertEquals(['convert', '-respect-parentheses', self.source, '(', '+clone', '-trim'], self.calls[0][:6])
+        self.assertEquals('null:', self.calls[0][-1])
+        for target in targets:
+            self.assertEquals('image', open(target).read())
+    
+    def test_should_skip_targets_that_already_exist(self):
+        target = self.tmp_dir + '/test.thumb.png'
+        open(target, 'w').write('cached')
+        self.assertEquals([], imagemagick.execute_batch([('-trim', target)], self.source))
+        self.assertEquals([], self.calls)
+    
+    def test_should_render_to_same_paths_as_views(self):
+        from imageservice.management.commands import pregenerate_images
+        old_roots = (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT)
+        settings.MEDIA_ROOT = settings.TEST_MEDIA_ROOT
+        settings.MEDIA_CACHE_ROOT = self.tmp_dir
+        try:
+            (source, rendered, error) = pregenerate_images.pregenerate(('test.png', [(100, 200)], [('TEST', '-trim')]))
+        finally:
+            (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT) = old_roots
+        
+        self.assertEquals(('test.png', 2, None), (source, rendered, error))
+        self.assertTrue(os.path.isfile(self.tmp_dir + '/test.100x200.png'))
+        self.assertTrue(os.path.isfile(self.tmp_dir + '/test.TEST.png'))
+    
+    def test_should_render_animations_frame_by_frame(self):
+        from imageservice.management.commands import pregenerate_images
+        old_roots = (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT)
+        settings.MEDIA_ROOT = self.tmp_dir + '/media'
+        settings.MEDIA_CACHE_ROOT = self.tmp_dir + '/cache'
+        os.makedirs(settings.MEDIA_ROOT)
+        open(settings.MEDIA_ROOT + '/animated.gif', 'wb').write(gif(40, 30, 3))
+        probe._cache.clear()
+        try:
+            (source, rendered, error) = pregenerate_images.pregenerate(('animated.gif', [(20, 20)], [('TEST', '-trim')]))
+        finally:
+            (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT) = old_roots
+        
+        self.assertEquals(('animated.gif', 2, None), (source, rendered, error))
+        self.assertEquals(2, len(self.calls))
+        self.assertTrue(all('-coalesce' in args and self.tmp_dir + '/media/animated.gif' in args for args in self.calls), self.calls)
+    
+    def test_should_find_sources_below_media_root(self):
+        from imageservice.management.commands import pregenerate_images
+        self.assertEquals(['Case.PNG', 'test.png'], sorted(pregenerate_images.find_sources(settings.TEST_MEDIA_ROOT)))
+
+class SourceIndexTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        open(self.tmp_dir + '/image.JPG', 'w').close()
+        self.old_listdir = os.listdir
+        self.listings = []
+        def counting_listdir(dir):
+            self.listings.append(dir)
+            return self.old_listdir(dir)
+        os.listdir = counting_listdir
+    
+    def tearDown(self):
+        os.listdir = self.old_listdir
+        shutil.rmtree(self.tmp_dir)
+        if hasattr(settings, 'RESIZE_SOURCE_INDEX'):
+            del settings.RESIZE_SOURCE_INDEX
+    
+    def test_should_be_disabled_by_default(self):
+        self.assertEquals(None, sourceindex.get_index())
+    
+    def test_should_find_first_existing_file_with_one_directory_listing(self):
+        index = sourceindex.SourceIndex()
+        candidates = [self.tmp_dir + '/image.png', self.tmp_dir + '/image.jpg', self.tmp_dir + '/image.JPG']
+        self.assertEquals(self.tmp_dir + '/image.JPG', index.first_existing(candidates))
+        self.assertEquals([self.tmp_dir], self.listings)
+    
+    def test_should_reuse_listing_while_directory_is_unchanged(self):
+        index = sourceindex.SourceIndex()
+        self.assertFalse(index.exists(self.tmp_dir + '/missing.png'))
+        self.assertFalse(index.exists(self.tmp_dir + '/missing.png'))
+        self.assertEquals(1, len(self.listings))
+    
+    def test_should_read_listing_again_when_directory_is_modified(self):
+        index = sourceindex.SourceIndex()
+        self.assertFalse(index.exists(self.tmp_dir + '/new.png'))
+        open(self.tmp_dir + '/new.png', 'w').close()
+        os.utime(self.tmp_dir, (time.time() + 10, time.time() + 10))
+        self.assertTrue(index.exists(self.tmp_dir + '/new.png'))
+    
+    def test_should_trust_listing_during_ttl(self):
+        index = sourceindex.SourceIndex(ttl=60)
+        index.exists(self.tmp_dir + '/new.png')
+        open(self.tmp_dir + '/new.png', 'w').close()
+        os.utime(self.tmp_dir, (time.time() + 10, time.time() + 10))
+        self.assertFalse(index.exists(self.tmp_dir + '/new.png'))
+    
+    def test_should_treat_missing_directory_as_empty(self):
+        self.assertFalse(sourceindex.SourceIndex().exists(self.tmp_dir + '/missing/image.png'))
+    
+    def test_should_be_used_to_guess_extension_of_source(self):
+        settings.RESIZE_SOURCE_INDEX = True
+        self.assertEquals(self.tmp_dir + '/image.JPG', imagemagick._findAndVerifySource(self.tmp_dir + '/image'))
+        self.assertEquals([self.tmp_dir], self.listings)
+    
+    @raises(IOError)
+    def test_should_raise_exception_for_missing_source(self):
+        settings.RESIZE_SOURCE_INDEX = True
+        imagemagick._findAndVerifySource(self.tmp_dir + '/missing.png')
+
+class PillowBackendTest(unittest.TestCase):
+    
+    def setUp(self):
+        try:
+            from imageservice import pillow_backend
+            from PIL import Image
+        except ImportError:
+            raise SkipTest("Pillow is not installed")
+        self.pillow_backend = pillow_backend
+        self.Image = Image
+        self.backend = backends.get_backend('pillow')
+        self.source = settings.TEST_MEDIA_ROOT + '/test.png'
+        self.tmp_dir = tempfile.mkdtemp()
+        self.target = self.tmp_dir + '/target.png'
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        for name in ('RESIZE_BACKEND', 'RESIZE_TEMPLATE_BACKENDS'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def test_should_resize_to_exactly_the_given_size(self):
+        self.backend.render(imagemagick.resize_command(100, 300), self.source, self.target)
+        image = self.Image.open(self.target)
+        self.assertEquals((100, 300), image.size)
+        self.assertEquals('PNG', image.format)
+    
+    def test_should_pad_with_white(self):
+        self.backend.render(imagemagick.resize_command(100, 300), self.source, self.target)
+        self.assertEquals((255, 255, 255), self.Image.open(self.target).convert('RGB').getpixel((50, 0)))
+    
+    def test_should_trim_borders_with_color_of_top_left_pixel(self):
+        image = self.Image.new('RGB', (100, 80), 'white')
+        image.paste((255, 0, 0), (10, 20, 40, 30))
+        self.assertEquals((30, 10), self.pillow_backend.trim(image).size)
+    
+    def test_should_trim_bordered_jpegs_before_decoding_at_reduced_size(self):
+        bordered = self.Image.new('RGB', (2000, 2000), 'white')
+        bordered.paste(self.Image.new('RGB', (500, 500), 'black'), (750, 750))
+        bordered.save(self.tmp_dir + '/bordered.jpeg', 'JPEG')
+        self.backend.render(imagemagick.resize_command(200, 200), self.tmp_dir + '/bordered.jpeg', self.target)
+        subject = self.Image.open(self.target).convert('L').point(lambda value: value < 128 and 255 or 0).getbbox()
+        self.assertTrue(subject[2] - subject[0] >= 195, subject)
+        self.assertTrue(subject[3] - subject[1] >= 195, subject)
+    
+    def test_should_not_enlarge_when_only_shrinking(self):
+        image = self.Image.new('RGB', (100, 80))
+        self.assertEquals((100, 80), self.pillow_backend.fit(image, (200, 200, True)).size)
+        self.assertEquals((200, 160), self.pillow_backend.fit(image, (200, 200, False)).size)
+    
+    @raises(backends.UnsupportedCommand)
+    def test_should_not_support_arbitrary_commands(self):
+        self.backend.render('-matte  -fill  none', self.source, self.target)
+    
+    @raises(backends.UnsupportedCommand)
+    def test_should_not_write_formats_pillow_can_not_encode(self):
+        self.Image.init()
+        if '.avif' in self.Image.EXTENSION:
+            raise SkipTest("Pillow supports AVIF")
+        self.backend.render(imagemagick.resize_command(10, 10), self.source, self.tmp_dir + '/target.png.avif')
+    
+    def test_execute_should_fall_back_to_imagemagick_for_unsupported_commands(self):
+        calls = []
+        old_callImageMagick = imagemagick._callImageMagick
+        imagemagick._callImageMagick = lambda command, src, target: calls.append(command)
+        try:
+            imagemagick.execute('-matte', self.source, self.target, 'pillow')
+        finally:
+            imagemagick._callImageMagick = old_callImageMagick
+        self.assertEquals(['-matte'], calls)
+    
+    def test_should_select_backend_per_template(self):
+        settings.RESIZE_BACKEND = 'pillow'
+        settings.RESIZE_TEMPLATE_BACKENDS = {'fancy': 'imagemagick'}
+        self.assertEquals('pillow', backends.backend_name())
+        self.assertEquals('pillow', backends.backend_name('plain'))
+        self.assertEquals('imagemagick', backends.backend_name('fancy'))
+
+class AdmissionTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        settings.RESIZE_RENDER_SLOTS_DIR = self.tmp_dir
+        settings.RESIZE_MAX_CONCURRENT_RENDERS = 1
+        settings.RESIZE_RENDER_QUEUE_TIMEOUT = 0.1
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        for name in ('RESIZE_RENDER_SLOTS_DIR', 'RESIZE_MAX_CONCURRENT_RENDERS', 'RESIZE_RENDER_QUEUE_TIMEOUT', 
+                     'RESIZE_RENDER_QUEUE_SIZE', 'RESIZE_IMAGEMAGICK_LIMITS'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def test_should_not_limit_renders_by_default(self):
+        del settings.RESIZE_MAX_CONCURRENT_RENDERS
+        with admission.render_slot():
+            with admission.render_slot():
+                pass
+    
+    def test_should_free_slot_after_render(self):
+        with admission.render_slot():
+            pass
+        with admission.render_slot():
+            pass
+    
+    @raises(admission.RenderQueueTimeout)
+    def test_should_time_out_if_all_slots_are_taken(self):
+        with admission.render_slot():
+            with admission.render_slot():
+                pass
+    
+    @raises(admission.RenderQueueFull)
+    def test_should_refuse_to_wait_if_queue_is_full(self):
+        settings.RESIZE_RENDER_QUEUE_SIZE = 0
+        with admission.render_slot():
+            with admission.render_slot():
+                pass
+    
+    def test_should_pass_resource_limits_to_imagemagick(self):
+        settings.RESIZE_IMAGEMAGICK_LIMITS = {'memory': '256MiB', 'thread': 1}
+        self.assertEquals(['-limit', 'memory', '256MiB', '-limit', 'thread', '1'], admission.imagemagick_limits())
+    
+    def test_view_should_answer_service_unavailable_if_renderer_is_busy(self):
+        def busy_resize(source_file, target_file, width, height):
+            raise admission.RenderQueueFull
+        old_resize = imagemagick.resize
+        imagemagick.resize = busy_resize
+        try:
+            result = views.resize_image(None, "hello", "100", "100", ".png")
+        finally:
+            imagemagick.resize = old_resize
+        self.assertEquals(503, result.status_code)
+        self.assertEquals('5', result['Retry-After'])
+
+class RecordingSink(object):
+    """ Metrics sink for tests, configured as 'imageservice.tests.RecordingSink'. """
+    records = []
+    
+    def incr(self, name, value, tags):
+        self.records.append(('counter', name, value, tags))
+    
+    def timing(self, name, seconds, tags):
+        self.records.append(('timing', name, seconds, tags))
+
+class MetricsTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        RecordingSink.records = []
+        metrics.registry = metrics.Registry()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        for name in ('RESIZE_METRICS_SINKS', 'RESIZE_STATSD_PORT'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def test_should_do_nothing_without_sinks(self):
+        self.assertFalse(metrics.enabled())
+        metrics.incr('cache', result='hit')
+        with metrics.timer('render_seconds'):
+            pass
+    
+    def test_should_send_signal(self):
+        settings.RESIZE_METRICS_SINKS = ('imageservice.metrics.SignalSink',)
+        received = []
+        def receiver(sender, name, kind, value, tags, **kwargs):
+            received.append((name, kind, value, tags))
+        signals.metric.connect(receiver)
+        try:
+            metrics.incr('cache', result='hit', label=None)
+        finally:
+            signals.metric.disconnect(receiver)
+        self.assertEquals([('cache', 'counter', 1, {'result': 'hit'})], received)
+    
+    def test_should_send_statsd_lines(self):
+        import socket
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        settings.RESIZE_STATSD_PORT = server.getsockname()[1]
+        settings.RESIZE_METRICS_SINKS = ('imageservice.metrics.StatsdSink',)
+        try:
+            metrics.incr('cache', result='miss')
+            metrics.timing('render_seconds', 0.25, backend='pillow')
+            self.assertEquals('imageservice.cache:1|c|#result:miss', server.recv(1024))
+            self.assertEquals('imageservice.render_seconds:250.000|ms|#backend:pillow', server.recv(1024))
+        finally:
+            server.close()
+    
+    def test_should_render_prometheus_text(self):
+        settings.RESIZE_METRICS_SINKS = ('imageservice.metrics.PrometheusSink',)
+        metrics.incr('cache', result='hit')
+        metrics.incr('cache', result='hit')
+        metrics.timing('render_seconds', 0.3, label='thumb')
+        text = views.prometheus_metrics(HttpRequest()).content
+        self.assertTrue('imageservice_cache_total{result="hit"} 2\n' in text)
+        self.assertTrue('imageservice_render_seconds_bucket{label="thumb",le="0.25"} 0\n' in text)
+        self.assertTrue('imageservice_render_seconds_bucket{label="thumb",le="0.5"} 1\n' in text)
+        self.assertTrue('imageservice_render_seconds_bucket{label="thumb",le="+Inf"} 1\n' in text)
+        self.assertTrue('imageservice_render_seconds_count{label="thumb"} 1\n' in text)
+    
+    def test_should_write_type_once_per_metric(self):
+        settings.RESIZE_METRICS_SINKS = ('imageservice.metrics.PrometheusSink',)
+        metrics.incr('cache', result='hit')
+        metrics.incr('cache', result='miss')
+        metrics.timing('render_seconds', 0.3, label='thumb')
+        metrics.timing('render_seconds', 0.3, label='card')
+        text = metrics.registry.render()
+        self.assertEquals(1, text.count('# TYPE imageservice_cache_total counter\n'))
+        self.assertEquals(1, text.count('# TYPE imageservice_render_seconds histogram\n'))
+        self.assertTrue(text.index('# TYPE imageservice_cache_total') < text.index('imageservice_cache_total{result="hit"}'))
+    
+    def test_execute_should_count_misses_and_hits(self):
+        settings.RESIZE_METRICS_SINKS = ('imageservice.tests.RecordingSink',)
+        source = os.path.join(self.tmp_dir, 'source.png')
+        target = os.path.join(self.tmp_dir, 'cache', 'target.png')
+        open(source, 'w').write('image')
+        old_callImageMagick = imagemagick._callImageMagick
+        imagemagick._callImageMagick = lambda command, src, target: open(target, 'w').write('resized')
+        try:
+            imagemagick.execute('-trim', source, target, 'imagemagick', label='thumb')
+            imagemagick.execute('-trim', source, target, 'imagemagick', label='thumb')
+        finally:
+            imagemagick._callImageMagick = old_callImageMagick
+        
+        counters = [(name, tags) for (kind, name, value, tags) in RecordingSink.records if kind == 'counter']
+        self.assertEquals([('cache', {'result': 'miss'}), ('cache', {'result': 'hit'})], counters)
+        timings = [(name, tags) for (kind, name, value, tags) in RecordingSink.records if kind == 'timing']
+        self.assertTrue(('render_seconds', {'label': 'thumb', 'backend': 'imagemagick'}) in timings)
+    
+    def test_should_bucket_sizes(self):
+        self.assertEquals('<=256', metrics.size_bucket(200, 100))
+        self.assertEquals('>2048', metrics.size_bucket(100, 4000))
+
+class TracingTest(unittest.TestCase):
+    
+    def setUp(self):
+        settings.RESIZE_TRACING = True
+        self.old_resize = imagemagick.resize
+        self.old_render_image_to_response = views.render_image_to_response
+        def mock_resize(source_file, target_file, width, height):
+            with tracing.phase('convert'):
+                pass
+        imagemagick.resize = mock_resize
+        views.render_image_to_response = lambda file_name, request=None, cache_key=None: HttpResponse('image')
+    
+    def tearDown(self):
+        imagemagick.resize = self.old_resize
+        views.render_image_to_response = self.old_render_image_to_response
+        for name in ('RESIZE_TRACING', 'RESIZE_TRACING_LOG'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def test_should_not_trace_by_default(self):
+        del settings.RESIZE_TRACING
+        with tracing.trace() as trace:
+            with tracing.phase('source'):
+                pass
+        self.assertEquals(None, trace)
+        self.assertFalse(views.resize_image(HttpRequest(), 'hello', '100', '100', '.png').has_header('Server-Timing'))
+    
+    def test_should_add_up_phases_in_order(self):
+        with tracing.trace() as trace:
+            with tracing.phase('lookup'):
+                pass
+            with tracing.phase('source'):
+                time.sleep(0.01)
+            with tracing.phase('lookup'):
+                pass
+        self.assertEquals(['lookup', 'source'], trace.phases)
+        self.assertTrue(trace.duration('source') >= 0.01)
+        self.assertEquals(['lookup', 'source', 'total'], [entry.split(';')[0] for entry in trace.server_timing().split(', ')])
+    
+    def test_view_should_send_server_timing_header(self):
+        response = views.resize_image(HttpRequest(), 'hello', '100', '100', '.png')
+        timing = response['Server-Timing']
+        self.assertTrue(timing.startswith('parse;dur='), timing)
+        self.assertTrue(', convert;dur=' in timing, timing)
+    
+    def test_should_log_phases(self):
+        import logging
+        settings.RESIZE_TRACING_LOG = True
+        messages = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                messages.append(record.getMessage())
+        handler = Handler()
+        tracing.logger.addHandler(handler)
+        tracing.logger.setLevel(logging.INFO)
+        request = HttpRequest()
+        request.method = 'GET'
+        request.path = '/hello.100x100.png'
+        try:
+            views.resize_image(request, 'hello', '100', '100', '.png')
+        finally:
+            tracing.logger.removeHandler(handler)
+        self.assertEquals(1, len(messages))
+        self.assertTrue(messages[0].startswith('method=GET path=/hello.100x100.png status=200 parse='), messages[0])
+
+class FormatNegotiationTest(unittest.TestCase):
+    
+    def setUp(self):
+        settings.RESIZE_NEGOTIATE_FORMATS = ('avif', 'webp')
+        formats._failures.clear()
+        self.rendered = []
+        self.old_resize = imagemagick.resize
+        self.old_render_image_to_response = views.render_image_to_response
+        def mock_resize(source_file, target_file, width, height):
+            if target_file.endswith('.avif'):
+                raise subprocess.CalledProcessError(1, 'convert')
+            self.rendered.append(target_file)
+        imagemagick.resize = mock_resize
+        views.render_image_to_response = lambda file_name, request=None, cache_key=None: HttpResponse(file_name)
+    
+    def tearDown(self):
+        imagemagick.resize = self.old_resize
+        views.render_image_to_response = self.old_render_image_to_response
+        for name in ('RESIZE_NEGOTIATE_FORMATS', 'RESIZE_FORMAT_OPTIONS', 'RESIZE_FORMAT_RETRY_INTERVAL'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def make_request(self, accept):
+        request = HttpRequest()
+        request.META['HTTP_ACCEPT'] = accept
+        return request
+    
+    def test_should_not_negotiate_by_default(self):
+        del settings.RESIZE_NEGOTIATE_FORMATS
+        self.assertEquals(None, formats.negotiate(self.make_request('image/webp'), 'photo.png'))
+    
+    def test_should_pick_first_accepted_variant(self):
+        self.assertEquals('photo.png.avif', formats.negotiate(self.make_request('image/avif,image/webp,*/*;q=0.8'), 'photo.png'))
+        self.assertEquals('photo.png.webp', formats.negotiate(self.make_request('image/avif;q=0,image/webp'), 'photo.png'))
+    
+    def test_should_not_negotiate_wildcards_or_same_format(self):
+        self.assertEquals(None, formats.negotiate(self.make_request('image/*,*/*'), 'photo.png'))
+        self.assertEquals(None, formats.negotiate(self.make_request('image/webp'), 'photo.webp'))
+        self.assertEquals(None, formats.negotiate(None, 'photo.png'))
+    
+    def test_should_render_variant_and_vary_on_accept(self):
+        response = views.resize_image(self.make_request('image/webp'), 'photo', '100', '100', '.png')
+        target = settings.MEDIA_CACHE_ROOT + '/photo.100x100.png.webp'
+        self.assertEquals([target], self.rendered)
+        self.assertEquals(target, response.content)
+        self.assertEquals('Accept', response['Vary'])
+    
+    def test_should_fall_back_to_original_format_if_variant_fails(self):
+        response = views.resize_image(self.make_request('image/avif'), 'photo', '100', '100', '.png')
+        target = settings.MEDIA_CACHE_ROOT + '/photo.100x100.png'
+        self.assertEquals([target], self.rendered)
+        self.assertEquals('Accept', response['Vary'])
+    
+    def test_should_try_next_variant_and_skip_failed_format(self):
+        request = self.make_request('image/avif,image/webp')
+        target = settings.MEDIA_CACHE_ROOT + '/photo.100x100.png.webp'
+        self.assertEquals(target, views.resize_image(request, 'photo', '100', '100', '.png').content)
+        self.assertEquals(['photo.png.webp'], formats.variants(request, 'photo.png'))
+        settings.RESIZE_FORMAT_RETRY_INTERVAL = 0
+        self.assertEquals(['photo.png.avif', 'photo.png.webp'], formats.variants(request, 'photo.png'))
+    
+    def test_should_append_encoder_options_per_format(self):
+        settings.RESIZE_FORMAT_OPTIONS = {'jpg': {'quality': 85, 'strip': True, 'interlace': True},
+                                          'webp': {'quality': 75, 'defines': {'webp:method': 6}}}
+        self.assertEquals('-trim  -strip  -interlace  Plane  -quality  85', formats.output_command('-trim', 'a.jpeg'))
+        self.assertEquals('-trim  -quality  75  -define  webp:method=6', formats.output_command('-trim', 'a.png.webp'))
+        self.assertEquals('-trim', formats.output_command('-trim', 'a.png'))
+
+class HotCacheTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image = os.path.join(self.tmp_dir, 'image.png')
+        open(self.image, 'w').write('small image')
+        settings.RESIZE_HOT_CACHE_BYTES = 100
+        settings.RESIZE_HOT_CACHE_MAX_ENTRY_BYTES = 50
+        hotcache._cache = None
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        for name in ('RESIZE_HOT_CACHE_BYTES', 'RESIZE_HOT_CACHE_MAX_ENTRY_BYTES', 'RESIZE_HOT_CACHE_TTL', 'RESIZE_CACHE_INDEX'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def make_request(self):
+        request = HttpRequest()
+        request.method = 'GET'
+        return request
+    
+    def test_should_be_disabled_by_default(self):
+        del settings.RESIZE_HOT_CACHE_BYTES
+        self.assertEquals(None, hotcache.get_cache())
+    
+    def test_should_evict_least_recently_used_entries(self):
+        cache = hotcache.get_cache()
+        stat = os.stat(self.image)
+        for name in ('a', 'b'):
+            cache.put(name, 'x' * 40, stat)
+        cache.fresh('a')
+        cache.put('c', 'x' * 40, stat)
+        self.assertEquals(['a', 'c'], sorted(cache.entries))
+        self.assertEquals(80, cache.bytes)
+    
+    def test_should_not_keep_large_images(self):
+        cache = hotcache.get_cache()
+        self.assertEquals(None, cache.put('large', 'x' * 51, os.stat(self.image)))
+        self.assertEquals({}, cache.entries)
+    
+    def test_should_serve_hot_images_without_touching_the_disk(self):
+        response = views.render_image_to_response(self.image, self.make_request())
+        os.remove(self.image)
+        hot_response = views.render_image_to_response(self.image, self.make_request())
+        self.assertEquals('small image', hot_response.content)
+        self.assertEquals(response['ETag'], hot_response['ETag'])
+        self.assertEquals(response['Last-Modified'], hot_response['Last-Modified'])
+    
+    def test_should_compare_entries_with_file_after_ttl(self):
+        settings.RESIZE_HOT_CACHE_TTL = 0
+        views.render_image_to_response(self.image, self.make_request())
+        time.sleep(0.01)
+        os.remove(self.image)
+        open(self.image, 'w').write('new image')
+        self.assertEquals('new image', views.render_image_to_response(self.image, self.make_request()).content)
+    
+    def test_should_record_hot_hits_in_cache_index_once_per_ttl(self):
+        settings.RESIZE_CACHE_INDEX = self.tmp_dir + '/index.sqlite'
+        index = cacheindex.get_index()
+        index.add(self.image, None)
+        views.render_image_to_response(self.image, self.make_request())
+        hotcache.get_cache().entries[self.image].touched -= 100
+        for i in range(3):
+            views.render_image_to_response(self.image, self.make_request())
+        self.assertEquals(1, index._connection().execute("SELECT hits FROM entries").fetchone()[0])
+    
+    def test_should_forget_invalidated_images(self):
+        old_roots = (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT)
+        (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT) = (self.tmp_dir + '/media', self.tmp_dir)
+        try:
+            views.render_image_to_response(self.image, self.make_request())
+            cache.invalidate('image.png')
+        finally:
+            (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT) = old_roots
+        self.assertEquals({}, hotcache.get_cache().entries)
+    
+    def test_view_should_not_render_hot_images(self):
+        old_resize = imagemagick.resize
+        old_render_image_to_response = views.render_image_to_response
+        calls = []
+        imagemagick.resize = lambda source_file, target_file, width, height: calls.append(target_file)
+        views.render_image_to_response = lambda file_name, request=None, cache_key=None: HttpResponse(file_name)
+        target = settings.MEDIA_CACHE_ROOT + '/image.100x100.png'
+        hotcache.get_cache().put(target, 'small image', os.stat(self.image))
+        try:
+            views.resize_image(self.make_request(), 'image', '100', '100', '.png')
+        finally:
+            imagemagick.resize = old_resize
+            views.render_image_to_response = old_render_image_to_response
+        self.assertEquals([], calls)
+
+class StorageTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_roots = (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT)
+        settings.MEDIA_ROOT = self.tmp_dir + '/media'
+        settings.MEDIA_CACHE_ROOT = self.tmp_dir + '/cache'
+        for name in ('remote', 'shared'):
+            os.makedirs(os.path.join(self.tmp_dir, name))
+        settings.RESIZE_SOURCE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+        settings.RESIZE_SOURCE_STORAGE_OPTIONS = {'location': self.tmp_dir + '/remote'}
+        settings.RESIZE_SHARED_CACHE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+        settings.RESIZE_SHARED_CACHE_STORAGE_OPTIONS = {'location': self.tmp_dir + '/shared'}
+        open(self.tmp_dir + '/remote/photo.png', 'w').write('source')
+        storage._missing.clear()
+        self.renders = []
+        self.old_callImageMagick = imagemagick._callImageMagick
+        def mock_callImageMagick(command, src, target):
+            self.renders.append(src)
+            open(target, 'w').write('rendered ' + open(src).read())
+        imagemagick._callImageMagick = mock_callImageMagick
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT) = self.old_roots
+        imagemagick._callImageMagick = self.old_callImageMagick
+        storage._missing.clear()
+        sourceindex._index = None
+        for name in ('RESIZE_SOURCE_STORAGE', 'RESIZE_SOURCE_STORAGE_OPTIONS', 
+                     'RESIZE_SHARED_CACHE_STORAGE', 'RESIZE_SHARED_CACHE_STORAGE_OPTIONS',
+                     'RESIZE_SOURCE_STORAGE_MISS_TTL', 'RESIZE_SOURCE_INDEX', 'RESIZE_SOURCE_INDEX_TTL'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def execute(self, target='photo.thumb.png'):
+        imagemagick.execute('-trim', settings.MEDIA_ROOT + '/photo', settings.MEDIA_CACHE_ROOT + '/' + target, 'imagemagick')
+    
+    def make_render(self, content):
+        if not os.path.isdir(settings.MEDIA_CACHE_ROOT):
+            os.makedirs(settings.MEDIA_CACHE_ROOT)
+        target = settings.MEDIA_CACHE_ROOT + '/photo.thumb.png'
+        open(target, 'w').write(content)
+        return target
+    
+    def test_should_use_local_files_without_storages(self):
+        for name in ('RESIZE_SOURCE_STORAGE', 'RESIZE_SHARED_CACHE_STORAGE'):
+            delattr(settings, name)
+        self.assertEquals(None, storage.stage_source([settings.MEDIA_ROOT + '/photo.png']))
+        self.assertFalse(storage.fetch_render(settings.MEDIA_CACHE_ROOT + '/photo.thumb.png'))
+    
+    def test_should_stage_source_once(self):
+        self.execute()
+        self.execute('photo.other.png')
+        self.assertEquals([settings.MEDIA_ROOT + '/photo.png'] * 2, self.renders)
+        self.assertEquals('source', open(settings.MEDIA_ROOT + '/photo.png').read())
+    
+    def test_should_remember_sources_missing_in_storage(self):
+        lookups = []
+        source_storage = storage.source_storage()
+        old_exists = source_storage.exists
+        source_storage.exists = lambda name: lookups.append(name) or old_exists(name)
+        try:
+            for _ in range(2):
+                self.assertRaises(IOError, imagemagick._findAndVerifySource, settings.MEDIA_ROOT + '/missing')
+            self.assertEquals(len(imagemagick.exts) * 2, len(lookups))
+            settings.RESIZE_SOURCE_STORAGE_MISS_TTL = 0
+            storage._missing.clear()
+            self.assertRaises(IOError, imagemagick._findAndVerifySource, settings.MEDIA_ROOT + '/missing')
+            self.assertRaises(IOError, imagemagick._findAndVerifySource, settings.MEDIA_ROOT + '/missing')
+            self.assertEquals(len(imagemagick.exts) * 2 * 3, len(lookups))
+        finally:
+            source_storage.exists = old_exists
+    
+    def test_should_find_staged_source_in_source_index(self):
+        settings.RESIZE_SOURCE_INDEX = True
+        settings.RESIZE_SOURCE_INDEX_TTL = 60
+        downloads = []
+        old_download = storage._download
+        storage._download = lambda *args: downloads.append(args) or old_download(*args)
+        try:
+            for _ in range(2):
+                self.assertEquals(settings.MEDIA_ROOT + '/photo.png', imagemagick._firstExistingSource([settings.MEDIA_ROOT + '/photo.png']))
+        finally:
+            storage._download = old_download
+        self.assertEquals(1, len(downloads))
+    
+    def test_should_not_stage_source_staged_meanwhile(self):
+        source = settings.MEDIA_ROOT + '/photo.png'
+        downloads = []
+        old_download = storage._download
+        storage._download = lambda *args: downloads.append(args) or old_download(*args)
+        source_storage = storage.source_storage()
+        old_exists = source_storage.exists
+        def exists(name): # Another process stages the source while this one waits for the lock
+            os.makedirs(settings.MEDIA_ROOT)
+            open(source, 'w').write('staged elsewhere')
+            return True
+        source_storage.exists = exists
+        try:
+            self.assertEquals(source, storage.stage_source([source]))
+        finally:
+            storage._download = old_download
+            source_storage.exists = old_exists
+        self.assertEquals([], downloads)
+        self.assertEquals('staged elsewhere', open(source).read())
+    
+    def test_should_publish_renders(self):
+        self.execute()
+        self.assertEquals('rendered source', open(self.tmp_dir + '/shared/photo.thumb.png').read())
+    
+    def test_should_fetch_renders_of_other_hosts(self):
+        open(self.tmp_dir + '/shared/photo.thumb.png', 'w').write('rendered elsewhere')
+        self.execute()
+        self.assertEquals([], self.renders)
+        self.assertEquals('rendered elsewhere', open(settings.MEDIA_CACHE_ROOT + '/photo.thumb.png').read())
+        self.assertFalse(os.path.exists(settings.MEDIA_ROOT + '/photo.png'))
+    
+    def test_should_replace_published_render(self):
+        storage.publish_render(self.make_render('old'))
+        storage.publish_render(self.make_render('new'))
+        self.assertEquals(['photo.thumb.png'], os.listdir(self.tmp_dir + '/shared'))
+        self.assertEquals('new', open(self.tmp_dir + '/shared/photo.thumb.png').read())
+    
+    def test_invalidate_should_remove_shared_renders_and_staged_source(self):
+        self.execute()
+        removed = cache.invalidate('photo.png')
+        self.assertEquals([settings.MEDIA_CACHE_ROOT + '/photo.thumb.png'], removed)
+        self.assertEquals([], os.listdir(self.tmp_dir + '/shared'))
+        self.assertFalse(os.path.exists(settings.MEDIA_ROOT + '/photo.png'))
+
+class SizeBucketTest(unittest.TestCase):
+    
+    def setUp(self):
+        settings.RESIZE_SIZE_BUCKETS = ('640x480', (100, 100), (320, 240))
+        self.resized = []
+        self.old_resize = imagemagick.resize
+        self.old_render_image_to_response = views.render_image_to_response
+        imagemagick.resize = lambda source_file, target_file, width, height: self.resized.append((target_file, width, height))
+        views.render_image_to_response = lambda file_name, request=None, cache_key=None: HttpResponse(file_name)
+    
+    def tearDown(self):
+        imagemagick.resize = self.old_resize
+        views.render_image_to_response = self.old_render_image_to_response
+        for name in ('RESIZE_SIZE_BUCKETS', 'RESIZE_SIZE_BUCKET_MODE'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def make_request(self, path):
+        request = HttpRequest()
+        request.path = path
+        return request
+    
+    def test_should_pick_smallest_bucket_that_fits(self):
+        self.assertEquals((320, 240), renditions.bucket(317, 211))
+        self.assertEquals((100, 100), renditions.bucket(100, 100))
+        self.assertEquals((640, 480), renditions.bucket(800, 100))
+        del settings.RESIZE_SIZE_BUCKETS
+        self.assertEquals((317, 211), renditions.bucket(317, 211))
+    
+    def test_should_snap_to_bucket(self):
+        views.resize_image(self.make_request('/images/foo.317x211.png'), 'foo', '317', '211', '.png')
+        self.assertEquals([(settings.MEDIA_CACHE_ROOT + '/foo.320x240.png', 320, 240)], self.resized)
+    
+    def test_should_redirect_to_bucket(self):
+        settings.RESIZE_SIZE_BUCKET_MODE = 'redirect'
+        response = views.resize_image(self.make_request('/images/foo.317x211.png'), 'foo', '317', '211', '.png')
+        self.assertEquals(302, response.status_code)
+        self.assertEquals('/images/foo.320x240.png', response['Location'])
+        self.assertEquals('max-age=3600', response['Cache-Control'])
+        self.assertEquals([], self.resized)
+
+class RenditionChainTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_roots = (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT)
+        (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT) = (settings.TEST_MEDIA_ROOT, self.tmp_dir)
+        settings.RESIZE_RENDITION_LEVELS = (1024, 256)
+        self.calls = []
+        self.old_callImageMagick = imagemagick._callImageMagick
+        def mock_callImageMagick(command, src, target):
+            self.calls.append((command.split('  ')[:2], os.path.basename(src)))
+            open(target, 'w').write('image')
+        imagemagick._callImageMagick = mock_callImageMagick
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT) = self.old_roots
+        imagemagick._callImageMagick = self.old_callImageMagick
+        for name in ('RESIZE_RENDITION_LEVELS', 'RESIZE_CACHE_INDEX', 'RESIZE_CHECK_SOURCE'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def resize(self, width, height):
+        imagemagick.resize(settings.MEDIA_ROOT + '/test.png', '%s/test.%dx%d.png' % (self.tmp_dir, width, height), width, height, 'imagemagick')
+    
+    def test_should_serve_cached_sizes_without_intermediates_or_source(self):
+        self.resize(100, 100)
+        os.remove(self.tmp_dir + '/test.chain-256.png')
+        self.calls = []
+        old_render_slot = admission.render_slot
+        admission.render_slot = None # Hits must not wait for a render slot
+        try:
+            self.resize(100, 100)
+            imagemagick.resize(settings.MEDIA_ROOT + '/deleted.png', self.tmp_dir + '/test.100x100.png', 100, 100, 'imagemagick')
+        finally:
+            admission.render_slot = old_render_slot
+        self.assertEquals([], self.calls)
+        self.assertFalse(os.path.exists(self.tmp_dir + '/test.chain-256.png'))
+    
+    def test_should_derive_sizes_from_trimmed_intermediate(self):
+        self.resize(100, 100)
+        self.resize(200, 150)
+        self.assertEquals([(['-trim', '-resize'], 'test.png'),
+                           (['-resize', '100x100>'], 'test.chain-256.png'),
+                           (['-resize', '200x150>'], 'test.chain-256.png')], self.calls)
+    
+    def test_should_derive_intermediate_from_nearest_larger_one(self):
+        self.resize(500, 500)
+        self.resize(100, 100)
+        self.assertEquals([(['-trim', '-resize'], 'test.png'),
+                           (['-resize', '500x500>'], 'test.chain-1024.png'),
+                           (['-resize', '256x256>'], 'test.chain-1024.png'),
+                           (['-resize', '100x100>'], 'test.chain-256.png')], self.calls)
+    
+    def test_should_resize_larger_images_from_source(self):
+        self.resize(2000, 100)
+        self.assertEquals([(['-trim', '-resize'], 'test.png')], self.calls)
+    
+    def test_should_record_derived_images_with_original_source_in_index(self):
+        settings.RESIZE_CACHE_INDEX = self.tmp_dir + '/index.sqlite'
+        settings.RESIZE_CHECK_SOURCE = True
+        self.resize(500, 500)
+        self.resize(100, 100)
+        self.calls = []
+        self.resize(100, 100)
+        self.assertEquals([], self.calls)
+        derivatives = cacheindex.get_index().derivatives(settings.MEDIA_ROOT + '/test.png')
+        self.assertEquals(['test.100x100.png', 'test.500x500.png', 'test.chain-1024.png', 'test.chain-256.png'],
+                          sorted(os.path.basename(path) for path in derivatives))
+
+class ProbeTest(unittest.TestCase):
+    
+    def setUp(self):
+        try:
+            from PIL import Image
+        except ImportError:
+            raise SkipTest("Pillow is not installed")
+        self.tmp_dir = tempfile.mkdtemp()
+        for (format, size) in (('JPEG', (300, 200)), ('GIF', (30, 20)), ('PNG', (3, 2))):
+            Image.new('RGB', size).save('%s/image.%s' % (self.tmp_dir, format.lower()), format)
+        open(self.tmp_dir + '/image.txt', 'w').write('no image')
+        probe._cache.clear()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        for name in ('RESIZE_MAX_SOURCE_PIXELS', 'RESIZE_JPEG_SIZE_HINT'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def test_should_read_size_from_header(self):
+        for (format, size) in (('JPEG', (300, 200)), ('GIF', (30, 20)), ('PNG', (3, 2))):
+            info = probe.probe('%s/image.%s' % (self.tmp_dir, format.lower()))
+            self.assertEquals((format, size), (info.format, (info.width, info.height)))
+        self.assertEquals(None, probe.probe(self.tmp_dir + '/image.txt'))
+    
+    def test_should_cache_results_until_file_changes(self):
+        image = self.tmp_dir + '/image.png'
+        probe.probe(image)
+        old_read_header = probe.read_header
+        probe.read_header = lambda f: None
+        try:
+            self.assertEquals(3, probe.probe(image).width)
+            os.remove(image)
+            shutil.copy(self.tmp_dir + '/image.gif', image)
+            self.assertEquals(None, probe.probe(image))
+        finally:
+            probe.read_header = old_read_header
+    
+    @raises(probe.SourceTooLarge)
+    def test_should_reject_sources_above_pixel_budget(self):
+        settings.RESIZE_MAX_SOURCE_PIXELS = 300 * 200 - 1
+        imagemagick.execute('-trim', self.tmp_dir + '/image.jpeg', self.tmp_dir + '/target.jpeg')
+    
+    def test_should_accept_sources_within_pixel_budget(self):
+        settings.RESIZE_MAX_SOURCE_PIXELS = 300 * 200
+        probe.check_pixel_budget(self.tmp_dir + '/image.jpeg')
+        probe.check_pixel_budget(self.tmp_dir + '/image.txt')
+    
+    def test_should_hint_jpeg_decoder_size(self):
+        jpeg = self.tmp_dir + '/image.jpeg'
+        self.assertEquals(['-define', 'jpeg:size=100x60'], probe.decode_hint(jpeg, imagemagick.resize_command(50, 30, False).split('  ')))
+        self.assertEquals([], probe.decode_hint(jpeg, imagemagick.resize_command(150, 100, False).split('  ')))
+        self.assertEquals([], probe.decode_hint(self.tmp_dir + '/image.png', ['-resize', '1x1']))
+        settings.RESIZE_JPEG_SIZE_HINT = None
+        self.assertEquals([], probe.decode_hint(jpeg, ['-resize', '10x10']))
+    
+    def test_should_not_hint_decoder_size_before_trim(self):
+        from PIL import Image
+        bordered = Image.new('RGB', (800, 800), 'white')
+        bordered.paste(Image.new('RGB', (200, 200), 'black'), (300, 300))
+        bordered.save(self.tmp_dir + '/bordered.jpeg', 'JPEG')
+        self.assertEquals([], probe.decode_hint(self.tmp_dir + '/bordered.jpeg', imagemagick.resize_command(50, 50).split('  ')))
+        self.assertEquals(['-define', 'jpeg:size=100x100'], 
+                          probe.decode_hint(self.tmp_dir + '/bordered.jpeg', imagemagick.resize_command(50, 50, False).split('  ')))
+    
+    def test_should_pass_decode_hint_to_imagemagick(self):
+        calls = []
+        old_check_call = subprocess.check_call
+        subprocess.check_call = lambda args: calls.append(args)
+        try:
+            imagemagick._callImageMagick('-resize  10x10', self.tmp_dir + '/image.jpeg', self.tmp_dir + '/target.jpeg')
+        finally:
+            subprocess.check_call = old_check_call
+        self.assertEquals(['convert', '-define', 'jpeg:size=20x20', self.tmp_dir + '/image.jpeg'], calls[0][:4])
+        self.assertEquals("-define jpeg:size=20x20 -read src.jpg -trim", workerpool.script('src.jpg', ['-trim'], 't.jpg', ['-define', 'jpeg:size=20x20'])[:43])
+
+class CacheLayoutTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_roots = (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT)
+        (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT) = (self.tmp_dir + '/media', self.tmp_dir + '/cache')
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT) = self.old_roots
+        for name in ('RESIZE_CACHE_LAYOUT', 'RESIZE_CACHE_FSYNC'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def create(self, path):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write('image')
+    
+    def test_should_mirror_media_root_by_default(self):
+        self.assertEquals(self.tmp_dir + '/cache/photos/cat.100x100.png', paths.resized_file('photos/cat', 100, 100, '.png'))
+    
+    def test_should_keep_derivatives_of_a_source_in_one_hashed_directory(self):
+        settings.RESIZE_CACHE_LAYOUT = 'hashed'
+        resized = paths.resized_file('photos/cat', 100, 100, '.png')
+        self.assertTrue(re.match(r'^%s/cache/[0-9a-f]{2}/[0-9a-f]{2}/photos/cat.100x100.png$' % self.tmp_dir, resized), resized)
+        self.assertEquals(os.path.dirname(resized), os.path.dirname(paths.template_file('photos/cat', 'thumb')))
+        self.assertEquals('photos/cat.100x100.png', paths.unshard(resized[len(settings.MEDIA_CACHE_ROOT) + 1:]))
+        self.assertEquals('ab/cd/cat.png', paths.unshard('ab/cd/cat.png'))
+    
+    def test_invalidate_should_find_hashed_derivatives(self):
+        settings.RESIZE_CACHE_LAYOUT = 'hashed'
+        self.create(paths.resized_file('photos/cat', 100, 100, '.png'))
+        self.assertEquals([paths.resized_file('photos/cat', 100, 100, '.png')], cache.invalidate('photos/cat.png'))
+    
+    def test_should_create_temp_file_next_to_target(self):
+        settings.RESIZE_CACHE_FSYNC = 'directory'
+        target = self.tmp_dir + '/target.png'
+        with imagemagick.temp_file(target) as temp:
+            self.assertEquals(self.tmp_dir, os.path.dirname(temp))
+            open(temp, 'w').write('image')
+        self.assertEquals(['target.png'], os.listdir(self.tmp_dir))
+    
+    def test_should_migrate_cache_between_layouts(self):
+        from StringIO import StringIO
+        from imageservice.management.commands.migrate_image_cache import Command
+        migrate = lambda **options: Command().execute(stdout=StringIO(), **options)
+        mirrored = [paths.resized_file('photos/cat', 100, 100, '.png'), paths.template_file('dog', 'thumb', '.jpg')]
+        for path in mirrored:
+            self.create(path)
+        settings.RESIZE_CACHE_LAYOUT = 'hashed'
+        hashed = [paths.resized_file('photos/cat', 100, 100, '.png'), paths.template_file('dog', 'thumb', '.jpg')]
+        
+        migrate()
+        self.assertEquals([True, True], [os.path.isfile(path) for path in hashed])
+        self.assertFalse(os.path.isdir(self.tmp_dir + '/cache/photos'))
+        
+        migrate(layout='mirror')
+        self.assertEquals([True, True], [os.path.isfile(path) for path in mirrored])
+
+class BackgroundRenderTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_settings = (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT, settings.MEDIA_URL)
+        settings.MEDIA_ROOT = self.tmp_dir + '/media'
+        settings.MEDIA_CACHE_ROOT = self.tmp_dir + '/cache'
+        settings.MEDIA_URL = '/media/'
+        settings.RESIZE_BACKGROUND_QUEUE = 'file'
+        settings.RESIZE_BACKGROUND_QUEUE_DIR = self.tmp_dir + '/queue'
+        os.makedirs(settings.MEDIA_ROOT)
+        open(settings.MEDIA_ROOT + '/photo.png', 'w').write('source')
+        self.resized = []
+        self.old_resize = imagemagick.resize
+        self.old_render_image_to_response = views.render_image_to_response
+        self.broken = ('broken',)
+        def mock_resize(source_file, target_file, width, height):
+            self.resized.append((source_file, target_file, width, height))
+            if 'busy' in target_file:
+                raise admission.RendererBusy()
+            if [name for name in self.broken if name in target_file]:
+                raise IOError("Broken image")
+        imagemagick.resize = mock_resize
+        views.render_image_to_response = lambda file_name, request=None, cache_key=None: HttpResponse(file_name)
+        background._failed.clear()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT, settings.MEDIA_URL) = self.old_settings
+        imagemagick.resize = self.old_resize
+        views.render_image_to_response = self.old_render_image_to_response
+        background._failed.clear()
+        for name in ('RESIZE_MISS_POLICY', 'RESIZE_BACKGROUND_QUEUE', 'RESIZE_BACKGROUND_QUEUE_DIR', 
+                     'RESIZE_PLACEHOLDER_IMAGE', 'RESIZE_MISS_MAX_AGE'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def request(self, name='photo'):
+        request = HttpRequest()
+        request.path = '/images/%s.100x100.png' % name
+        return views.resize_image(request, name, '100', '100', '.png')
+    
+    def queue(self):
+        return background.FileQueue(settings.RESIZE_BACKGROUND_QUEUE_DIR)
+    
+    def test_should_render_while_request_waits_by_default(self):
+        response = self.request()
+        self.assertEquals(settings.MEDIA_CACHE_ROOT + '/photo.100x100.png', response.content)
+        self.assertEquals(1, len(self.resized))
+        self.assertEquals(None, self.queue().claim())
+    
+    def test_should_redirect_to_source_and_queue_render(self):
+        settings.RESIZE_MISS_POLICY = 'redirect'
+        response = self.request()
+        self.assertEquals(302, response.status_code)
+        self.assertEquals('/media/photo.png', response['Location'])
+        self.assertEquals('max-age=5', response['Cache-Control'])
+        self.assertEquals([], self.resized)
+        self.assertEquals((1, 0), self.queue().drain())
+        self.assertEquals([(settings.MEDIA_ROOT + '/photo.png', settings.MEDIA_CACHE_ROOT + '/photo.100x100.png', 100, 100)], self.resized)
+    
+    def test_should_serve_placeholder(self):
+        settings.RESIZE_MISS_POLICY = 'placeholder'
+        response = self.request()
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('image/gif', response['Content-Type'])
+        self.assertEquals(views.TRANSPARENT_GIF, response.content)
+        settings.RESIZE_PLACEHOLDER_IMAGE = settings.TEST_MEDIA_ROOT + '/test.png'
+        response = self.request()
+        self.assertEquals('image/png', response['Content-Type'])
+        self.assertEquals(open(settings.TEST_MEDIA_ROOT + '/test.png', 'rb').read(), response.content)
+    
+    def test_should_accept_and_queue_target_once(self):
+        settings.RESIZE_MISS_POLICY = 'accepted'
+        settings.RESIZE_MISS_MAX_AGE = 2
+        self.assertEquals(202, self.request().status_code)
+        response = self.request()
+        self.assertEquals(202, response.status_code)
+        self.assertEquals('2', response['Retry-After'])
+        self.assertEquals((1, 0), self.queue().drain())
+    
+    def test_should_serve_cached_images(self):
+        settings.RESIZE_MISS_POLICY = 'accepted'
+        os.makedirs(settings.MEDIA_CACHE_ROOT)
+        open(settings.MEDIA_CACHE_ROOT + '/photo.100x100.png', 'w').write('image')
+        self.assertEquals(settings.MEDIA_CACHE_ROOT + '/photo.100x100.png', self.request().content)
+    
+    @raises(Http404)
+    def test_should_not_queue_missing_sources(self):
+        settings.RESIZE_MISS_POLICY = 'accepted'
+        try:
+            self.request('missing')
+        finally:
+            self.assertEquals(None, self.queue().claim())
+    
+    def test_should_render_failed_images_while_request_waits(self):
+        settings.RESIZE_MISS_POLICY = 'accepted'
+        open(settings.MEDIA_ROOT + '/broken.png', 'w').write('source')
+        self.assertEquals(202, self.request('broken').status_code)
+        self.assertEquals((1, 1), self.queue().drain())
+        self.assertRaises(Http404, self.request, 'broken')
+        self.assertEquals(2, len(self.resized))
+    
+    def test_should_share_failures_of_file_queue_between_processes(self):
+        settings.RESIZE_MISS_POLICY = 'accepted'
+        open(settings.MEDIA_ROOT + '/broken.png', 'w').write('source')
+        self.request('broken')
+        self.assertEquals((1, 1), self.queue().drain())
+        background._failed.clear() # Failed in the render_queued_images process
+        self.assertTrue(background.failed(settings.MEDIA_CACHE_ROOT + '/broken.100x100.png'))
+        self.assertRaises(Http404, self.request, 'broken')
+        self.assertEquals(None, self.queue().claim())
+    
+    def test_should_forget_failure_once_rendered_while_request_waits(self):
+        settings.RESIZE_MISS_POLICY = 'accepted'
+        target = settings.MEDIA_CACHE_ROOT + '/flaky.100x100.png'
+        open(settings.MEDIA_ROOT + '/flaky.png', 'w').write('source')
+        self.broken = ('flaky',)
+        self.request('flaky')
+        self.assertEquals((1, 1), self.queue().drain())
+        self.broken = ()
+        self.assertEquals(target, self.request('flaky').content)
+        self.assertFalse(background.failed(target))
+        self.assertEquals(202, self.request('flaky').status_code)
+    
+    def test_should_not_remember_busy_renders_as_failed(self):
+        settings.RESIZE_MISS_POLICY = 'accepted'
+        open(settings.MEDIA_ROOT + '/busy.png', 'w').write('source')
+        self.request('busy')
+        self.assertEquals((1, 0), self.queue().drain())
+        self.assertFalse(background.failed(settings.MEDIA_CACHE_ROOT + '/busy.100x100.png'))
+        self.assertEquals(202, self.request('busy').status_code)
+    
+    def test_should_render_in_threads(self):
+        queue = background.ThreadQueue(1)
+        queue.put(('resize', settings.MEDIA_ROOT + '/photo.png', settings.MEDIA_CACHE_ROOT + '/photo.10x10.png', 10, 10))
+        for _ in range(100):
+            if self.resized:
+                break
+            time.sleep(0.01)
+        self.assertEquals([(settings.MEDIA_ROOT + '/photo.png', settings.MEDIA_CACHE_ROOT + '/photo.10x10.png', 10, 10)], self.resized)
+    
+    def test_command_should_drain_queue(self):
+        from imageservice.management.commands.render_queued_images import Command
+        from StringIO import StringIO
+        settings.RESIZE_MISS_POLICY = 'accepted'
+        self.request()
+        stdout = StringIO()
+        Command().execute(stdout=stdout)
+        self.assertEquals("Rendered 1 images, 0 failed.\n", stdout.getvalue())
+        self.assertEquals(None, self.queue().claim())
+
+def gif(width, height, frames):
+    """ The blocks of a GIF image with frames frames. The image data is not decodable, only countable. """
+    image = 'GIF89a' + struct.pack('<HHBBB', width, height, 0x80, 0, 0) + '\x00\x00\x00\xff\xff\xff'
+    image += '!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00'
+    for _ in range(frames):
+        image += '!\xf9\x04\x00\x0a\x00\x00\x00'
+        image += ',' + struct.pack('<HHHHB', 0, 0, width, height, 0) + '\x02\x02\x44\x01\x00'
+    return image + ';'
+
+class AnimationTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.animated = self.tmp_dir + '/animated.gif'
+        open(self.animated, 'wb').write(gif(40, 30, 3))
+        open(self.tmp_dir + '/still.gif', 'wb').write(gif(40, 30, 1))
+        probe._cache.clear()
+        self.calls = []
+        self.old_callImageMagick = imagemagick._callImageMagick
+        def mock_callImageMagick(command, src, target):
+            self.calls.append(command)
+            open(target, 'w').write('image')
+        imagemagick._callImageMagick = mock_callImageMagick
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        imagemagick._callImageMagick = self.old_callImageMagick
+        for name in ('RESIZE_MAX_FRAMES', 'RESIZE_MAX_ANIMATION_PIXELS', 'RESIZE_FLATTEN_ANIMATIONS'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def test_should_count_gif_frames(self):
+        info = probe.probe(self.animated)
+        self.assertEquals(('GIF', 40, 30, 3), (info.format, info.width, info.height, info.frames))
+        self.assertEquals(1, probe.probe(self.tmp_dir + '/still.gif').frames)
+        open(self.tmp_dir + '/truncated.gif', 'wb').write(gif(40, 30, 3)[:-20])
+        self.assertEquals(2, probe.probe(self.tmp_dir + '/truncated.gif').frames)
+    
+    def test_should_animate_gif_targets_within_limits(self):
+        self.assertTrue(animation.animates(self.animated, 'target.gif'))
+        self.assertFalse(animation.animates(self.animated, 'target.png'))
+        self.assertFalse(animation.animates(self.animated, 'target.gif', flatten=True))
+        self.assertFalse(animation.animates(self.tmp_dir + '/still.gif', 'target.gif'))
+        settings.RESIZE_MAX_FRAMES = 2
+        self.assertFalse(animation.animates(self.animated, 'target.gif'))
+        settings.RESIZE_MAX_FRAMES = 3
+        settings.RESIZE_MAX_ANIMATION_PIXELS = 40 * 30 * 3 - 1
+        self.assertFalse(animation.animates(self.animated, 'target.gif'))
+    
+    def test_should_read_first_frame_unless_animated(self):
+        self.assertEquals(self.animated + '[0]', animation.input_file(self.animated, ['-trim']))
+        self.assertEquals(self.animated, animation.input_file(self.animated, animation.command('-trim').split('  ')))
+        self.assertEquals(self.tmp_dir + '/still.gif', animation.input_file(self.tmp_dir + '/still.gif', ['-trim']))
+    
+    def test_should_resize_animations_frame_by_frame(self):
+        imagemagick.resize(self.animated, self.tmp_dir + '/animated.20x20.gif', 20, 20)
+        imagemagick.resize(self.animated, self.tmp_dir + '/animated.20x20.png', 20, 20)
+        self.assertEquals([animation.resize_command(20, 20), imagemagick.resize_command(20, 20)], self.calls)
+        self.assertTrue(self.calls[0].startswith('-coalesce  -resize  20x20>'))
+        self.assertTrue(self.calls[0].endswith('  -layers  Optimize'))
+    
+    def test_should_flatten_configured_templates(self):
+        settings.RESIZE_FLATTEN_ANIMATIONS = ('thumb', 'resize')
+        self.assertTrue(animation.flattened('thumb'))
+        self.assertFalse(animation.flattened('card'))
+        imagemagick.resize(self.animated, self.tmp_dir + '/animated.20x20.gif', 20, 20)
+        imagemagick.execute('-trim', self.animated, self.tmp_dir + '/animated.thumb.gif', flatten=animation.flattened('thumb'))
+        imagemagick.execute('-trim', self.animated, self.tmp_dir + '/animated.card.gif', flatten=animation.flattened('card'))
+        self.assertEquals([imagemagick.resize_command(20, 20), '-trim', '-coalesce  -trim  -layers  Optimize'], self.calls)
+        settings.RESIZE_FLATTEN_ANIMATIONS = True
+        self.assertTrue(animation.flattened('card'))
+    
+    def test_should_pass_first_frame_to_imagemagick(self):
+        imagemagick._callImageMagick = self.old_callImageMagick
+        calls = []
+        old_runImageMagick = imagemagick._runImageMagick
+        imagemagick._runImageMagick = lambda src, args, target, input_args=(): calls.append(src)
+        try:
+            imagemagick.execute('-trim', self.animated, self.tmp_dir + '/animated.trim.png')
+            imagemagick.execute('-trim', self.animated, self.tmp_dir + '/animated.trim.gif')
+        finally:
+            imagemagick._runImageMagick = old_runImageMagick
+        self.assertEquals([self.animated + '[0]', self.animated], calls)
+
+class TemplatePipelineTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.makedirs(self.tmp_dir + '/templates')
+        os.makedirs(self.tmp_dir + '/media')
+        open(self.tmp_dir + '/media/photo.png', 'w').write('source')
+        self.old_settings = (settings.TEMPLATE_DIRS, settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT)
+        settings.TEMPLATE_DIRS = (self.tmp_dir + '/templates',)
+        settings.MEDIA_ROOT = self.tmp_dir + '/media'
+        settings.MEDIA_CACHE_ROOT = self.tmp_dir + '/cache'
+        self.write_templates('# Comment', '', 'trim = -trim', 'sharpen = -unsharp  0x1', 
+                             'card = trim | -resize  400x300> | sharpen', 'banner = trim | -resize  800x200>', 
+                             'hint = -define  jpeg:size=100x100')
+        self.calls = []
+        self.old_callImageMagick = imagemagick._callImageMagick
+        def mock_callImageMagick(command, src, target):
+            self.calls.append((command, src, target))
+            open(target, 'w').write('image')
+        imagemagick._callImageMagick = mock_callImageMagick
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        (settings.TEMPLATE_DIRS, settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT) = self.old_settings
+        imagemagick._callImageMagick = self.old_callImageMagick
+        if hasattr(settings, 'RESIZE_TEMPLATES_CHECK_INTERVAL'):
+            del settings.RESIZE_TEMPLATES_CHECK_INTERVAL
+    
+    def write_templates(self, *lines):
+        file = self.tmp_dir + '/templates/imagemagick.templates'
+        mtime = os.path.isfile(file) and os.path.getmtime(file)
+        open(file, 'w').write('\n'.join(lines))
+        if mtime:
+            os.utime(file, (mtime + 1, mtime + 1))
+    
+    def test_should_compile_pipelines(self):
+        repository = TemplateRepository()
+        card = repository.get('card')
+        self.assertEquals(['-trim', '-resize  400x300>', '-unsharp  0x1'], card.stages)
+        self.assertEquals('-trim  -resize  400x300>  -unsharp  0x1', repository.getTemplate('card'))
+        self.assertEquals('-define  jpeg:size=100x100', repository.getTemplate('hint'))
+        self.assertRaises(KeyError, repository.get, 'Comment')
+    
+    @raises(ValueError)
+    def test_should_reject_cyclic_references(self):
+        self.write_templates('a = -trim | b', 'b = a')
+        TemplateRepository()
+    
+    def test_should_reload_changed_file(self):
+        settings.RESIZE_TEMPLATES_CHECK_INTERVAL = 0
+        repository = TemplateRepository()
+        self.write_templates('trim = -trim  +repage')
+        self.assertEquals('-trim  +repage', repository.getTemplate('trim'))
+        self.assertRaises(KeyError, repository.get, 'card')
+        self.write_templates('trim = -trim | trim')
+        self.assertEquals('-trim  +repage', repository.getTemplate('trim'))
+    
+    def test_should_not_reload_within_interval(self):
+        repository = TemplateRepository()
+        self.write_templates('trim = -trim  +repage')
+        self.assertEquals('-trim', repository.getTemplate('trim'))
+    
+    def test_should_share_intermediate_of_first_stage(self):
+        repository = TemplateRepository()
+        source = settings.MEDIA_ROOT + '/photo'
+        imagemagick.execute_stages(repository.get('card').stages, source, settings.MEDIA_CACHE_ROOT + '/photo.card.png')
+        imagemagick.execute_stages(repository.get('banner').stages, source, settings.MEDIA_CACHE_ROOT + '/photo.banner.png')
+        intermediate = paths.stage_file('photo', '-trim', '.png')
+        self.assertEquals([('-trim', settings.MEDIA_ROOT + '/photo.png', intermediate),
+                           ('-resize  400x300>  -unsharp  0x1', intermediate, settings.MEDIA_CACHE_ROOT + '/photo.card.png'),
+                           ('-resize  800x200>', intermediate, settings.MEDIA_CACHE_ROOT + '/photo.banner.png')], self.calls)
+    
+    def test_view_should_render_pipeline(self):
+        old_templatesRepo = views.templatesRepo
+        old_render_image_to_response = views.render_image_to_response
+        views.templatesRepo = TemplateRepository()
+        views.render_image_to_response = lambda file_name, request=None, cache_key=None: HttpResponse(file_name)
+        try:
+            response = views.execute_template(None, 'photo', 'card', '.png')
+        finally:
+            views.templatesRepo = old_templatesRepo
+            views.render_image_to_response = old_render_image_to_response
+        self.assertEquals(settings.MEDIA_CACHE_ROOT + '/photo.card.png', response.content)
+        self.assertEquals(['-trim', '-resize  400x300>  -unsharp  0x1'], [command for (command, _, _) in self.calls])
+
+class ResponsiveImageTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_roots = (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT)
+        settings.MEDIA_ROOT = self.tmp_dir + '/media'
+        settings.MEDIA_CACHE_ROOT = self.tmp_dir + '/cache'
+        settings.RESIZE_METADATA_INDEX = self.tmp_dir + '/metadata.json'
+        settings.RESIZE_IMAGE_URL = '/images/'
+        os.makedirs(settings.MEDIA_ROOT + '/photos')
+        shutil.copy(settings.TEST_MEDIA_ROOT + '/test.png', settings.MEDIA_ROOT + '/photos/test.png')
+        metadata._index = None
+        probe._cache.clear()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        (settings.MEDIA_ROOT, settings.MEDIA_CACHE_ROOT) = self.old_roots
+        metadata._index = None
+        for name in ('RESIZE_METADATA_INDEX', 'RESIZE_IMAGE_URL', 'RESIZE_SRCSET_WIDTHS', 'RESIZE_SIZE_BUCKETS', 'RESIZE_LOCK_TIMEOUT'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def test_should_persist_index(self):
+        index = metadata.get_index()
+        index.record('photos/cat', 1000, 500, (800, 400, 100, 50))
+        index.record('photos/dog', 300, 200)
+        self.assertEquals((800, 400), index.get('photos/cat').trimmed_size())
+        index.save()
+        index.record('photos/cat', 1000, 500)
+        info = metadata.MetadataIndex(settings.RESIZE_METADATA_INDEX).get('photos/cat')
+        self.assertEquals((1000, 500, (800, 400, 100, 50)), (info.width, info.height, info.trim))
+        self.assertEquals((300, 200), metadata.MetadataIndex(settings.RESIZE_METADATA_INDEX).get('photos/dog').trimmed_size())
+        self.assertEquals(None, index.get('photos/bird'))
+    
+    def test_should_keep_entries_while_index_is_locked(self):
+        settings.RESIZE_LOCK_TIMEOUT = 0
+        index = metadata.get_index()
+        index.record('photos/cat', 1000, 500)
+        with locks.render_lock(settings.RESIZE_METADATA_INDEX, 1):
+            index.save()
+        self.assertFalse(os.path.exists(settings.RESIZE_METADATA_INDEX))
+        index.save()
+        self.assertEquals((1000, 500), metadata.MetadataIndex(settings.RESIZE_METADATA_INDEX).get('photos/cat').trimmed_size())
+    
+    def test_should_record_sources_when_rendering(self):
+        old_callImageMagick = imagemagick._callImageMagick
+        imagemagick._callImageMagick = lambda command, src, target: open(target, 'w').write('image')
+        try:
+            imagemagick.resize(settings.MEDIA_ROOT + '/photos/test', settings.MEDIA_CACHE_ROOT + '/photos/test.100x100.png', 100, 100)
+        finally:
+            imagemagick._callImageMagick = old_callImageMagick
+        info = metadata.get_index().get('photos/test')
+        self.assertEquals((512, 390, None), (info.width, info.height, info.trim))
+    
+    def test_should_render_srcset_from_index(self):
+        metadata.get_index().record('photos/cat', 1000, 500, (800, 400, 100, 50))
+        html = image_service.responsive_image_html('/images/photos/cat.jpg', widths='320,640,960', sizes='50vw', alt='A "cat"')
+        self.assertEquals('<img src="/images/photos/cat.640x320.jpg" '
+                          'srcset="/images/photos/cat.320x160.jpg 320w, /images/photos/cat.640x320.jpg 640w" '
+                          'sizes="50vw" width="640" height="320" alt="A &quot;cat&quot;">', html)
+    
+    def test_should_use_size_buckets_and_source_size(self):
+        settings.RESIZE_SIZE_BUCKETS = ('100x100', '300x300')
+        metadata.get_index().record('photos/cat', 200, 100)
+        html = image_service.responsive_image_html('/images/photos/cat.jpg', widths=[50, 150, 1000])
+        self.assertTrue('srcset="/images/photos/cat.100x100.jpg 100w, /images/photos/cat.300x300.jpg 300w"' in html, html)
+    
+    def test_should_render_plain_image_without_metadata(self):
+        self.assertEquals('<img src="/images/photos/bird.jpg" alt="">', image_service.responsive_image_html('/images/photos/bird.jpg'))
+        self.assertEquals('<img src="/other/cat.jpg" alt="">', image_service.responsive_image_html('/other/cat.jpg'))
+    
+    def test_tag_should_render_image(self):
+        from django.template import Template, Context, add_to_builtins
+        add_to_builtins('imageservice.templatetags.image_service')
+        settings.RESIZE_SRCSET_WIDTHS = (100, 200)
+        metadata.get_index().record('photos/cat', 400, 300)
+        html = Template('{% responsive_image url alt=name class="photo" %}').render(Context({'url': '/images/photos/cat.png', 'name': 'Cat'}))
+        self.assertEquals('<img src="/images/photos/cat.200x150.png" srcset="/images/photos/cat.100x75.png 100w, '
+                          '/images/photos/cat.200x150.png 200w" sizes="100vw" width="200" height="150" alt="Cat" class="photo">', html)
+    
+    def test_command_should_index_sources(self):
+        from imageservice.management.commands.index_image_metadata import Command
+        from StringIO import StringIO
+        stdout = StringIO()
+        Command().execute(stdout=stdout, trim=False)
+        self.assertEquals("Indexed 1 images, 0 failed.\n", stdout.getvalue())
+        self.assertEquals((512, 390), metadata.MetadataIndex(settings.RESIZE_METADATA_INDEX).get('photos/test').trimmed_size())
+
 class TemporaryFileTest(unittest.TestCase):
    
     def setUp(self):
@@ -110,7 +1797,7 @@ class TemporaryFileTest(unittest.TestCase):
         
         self.temp_file = self.tmp_dir + "/tempfile.png"
         self.old_mkstemp = tempfile.mkstemp
-        tempfile.mkstemp = lambda **kwargs: (None, self.temp_file)  
+        tempfile.mkstemp = lambda **kwargs: (os.open(self.temp_file, os.O_RDWR | os.O_CREAT), self.temp_file)
          
         
     def tearDown(self):
@@ -174,8 +1861,9 @@ class ResizeImageViewTest(unittest.TestCase):
                     'height': height,
                     }
        
-        def mock_render_image_to_response(file_name):
+        def mock_render_image_to_response(file_name, request=None, cache_key=None):
             self.result['rendered_to_http_response'] = True
+            self.result['cache_key'] = cache_key
             return self.result
             
         self.old_render_image_to_response = views.render_image_to_response
@@ -258,6 +1946,10 @@ class ResizeImageViewTest(unittest.TestCase):
     def test_should_render_resized_image_to_http_response(self):
         result = views.resize_image(None, self.file_name_without_extension, self.width, self.height, self.file_extension)
         self.assertTrue(result['rendered_to_http_response'])
+    
+    def test_should_use_size_as_cache_key(self):
+        result = views.resize_image(None, self.file_name_without_extension, self.width, self.height, self.file_extension)
+        self.assertEquals("100x200", result['cache_key'])
 
     def test_should_be_case_sensitive(self):
         result = views.resize_image(None, "Case", self.width, self.height, ".PNG")
@@ -280,18 +1972,27 @@ class TemplatesRepositoryTest(unittest.TestCase):
 class MockFile(object):
     def __init__(self, file_name):
         self.file_name = file_name
+        self.closed = False
         
     def read(self):
         return ["mocked_binary:", self.file_name]
+    
+    def close(self):
+        self.closed = True
 
 class RenderImageToResponseTest(unittest.TestCase):
     
     def setUp(self):
         self.old_open = views._open
-        views._open = lambda f: MockFile(f)
+        self.opened = []
+        def mock_open(f):
+            self.opened.append(MockFile(f))
+            return self.opened[-1]
+        views._open = mock_open
         
     def tearDown(self):
         views._open = self.old_open
+        settings.RESIZE_SERVE_MODE = 'buffered'
     
     def test_should_inlude_file_data_in_response_content(self):
         result = views.render_image_to_response("foo.jpg")
@@ -300,8 +2001,121 @@ class RenderImageToResponseTest(unittest.TestCase):
     def test_should_have_image_as_content_type(self):
         result = views.render_image_to_response("foo.jpg")
         self.assertEquals("image/jpg", result['content-type'])
+    
+    def test_should_close_file_after_reading_it(self):
+        views.render_image_to_response("foo.jpg")
+        self.assertTrue(self.opened[0].closed)
+    
+    def test_should_stream_file_in_chunks_if_configured(self):
+        views._open = self.old_open
+        settings.RESIZE_SERVE_MODE = 'stream'
+        file_name = settings.TEST_MEDIA_ROOT + '/test.png'
+        result = views.render_image_to_response(file_name)
+        
+        self.assertEquals(str(os.path.getsize(file_name)), result['Content-Length'])
+        self.assertEquals(open(file_name, 'rb').read(), "".join(result))
+        result.close()
+    
+    def test_should_leave_sending_the_file_to_the_web_server_if_xsendfile_is_configured(self):
+        settings.RESIZE_SERVE_MODE = 'xsendfile'
+        result = views.render_image_to_response("/cache/foo.jpg")
+        
+        self.assertEquals("/cache/foo.jpg", result['X-Sendfile'])
+        self.assertEquals([], self.opened)
+    
+    def test_should_redirect_to_internal_location_below_cache_root_if_xaccel_is_configured(self):
+        settings.RESIZE_SERVE_MODE = 'xaccel'
+        settings.RESIZE_ACCEL_REDIRECT_PREFIX = '/protected/'
+        try:
+            result = views.render_image_to_response("%s/dir/foo.jpg" % settings.MEDIA_CACHE_ROOT)
+        finally:
+            del settings.RESIZE_ACCEL_REDIRECT_PREFIX
+        
+        self.assertEquals("/protected/dir/foo.jpg", result['X-Accel-Redirect'])
+        self.assertEquals([], self.opened)
 
 
+def make_request(method='GET', **meta):
+    request = HttpRequest()
+    request.method = method
+    request.META.update(meta)
+    return request
+
+class ConditionalResponseTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.file_name = settings.TEST_MEDIA_ROOT + '/test.png'
+        stat = os.stat(self.file_name)
+        self.etag = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+        self.last_modified = http_date(stat.st_mtime)
+        
+        self.old_open = views._open
+        self.opened = []
+        def mock_open(f):
+            self.opened.append(f)
+            return self.old_open(f)
+        views._open = mock_open
+    
+    def tearDown(self):
+        views._open = self.old_open
+        for name in ('RESIZE_CACHE_MAX_AGE', 'RESIZE_CACHE_MAX_AGES'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+    
+    def test_should_set_validators(self):
+        result = views.render_image_to_response(self.file_name, make_request())
+        self.assertEquals(200, result.status_code)
+        self.assertEquals(self.etag, result['ETag'])
+        self.assertEquals(self.last_modified, result['Last-Modified'])
+    
+    def test_should_answer_matching_if_none_match_with_not_modified_without_opening_file(self):
+        result = views.render_image_to_response(self.file_name, make_request(HTTP_IF_NONE_MATCH=self.etag))
+        self.assertEquals(304, result.status_code)
+        self.assertEquals([], self.opened)
+    
+    def test_should_send_image_if_etag_does_not_match(self):
+        result = views.render_image_to_response(self.file_name, make_request(HTTP_IF_NONE_MATCH='"other"'))
+        self.assertEquals(200, result.status_code)
+    
+    def test_should_answer_if_modified_since_with_not_modified_if_image_is_unchanged(self):
+        result = views.render_image_to_response(self.file_name, make_request(HTTP_IF_MODIFIED_SINCE=self.last_modified))
+        self.assertEquals(304, result.status_code)
+        self.assertEquals([], self.opened)
+    
+    def test_should_answer_own_last_modified_with_not_modified_for_fractional_mtime(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            file_name = tmp_dir + '/test.png'
+            shutil.copy(self.file_name, file_name)
+            os.utime(file_name, (1300000000.75, 1300000000.75))
+            last_modified = views.render_image_to_response(file_name, make_request())['Last-Modified']
+            result = views.render_image_to_response(file_name, make_request(HTTP_IF_MODIFIED_SINCE=last_modified))
+            self.assertEquals(304, result.status_code)
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_should_answer_head_request_without_opening_file(self):
+        result = views.render_image_to_response(self.file_name, make_request('HEAD'))
+        self.assertEquals(200, result.status_code)
+        self.assertEquals(str(os.path.getsize(self.file_name)), result['Content-Length'])
+        self.assertEquals([], self.opened)
+    
+    def test_should_not_set_cache_control_by_default(self):
+        result = views.render_image_to_response(self.file_name, make_request(), '100x100')
+        self.assertFalse(result.has_header('Cache-Control'))
+    
+    def test_should_set_configured_max_age(self):
+        settings.RESIZE_CACHE_MAX_AGE = 60
+        result = views.render_image_to_response(self.file_name, make_request(), '100x100')
+        self.assertEquals('public, max-age=60', result['Cache-Control'])
+        self.assertTrue(result.has_header('Expires'))
+    
+    def test_should_prefer_max_age_of_cache_key(self):
+        settings.RESIZE_CACHE_MAX_AGE = 60
+        settings.RESIZE_CACHE_MAX_AGES = {'thumb': 3600}
+        result = views.render_image_to_response(self.file_name, make_request(), 'thumb')
+        self.assertEquals('public, max-age=3600', result['Cache-Control'])
+
 class ResizeUrlTest(unittest.TestCase):
     
     def setUp(self):
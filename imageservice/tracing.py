@@ -0,0 +1,77 @@
+from __future__ import with_statement
+
+import time
+import logging
+import threading
+
+from contextlib import contextmanager
+from django.conf import settings
+
+logger = logging.getLogger('imageservice.tracing')
+
+def enabled():
+    return getattr(settings, 'RESIZE_TRACING', False)
+
+@contextmanager
+def trace():
+    """ Records the phases of the with block in a new Trace, which is yielded,
+        if settings.RESIZE_TRACING is True. Otherwise None is yielded and nothing is recorded.
+    """
+    if not enabled():
+        yield None
+        return
+    current = Trace()
+    previous = getattr(_local, 'trace', None)
+    _local.trace = current
+    try:
+        yield current
+    finally:
+        _local.trace = previous
+
+@contextmanager
+def phase(name):
+    """ Adds the duration of the with block as phase name to the trace of the current thread, if any. """
+    current = getattr(_local, 'trace', None)
+    if current is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        current.add(name, time.time() - start)
+
+_local = threading.local()
+
+class Trace(object):
+    """ Durations of the phases of one request, in the order the phases started. """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = []
+        self._durations = {}
+
+    def add(self, name, seconds):
+        if name not in self._durations:
+            self.phases.append(name)
+            self._durations[name] = 0.0
+        self._durations[name] += seconds
+
+    def duration(self, name):
+        return self._durations.get(name, 0.0)
+
+    def server_timing(self):
+        """ Returns the phases and the total duration as a Server-Timing header value, in milliseconds. """
+        entries = ['%s;dur=%.1f' % (name, self.duration(name) * 1000) for name in self.phases]
+        entries.append('total;dur=%.1f' % ((time.time() - self.started) * 1000))
+        return ', '.join(entries)
+
+def finish(current, request, response):
+    """ Adds the Server-Timing header for the trace to response and, if settings.RESIZE_TRACING_LOG is True,
+        logs a line of key=value pairs to the 'imageservice.tracing' logger.
+    """
+    timing = current.server_timing()
+    response['Server-Timing'] = timing
+    if getattr(settings, 'RESIZE_TRACING_LOG', False):
+        phases = ' '.join([entry.replace(';dur=', '=') for entry in timing.split(', ')])
+        logger.info('method=%s path=%s status=%d %s', request.method, request.path, response.status_code, phases)
@@ -1,51 +1,342 @@
-from django.http import HttpResponse, Http404
+from __future__ import with_statement
+from django.http import HttpResponse, HttpResponseNotModified, HttpResponseRedirect, Http404
+from django.core.servers.basehttp import FileWrapper
+from django.utils.http import http_date, parse_etags
+from django.utils.cache import patch_vary_headers
+from django.views.static import was_modified_since
 from imageservice.template_repository import TemplateRepository
+from imageservice import admission, animation, background, backends, cacheindex, formats, hotcache, metrics, paths, renditions, tracing
 import imagemagick
 from django.conf import settings
+import os
+import time
 
 templatesRepo = TemplateRepository()
 
+def traced(view):
+    """ Adds a Server-Timing header with the phases of the request to the response of view,
+        if settings.RESIZE_TRACING is True. See imageservice.tracing.
+    """
+    def traced_view(request, *args, **kwargs):
+        with tracing.trace() as trace:
+            response = view(request, *args, **kwargs)
+        if trace is not None:
+            tracing.finish(trace, request, response)
+        return response
+    traced_view.__name__ = view.__name__
+    traced_view.__doc__ = view.__doc__
+    return traced_view
+
+@traced
 def execute_template(request, file_name_without_extension, template_name, file_extension):
-    try:
-        command  = templatesRepo.getTemplate(template_name)
-    except Exception, e:
-        raise Http404(e)
-    
-    source_file = "%s/%s" % (settings.MEDIA_ROOT, file_name_without_extension)
-    target_file = "%s/%s.%s%s" % (settings.MEDIA_CACHE_ROOT, file_name_without_extension, template_name, file_extension)   
+    with tracing.phase('parse'):
+        try:
+            template = templatesRepo.get(template_name)
+        except Exception, e:
+            raise Http404(e)
+        
+        source_file = paths.source_file(file_name_without_extension)
+        target_file = paths.template_file(file_name_without_extension, template_name, file_extension)
     
+    backend = backends.backend_name(template_name)
+    flatten = animation.flattened(template_name)
+    task = lambda target: ('stages', template.stages, source_file, target, backend, template_name, flatten)
+    response = _enqueue_miss(request, source_file, target_file, task)
+    if response is not None:
+        return response
     try:
-        imagemagick.execute(command, source_file, target_file)    
+        target_file = _render_negotiated(request, target_file, lambda target: background.render_now(task(target)))
+    except admission.RendererBusy:
+        return render_busy_response()
     except Exception, e:
         raise Http404(e)
         
-    return render_image_to_response(target_file)
+    return _vary(render_image_to_response(target_file, request, template_name))
  
     
+@traced
 def resize_image(request, file_name_without_extension, width, height, file_extension):
-    width = int(width)
-    height = int(height)
-    
-    if height > settings.RESIZE_MAX_HEIGHT or width > settings.RESIZE_MAX_WIDTH:
-        raise Http404
-    
-    source_file = "%s/%s" % (settings.MEDIA_ROOT, file_name_without_extension)
-    if file_extension:
-        source_file += file_extension
-
-    target_file = "%s/%s.%dx%d%s" % (settings.MEDIA_CACHE_ROOT, file_name_without_extension, width, height, file_extension)   
+    with tracing.phase('parse'):
+        size = '%sx%s' % (width, height)
+        width = int(width)
+        height = int(height)
+        
+        if height > settings.RESIZE_MAX_HEIGHT or width > settings.RESIZE_MAX_WIDTH:
+            raise Http404
+        
+        bucket = renditions.bucket(width, height)
+        if bucket != (width, height):
+            url = _size_url(request, size, bucket, file_extension)
+            if url is not None and renditions.bucket_mode() == 'redirect':
+                return _bucket_redirect(url)
+            (width, height) = bucket
+        
+        source_file = paths.source_file(file_name_without_extension, file_extension)
+        target_file = paths.resized_file(file_name_without_extension, width, height, file_extension)
     
+    task = lambda target: ('resize', source_file, target, width, height)
+    response = _enqueue_miss(request, source_file, target_file, task)
+    if response is not None:
+        return response
     try:
-        imagemagick.resize(source_file, target_file, width, height)    
+        target_file = _render_negotiated(request, target_file, lambda target: background.render_now(task(target)))
+    except admission.RendererBusy:
+        return render_busy_response()
     except Exception, e:
         raise Http404(e)
         
-    return render_image_to_response(target_file)
+    return _vary(render_image_to_response(target_file, request, "%dx%d" % (width, height)))
+
+def _size_url(request, size, bucket, file_extension):
+    """ Returns the url of the request with size replaced by bucket, or None if it can not be derived. """
+    suffix = '.%s%s' % (size, file_extension)
+    if request is None or not request.path.endswith(suffix):
+        return None
+    url = '%s.%dx%d%s' % (request.path[:-len(suffix)], bucket[0], bucket[1], file_extension)
+    if request.META.get('QUERY_STRING'):
+        url += '?' + request.META['QUERY_STRING']
+    return url
+
+def _bucket_redirect(url):
+    """ 302 to the url of a size bucket. Not permanent, since the buckets may change, but it may be cached for
+        settings.RESIZE_SIZE_BUCKET_REDIRECT_MAX_AGE seconds (default 3600).
+    """
+    response = HttpResponseRedirect(url)
+    response['Cache-Control'] = 'max-age=%d' % getattr(settings, 'RESIZE_SIZE_BUCKET_REDIRECT_MAX_AGE', 3600)
+    return response
+
+def _enqueue_miss(request, source_file, target_file, task):
+    """ Unless settings.RESIZE_MISS_POLICY is 'render', renders an image that is not cached yet in the background
+        (see imageservice.background) and returns the response of the policy. Returns None for cached images,
+        and for images that failed to render in the background, so that they are rendered while the request waits.
+    """
+    policy = background.miss_policy()
+    if policy == 'render' or request is None:
+        return None
+    target = formats.negotiate(request, target_file) or target_file
+    hot = hotcache.get_cache()
+    if (hot is not None and hot.fresh(target) is not None) or os.path.isfile(target) or background.failed(target):
+        return None
+    try:
+        source_file = imagemagick._findAndVerifySource(source_file)
+    except IOError, e:
+        raise Http404(e)
+    background.enqueue(task(target))
+    metrics.incr('cache', result='queued')
+    return _vary(_miss_response(request, policy, source_file))
+
+def _miss_response(request, policy, source_file):
+    """ 'redirect': 302 to the source image. 'placeholder': settings.RESIZE_PLACEHOLDER_IMAGE or a transparent pixel.
+        'accepted': 202 Accepted. The responses may be cached for settings.RESIZE_MISS_MAX_AGE seconds (default 5).
+    """
+    max_age = getattr(settings, 'RESIZE_MISS_MAX_AGE', 5)
+    if policy == 'redirect' and source_file.startswith(settings.MEDIA_ROOT.rstrip('/') + '/'):
+        response = HttpResponseRedirect(settings.MEDIA_URL.rstrip('/') + source_file[len(settings.MEDIA_ROOT.rstrip('/')):])
+    elif policy == 'placeholder':
+        placeholder = getattr(settings, 'RESIZE_PLACEHOLDER_IMAGE', None)
+        if placeholder is not None:
+            f = _open(placeholder)
+            try:
+                response = HttpResponse(f.read(), mimetype=_mimetype(placeholder))
+            finally:
+                f.close()
+        else:
+            response = HttpResponse(TRANSPARENT_GIF, mimetype='image/gif')
+    else:
+        response = HttpResponse("The image is being rendered, please retry later.", status=202, mimetype='text/plain')
+        response['Retry-After'] = str(max_age)
+    response['Cache-Control'] = 'max-age=%d' % max_age
+    metrics.incr('responses', status=response.status_code)
+    return response
+
+# 1x1 transparent GIF
+TRANSPARENT_GIF = 'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\x00\x00\x00!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+
+def _render_negotiated(request, target_file, render):
+    """ Calls render with the file name of the best format variant of target_file that the client accepts 
+        (see formats.variants) and returns that file name. A variant that can not be rendered, for example 
+        because imagemagick lacks the encoder, is skipped for the next one, and its format is left out of 
+        negotiation for a while (see formats.record_failure). Falls back to target_file itself if no 
+        variant remains.
+    """
+    for variant in formats.variants(request, target_file):
+        try:
+            _render_unless_hot(render, variant)
+            return variant
+        except (admission.RendererBusy, IOError):
+            raise
+        except Exception:
+            formats.record_failure(variant)
+            metrics.incr('format_fallbacks', format=variant.split('.')[-1])
+    _render_unless_hot(render, target_file)
+    return target_file
+
+def _render_unless_hot(render, target_file):
+    """ Skips rendering, and any file system access, for images in the in-memory cache (see hotcache). """
+    hot = hotcache.get_cache()
+    entry = hot and hot.fresh(target_file)
+    if entry is not None:
+        _touch_hot(hot, entry)
+        metrics.incr('cache', result='hot')
+        return
+    render(target_file)
+
+def _touch_hot(hot, entry):
+    """ Records an access to an image served from memory in the cache index, at most once per hot cache TTL,
+        so that the index does not evict images that are only requested from memory.
+    """
+    now = time.time()
+    if now - entry.touched < hot.ttl:
+        return
+    entry.touched = now
+    index = cacheindex.get_index()
+    if index is not None:
+        index.touch(entry.path)
+
+def _vary(response):
+    if formats.negotiation_enabled():
+        patch_vary_headers(response, ('Accept',))
+    return response
+
+def render_busy_response():
+    """ 503 Service Unavailable, asking the client to retry after settings.RESIZE_RENDER_RETRY_AFTER seconds. """
+    metrics.incr('responses', status=503)
+    response = HttpResponse("Too many images are being rendered, please retry later.", status=503, mimetype='text/plain')
+    response['Retry-After'] = str(getattr(settings, 'RESIZE_RENDER_RETRY_AFTER', 5))
+    return response
 
 # Needed to be able to mock built in open function
 def _open(file_name):
     return open(file_name, 'rb')
 
-def render_image_to_response(image_file_name):
-    img = _open(image_file_name).read()
-    return HttpResponse(img, mimetype='image/%s' % image_file_name.split(".")[-1])
\ No newline at end of file
+def render_image_to_response(image_file_name, request=None, cache_key=None):
+    """ Returns a response with the image. 
+    
+        If request is given, the response has validators (ETag and Last-Modified) derived from the 
+        image file's modification time and size, a conditional request with matching validators is 
+        answered with 304 Not Modified and a HEAD request with the headers only, in both cases without 
+        opening the image. Cache-Control and Expires headers are set if a max age is configured:
+        
+        settings.RESIZE_CACHE_MAX_AGES: Max age in seconds per cache_key, which is the size 
+        (for example '100x100') or the template name of the image.
+        
+        settings.RESIZE_CACHE_MAX_AGE: Max age in seconds for all other images.
+    
+        How the image is sent depends on settings.RESIZE_SERVE_MODE:
+    
+        'buffered' (default): The image is read into memory and sent as the response content.
+        
+        'stream': The image is streamed from disk in chunks.
+        
+        'xsendfile': The front end server sends the file given in the X-Sendfile header.
+        
+        'xaccel': Nginx sends the file given in the X-Accel-Redirect header, which is the path 
+        of the image below MEDIA_CACHE_ROOT prefixed with settings.RESIZE_ACCEL_REDIRECT_PREFIX.
+        
+        Images small enough for the in-memory cache (see hotcache) are served from memory in any mode, 
+        if request is given.
+    
+    """
+    if request is None:
+        return _image_response(image_file_name)
+    
+    hot = hotcache.get_cache()
+    entry = hot and hot.fresh(image_file_name)
+    if entry is None:
+        stat = os.stat(image_file_name)
+        entry = hot and hot.get(image_file_name, stat)
+    if entry is not None:
+        _touch_hot(hot, entry)
+    (mtime, size) = entry and (entry.mtime, entry.size) or (stat.st_mtime, stat.st_size)
+    etag = '"%x-%x"' % (int(mtime), size)
+    
+    if _not_modified(request, etag, mtime, size):
+        response = HttpResponseNotModified()
+    elif request.method == 'HEAD':
+        response = HttpResponse(mimetype=_mimetype(image_file_name))
+        response['Content-Length'] = str(size)
+    elif entry is not None:
+        response = HttpResponse(entry.data, mimetype=_mimetype(image_file_name))
+        metrics.incr('response_bytes', size, mode='hot')
+    elif hot is not None and hot.accepts(size):
+        response = HttpResponse(_hot_read(hot, image_file_name, stat), mimetype=_mimetype(image_file_name))
+        metrics.incr('response_bytes', size, mode='buffered')
+    else:
+        response = _image_response(image_file_name)
+        metrics.incr('response_bytes', size, mode=getattr(settings, 'RESIZE_SERVE_MODE', 'buffered'))
+    metrics.incr('responses', status=response.status_code)
+    
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(mtime)
+    _add_max_age(response, cache_key)
+    return response
+
+def _hot_read(hot, image_file_name, stat):
+    with tracing.phase('response'):
+        img = _open(image_file_name)
+        try:
+            data = img.read()
+        finally:
+            img.close()
+    hot.put(image_file_name, data, stat)
+    return data
+
+def _not_modified(request, etag, mtime, size):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        etags = parse_etags(if_none_match)
+        return '*' in etags or etag.strip('"') in etags
+    
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is not None:
+        return not was_modified_since(if_modified_since, int(mtime), size) # Last-Modified has whole seconds
+    
+    return False
+
+def _add_max_age(response, cache_key):
+    max_age = getattr(settings, 'RESIZE_CACHE_MAX_AGES', {}).get(cache_key, 
+                                                                getattr(settings, 'RESIZE_CACHE_MAX_AGE', None))
+    if max_age is None:
+        return
+    response['Cache-Control'] = 'public, max-age=%d' % max_age
+    response['Expires'] = http_date(time.time() + max_age)
+
+def _mimetype(image_file_name):
+    return 'image/%s' % image_file_name.split(".")[-1]
+
+def _image_response(image_file_name):
+    with tracing.phase('response'):
+        return _read_image_response(image_file_name)
+
+def _read_image_response(image_file_name):
+    mimetype = _mimetype(image_file_name)
+    mode = getattr(settings, 'RESIZE_SERVE_MODE', 'buffered')
+    
+    if mode == 'stream':
+        response = HttpResponse(FileWrapper(_open(image_file_name)), mimetype=mimetype)
+        response['Content-Length'] = str(os.path.getsize(image_file_name))
+    elif mode == 'xsendfile':
+        response = HttpResponse(mimetype=mimetype)
+        response['X-Sendfile'] = image_file_name
+    elif mode == 'xaccel':
+        response = HttpResponse(mimetype=mimetype)
+        response['X-Accel-Redirect'] = _accel_redirect_location(image_file_name)
+    else:
+        img = _open(image_file_name)
+        try:
+            response = HttpResponse(img.read(), mimetype=mimetype)
+        finally:
+            img.close()
+    return response
+
+def _accel_redirect_location(image_file_name):
+    cache_root = settings.MEDIA_CACHE_ROOT.rstrip('/')
+    if not image_file_name.startswith(cache_root + '/'):
+        raise IOError("Image is not stored under MEDIA_CACHE_ROOT: %s" % image_file_name)
+    prefix = getattr(settings, 'RESIZE_ACCEL_REDIRECT_PREFIX', '/cache/')
+    return prefix.rstrip('/') + image_file_name[len(cache_root):]
+
+
+def prometheus_metrics(request):
+    """ Serves the metrics collected by imageservice.metrics.PrometheusSink in this process. """
+    return HttpResponse(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
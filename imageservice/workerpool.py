@@ -0,0 +1,150 @@
+from __future__ import with_statement
+
+import os
+import re
+import select
+import subprocess
+import threading
+import Queue
+
+from django.conf import settings
+from imageservice import admission, tracing
+
+class WorkerError(Exception):
+    """ Raised when a pooled worker fails to render an image. The worker is discarded. """
+    pass
+
+def get_pool():
+    """ Returns the ImageMagick worker pool of this process, or None if pooling is disabled.
+
+        The pool is configured with the following settings:
+
+        RESIZE_IMAGEMAGICK_POOL: Number of workers. (0 disables the pool)
+
+        RESIZE_IMAGEMAGICK_POOL_MAX_JOBS: Number of images a worker renders before it is replaced.
+
+        RESIZE_IMAGEMAGICK_POOL_TIMEOUT: Seconds to wait for a worker to finish an image.
+
+        RESIZE_IMAGEMAGICK_POOL_COMMAND: Command starting an ImageMagick process that reads a script from stdin.
+        
+        The resource limits of settings.RESIZE_IMAGEMAGICK_LIMITS are added to the command.
+
+    """
+    global _pool, _pool_pid
+    size = getattr(settings, 'RESIZE_IMAGEMAGICK_POOL', 0)
+    if not size:
+        return None
+
+    # Workers started before a fork belong to the parent process
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_guard:
+            if _pool is None or _pool_pid != os.getpid():
+                command = list(getattr(settings, 'RESIZE_IMAGEMAGICK_POOL_COMMAND', ('magick', '-script', '-')))
+                _pool = WorkerPool(size,
+                                   command[:1] + admission.imagemagick_limits() + command[1:],
+                                   getattr(settings, 'RESIZE_IMAGEMAGICK_POOL_MAX_JOBS', 100),
+                                   getattr(settings, 'RESIZE_IMAGEMAGICK_POOL_TIMEOUT', 60))
+                _pool_pid = os.getpid()
+    return _pool
+
+_pool = None
+_pool_pid = None
+_pool_guard = threading.Lock()
+
+class WorkerPool(object):
+    """ A fixed number of long lived ImageMagick processes. Workers are started on first use,
+        replaced after max_jobs images and whenever they fail.
+    """
+
+    def __init__(self, size, command, max_jobs, timeout):
+        self.command = list(command)
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.idle = Queue.Queue()
+        for _ in range(size):
+            self.idle.put(None)
+
+    def run(self, src, args, target, input_args=()):
+        """ Renders src with the imagemagick arguments args and writes the result to target.
+            input_args are settings for reading src. Blocks until a worker is idle.
+        """
+        worker = self.idle.get()
+        try:
+            if worker is None:
+                with tracing.phase('spawn'):
+                    worker = Worker(self.command)
+            with tracing.phase('render'):
+                worker.run(src, args, target, self.timeout, input_args)
+        except Exception:
+            if worker is not None:
+                worker.close()
+                worker = None
+            raise
+        finally:
+            if worker is not None and worker.jobs >= self.max_jobs:
+                worker.close()
+                worker = None
+            self.idle.put(worker)
+
+class Worker(object):
+    """ One ImageMagick process executing scripts read from its stdin. """
+
+    def __init__(self, command):
+        self.jobs = 0
+        self._buffer = ''
+        devnull = open(os.devnull, 'w')
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=devnull, close_fds=True)
+        except OSError, e:
+            raise WorkerError(e)
+        finally:
+            devnull.close()
+
+    def run(self, src, args, target, timeout, input_args=()):
+        self.jobs += 1
+        try:
+            self.process.stdin.write(script(src, args, target, input_args))
+            self.process.stdin.flush()
+        except IOError, e:
+            raise WorkerError(e)
+
+        if not self._readline(timeout):
+            raise WorkerError("ImageMagick worker did not finish %s." % target)
+        if not os.path.isfile(target) or os.path.getsize(target) == 0:
+            raise WorkerError("ImageMagick worker failed to write %s." % target)
+
+    def _readline(self, timeout):
+        fd = self.process.stdout.fileno()
+        while '\n' not in self._buffer:
+            (readable, _, _) = select.select([fd], [], [], timeout)
+            if not readable:
+                return None
+            data = os.read(fd, 4096)
+            if not data:
+                return None
+            self._buffer += data
+        (line, _, self._buffer) = self._buffer.partition('\n')
+        return line.strip()
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+def script(src, args, target, input_args=()):
+    """ Returns the ImageMagick script rendering one image. The image list is emptied afterwards
+        and a one line description of a dummy image is written to stdout to signal that the job is done.
+    """
+    tokens = list(input_args) + ['-read', src] + list(args) + ['-write', target, '-delete', '0--1',
+              '-size', '1x1', 'xc:black', '-write', 'info:/dev/stdout', '-delete', '0--1']
+    return " ".join([_quote(token) for token in tokens]) + "\n"
+
+def _quote(token):
+    if re.match(r'^[\w.,:%@+/<>=-]+$', token):
+        return token
+    return "'%s'" % token.replace("\\", "\\\\").replace("'", "\\'")